@@ -0,0 +1,28 @@
+import docopt
+
+import teuthology.archive
+import teuthology.config
+
+doc = """
+usage: teuthology-index -h
+       teuthology-index [-v] [-a ARCHIVE] [--rebuild | --verify]
+
+Bring the index of the archive directory up to date. teuthology-ls,
+teuthology-results, teuthology-report, teuthology-kill and
+teuthology-coverage read job information from it.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -a ARCHIVE, --archive ARCHIVE
+                        The base archive directory
+                        [default: {archive_base}]
+  --rebuild             Throw the index away and index the whole archive
+  --verify              Compare the index with the archive and list any
+                        differences, without changing anything
+  -v, --verbose         be more verbose
+""".format(archive_base=teuthology.config.config.archive_base)
+
+
+def main():
+    args = docopt.docopt(doc)
+    teuthology.archive.main(args)
@@ -33,6 +33,12 @@ combination, and will override anything in the suite.
         action='store_true', default=None,
         help='do a dry run; do not schedule anything',
     )
+    parser.add_argument(
+        '--count-only',
+        action='store_true', default=None,
+        help='only count the jobs the collections would generate; do not ' +
+        'schedule anything',
+    )
     parser.add_argument(
         '--name',
         help='name for this suite',
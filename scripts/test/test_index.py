@@ -0,0 +1,5 @@
+from script import Script
+
+
+class TestIndex(Script):
+    script_name = 'teuthology-index'
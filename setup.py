@@ -29,6 +29,7 @@ setup(
             'teuthology-report = scripts.report:main',
             'teuthology-kill = scripts.kill:main',
             'teuthology-queue = scripts.queue:main',
+            'teuthology-index = scripts.index:main',
             ],
         },
 
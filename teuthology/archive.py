@@ -0,0 +1,402 @@
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+import yaml
+
+import teuthology
+from .config import config
+
+log = logging.getLogger(__name__)
+
+
+def is_job_dir(run_dir, name):
+    return re.match('\d+$', name) and \
+        os.path.isdir(os.path.join(run_dir, name))
+
+
+def load_yaml(path):
+    """
+    Merge all the documents in a YAML file into one dict. A missing file
+    gives an empty dict.
+    """
+    info = {}
+    try:
+        with file(path) as f:
+            for doc in yaml.safe_load_all(f):
+                if doc:
+                    info.update(doc)
+    except IOError:
+        pass
+    return info
+
+
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def read_job(job_dir):
+    """
+    Read a job's YAML files from the archive.
+
+    :returns: A dict with an entry for each of ArchiveIndex.fields
+    """
+    info = load_yaml(os.path.join(job_dir, 'info.yaml'))
+    summary_path = os.path.join(job_dir, 'summary.yaml')
+    finished = os.path.exists(summary_path)
+    summary = load_yaml(summary_path)
+
+    machine_type = info.get('machine_type')
+    if machine_type is None:
+        conf_path = os.path.join(job_dir, 'config.yaml')
+        if not os.path.exists(conf_path):
+            conf_path = os.path.join(job_dir, 'orig.config.yaml')
+        machine_type = load_yaml(conf_path).get('machine_type')
+
+    sentry_events = summary.get('sentry_events')
+    if sentry_events:
+        sentry_event = sentry_events[0]
+    else:
+        sentry_event = summary.get('sentry_event')
+
+    if not finished:
+        status = 'running'
+    elif summary.get('success'):
+        status = 'pass'
+    else:
+        status = 'fail'
+    return dict(
+        status=status,
+        success=summary.get('success'),
+        duration=summary.get('duration'),
+        description=summary.get('description', info.get('description')),
+        failure_reason=summary.get('failure_reason'),
+        owner=summary.get('owner', info.get('owner')),
+        machine_type=machine_type,
+        pid=info.get('pid'),
+        flavor=summary.get('flavor'),
+        sentry_event=sentry_event,
+    )
+
+
+class ArchiveIndex(object):
+    """
+    A SQLite index of the runs and jobs in an archive directory, so that
+    listing them doesn't mean reading every job's YAML files.
+
+    The index is brought up to date incrementally: a run is only listed again
+    if its directory changed since it was last indexed, and a job is only
+    read again if its directory changed - which is the case when its
+    summary.yaml is written - or if it hadn't finished yet. Jobs are also
+    re-indexed explicitly by teuthology when it writes their summary.yaml.
+
+    The index lives in the archive directory, or at config.archive_index for
+    the index of config.archive_base; other archives always use their own.
+    """
+    # The columns of the jobs table, other than run and job_id
+    fields = ('status', 'success', 'duration', 'description',
+              'failure_reason', 'owner', 'machine_type', 'pid', 'flavor',
+              'sentry_event')
+
+    # A directory modified this recently may still be changing within the
+    # resolution of its mtime, so it isn't trusted to stay unmodified
+    racy_window = 2
+
+    def __init__(self, archive_base=None, path=None):
+        self.archive_base = os.path.abspath(
+            archive_base or config.archive_base)
+        if path is None and config.archive_index and \
+                self.archive_base == os.path.abspath(config.archive_base):
+            path = config.archive_index
+        self.path = path or os.path.join(
+            self.archive_base, '.teuthology-index.sqlite')
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run TEXT PRIMARY KEY,
+                mtime REAL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                run TEXT NOT NULL,
+                job_id TEXT NOT NULL,
+                status TEXT,
+                success INTEGER,
+                duration REAL,
+                description TEXT,
+                failure_reason TEXT,
+                owner TEXT,
+                machine_type TEXT,
+                pid INTEGER,
+                flavor TEXT,
+                sentry_event TEXT,
+                mtime REAL,
+                PRIMARY KEY (run, job_id)
+            );
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def _stable_mtime(self, mtime, now):
+        if mtime is None or now - mtime < self.racy_window:
+            return None
+        return mtime
+
+    def read_job(self, run_name, job_id):
+        return read_job(os.path.join(self.archive_base, run_name, job_id))
+
+    def update_job(self, run_name, job_id, mtime=None):
+        """
+        (Re-)index one job, e.g. after its summary.yaml was written.
+        """
+        job = self.read_job(run_name, job_id)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [run_name, job_id] + [job[f] for f in self.fields] + [mtime])
+
+    def update_run(self, run_name):
+        """
+        Bring the index of one run up to date.
+        """
+        now = time.time()
+        run_dir = os.path.join(self.archive_base, run_name)
+        mtime = get_mtime(run_dir)
+        if mtime is None:
+            self.remove_run(run_name)
+            return
+        row = self.db.execute("SELECT mtime FROM runs WHERE run = ?",
+                              (run_name,)).fetchone()
+        indexed = dict((job_id, (job_mtime, status)) for
+                       job_id, job_mtime, status in self.db.execute(
+                           "SELECT job_id, mtime, status FROM jobs "
+                           "WHERE run = ?", (run_name,)))
+        if row is None or row[0] != mtime:
+            job_ids = [name for name in os.listdir(run_dir)
+                       if is_job_dir(run_dir, name)]
+            gone = set(indexed).difference(job_ids)
+            with self.db:
+                self.db.executemany(
+                    "DELETE FROM jobs WHERE run = ? AND job_id = ?",
+                    [(run_name, job_id) for job_id in gone])
+        else:
+            # No jobs were added or removed. Finished jobs don't change
+            # unless they are re-indexed explicitly.
+            job_ids = [job_id for job_id, (job_mtime, status)
+                       in indexed.iteritems()
+                       if job_mtime is None or status == 'running']
+        for job_id in job_ids:
+            job_mtime = get_mtime(os.path.join(run_dir, job_id))
+            if job_mtime is None:
+                continue
+            if job_id not in indexed or indexed[job_id][0] != job_mtime:
+                self.update_job(run_name, job_id,
+                                self._stable_mtime(job_mtime, now))
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?)",
+                            (run_name, self._stable_mtime(mtime, now)))
+
+    def remove_run(self, run_name):
+        with self.db:
+            self.db.execute("DELETE FROM jobs WHERE run = ?", (run_name,))
+            self.db.execute("DELETE FROM runs WHERE run = ?", (run_name,))
+
+    def update(self):
+        """
+        Bring the index of every run in the archive up to date.
+        """
+        run_names = self.list_runs()
+        for run_name in set(self.runs()).difference(run_names):
+            self.remove_run(run_name)
+        for run_name in run_names:
+            self.update_run(run_name)
+
+    def rebuild(self):
+        """
+        Throw the index away and index the whole archive again.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM jobs")
+            self.db.execute("DELETE FROM runs")
+        self.update()
+
+    def list_runs(self):
+        """
+        The runs in the archive directory itself, in the order os.listdir()
+        returns them.
+        """
+        if not os.path.isdir(self.archive_base):
+            return []
+        return [name for name in os.listdir(self.archive_base)
+                if not name.startswith('.') and
+                os.path.isdir(os.path.join(self.archive_base, name))]
+
+    def runs(self):
+        """
+        The names of the indexed runs. Call update() first to see new ones.
+        """
+        return [run for (run,) in self.db.execute(
+            "SELECT run FROM runs ORDER BY run")]
+
+    def jobs(self, run_name, status=None, update=True):
+        """
+        The jobs of a run, as dicts with run, job_id and self.fields, in job
+        id order.
+
+        :param status: Only return jobs with this status: 'pass', 'fail' or
+                       'running'
+        :param update: Bring the run's index up to date first
+        """
+        if update:
+            self.update_run(run_name)
+        query = "SELECT run, job_id, {fields} FROM jobs WHERE run = ?".format(
+            fields=', '.join(self.fields))
+        params = [run_name]
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY CAST(job_id AS INTEGER)"
+        keys = ('run', 'job_id') + self.fields
+        return [dict(zip(keys, row)) for row in self.db.execute(query, params)]
+
+    def verify(self):
+        """
+        Compare the index with the archive, without changing either.
+
+        :returns: A list of (run, job_id, field, indexed, actual) tuples, one
+                  for every difference found. job_id and field are None for
+                  runs missing from the index or the archive.
+        """
+        problems = []
+        run_names = self.list_runs()
+        indexed_runs = set(self.runs())
+        for run_name in indexed_runs.difference(run_names):
+            problems.append((run_name, None, None, True, False))
+        for run_name in run_names:
+            if run_name not in indexed_runs:
+                problems.append((run_name, None, None, False, True))
+                continue
+            run_dir = os.path.join(self.archive_base, run_name)
+            job_ids = set(name for name in os.listdir(run_dir)
+                          if is_job_dir(run_dir, name))
+            indexed = dict((job['job_id'], job) for job in
+                           self.jobs(run_name, update=False))
+            for job_id in sorted(set(indexed).union(job_ids)):
+                if job_id not in job_ids:
+                    problems.append((run_name, job_id, None, True, False))
+                    continue
+                if job_id not in indexed:
+                    problems.append((run_name, job_id, None, False, True))
+                    continue
+                actual = self.read_job(run_name, job_id)
+                for field in self.fields:
+                    if indexed[job_id][field] != actual[field]:
+                        problems.append((run_name, job_id, field,
+                                         indexed[job_id][field],
+                                         actual[field]))
+        return problems
+
+
+def open_index(archive_base=None):
+    """
+    Open the ArchiveIndex of archive_base, or return None if that isn't
+    possible, e.g. because the archive isn't writable; callers then read the
+    archive directly.
+    """
+    try:
+        return ArchiveIndex(archive_base)
+    except sqlite3.Error:
+        log.warning("Could not open the archive index of %s",
+                    archive_base or config.archive_base, exc_info=True)
+        return None
+
+
+def split_run_dir(run_dir):
+    """
+    Split the path to a run into the archive base and the run name.
+    """
+    run_dir = os.path.abspath(run_dir).rstrip('/')
+    return os.path.dirname(run_dir), os.path.basename(run_dir)
+
+
+def run_jobs(run_dir, status=None):
+    """
+    The jobs of the run in run_dir, as ArchiveIndex.jobs() returns them. If
+    the index can't be used, the jobs' YAML files are read directly.
+    """
+    archive_base, run_name = split_run_dir(run_dir)
+    index = open_index(archive_base)
+    if index is not None:
+        try:
+            return index.jobs(run_name, status=status)
+        except (sqlite3.Error, OSError):
+            log.warning("Could not use the archive index of %s",
+                        archive_base, exc_info=True)
+        finally:
+            index.close()
+
+    jobs = []
+    job_ids = [name for name in os.listdir(run_dir)
+               if is_job_dir(run_dir, name)]
+    for job_id in sorted(job_ids, key=int):
+        job = read_job(os.path.join(run_dir, job_id))
+        if status is not None and job['status'] != status:
+            continue
+        job.update(run=run_name, job_id=job_id)
+        jobs.append(job)
+    return jobs
+
+
+def try_index_job(job_dir):
+    """
+    Re-index a job after its summary.yaml was written, ignoring any error:
+    the next listing of the run notices the change anyway.
+    """
+    run_dir, job_id = os.path.split(os.path.abspath(job_dir).rstrip('/'))
+    archive_base, run_name = split_run_dir(run_dir)
+    try:
+        index = ArchiveIndex(archive_base)
+        try:
+            index.update_job(run_name, job_id)
+        finally:
+            index.close()
+    except (sqlite3.Error, OSError):
+        log.debug("Could not index %s", job_dir, exc_info=True)
+
+
+def main(args):
+    if args['--verbose']:
+        teuthology.log.setLevel(logging.DEBUG)
+    archive_base = os.path.abspath(os.path.expanduser(args['--archive']))
+
+    index = ArchiveIndex(archive_base)
+    try:
+        if args['--verify']:
+            problems = index.verify()
+            for run_name, job_id, field, indexed, actual in problems:
+                if job_id is None:
+                    print '{run}: indexed={indexed} exists={actual}'.format(
+                        run=run_name, indexed=indexed, actual=actual)
+                elif field is None:
+                    print '{run}/{job}: indexed={indexed} exists={actual}'\
+                        .format(run=run_name, job=job_id, indexed=indexed,
+                                actual=actual)
+                else:
+                    print '{run}/{job} {field}: indexed={indexed!r} ' \
+                        'actual={actual!r}'.format(
+                            run=run_name, job=job_id, field=field,
+                            indexed=indexed, actual=actual)
+            if problems:
+                sys.exit(1)
+        elif args['--rebuild']:
+            index.rebuild()
+        else:
+            index.update()
+    finally:
+        index.close()
@@ -1,6 +1,8 @@
 import beanstalkc
 import yaml
 import logging
+import os
+import sqlite3
 import sys
 from collections import OrderedDict
 
@@ -17,7 +19,45 @@ def connect():
         raise RuntimeError(
             'Beanstalk queue information not found in {conf_path}'.format(
                 conf_path=config.teuthology_yaml))
-    return beanstalkc.Connection(host=host, port=port)
+    return Connection(host=host, port=port)
+
+
+class Connection(beanstalkc.Connection):
+    """
+    A beanstalkc.Connection that can put several jobs in one round trip.
+
+    beanstalkc has no public way to pipeline commands, so put_many() writes
+    to its socket and reads its replies through the private _socket and
+    _read_response. It only does so for the beanstalkc versions listed in
+    PIPELINE_VERSIONS, which are known to have them; with any other version
+    it puts the jobs one at a time with put().
+    """
+    PIPELINE_VERSIONS = ('0.3.0', '0.4.0')
+
+    def can_pipeline(self):
+        return getattr(beanstalkc, '__version__', None) in \
+            self.PIPELINE_VERSIONS
+
+    def put_many(self, bodies, priority, ttr):
+        """
+        :returns: A list of the new job ids, in the same order as bodies
+        """
+        if not self.can_pipeline():
+            return [self.put(body, priority=priority, ttr=ttr)
+                    for body in bodies]
+        command = ''.join(
+            'put %d %d %d %d\r\n%s\r\n' % (priority, 0, ttr, len(body), body)
+            for body in bodies)
+        beanstalkc.SocketError.wrap(self._socket.sendall, command)
+        jids = []
+        for body in bodies:
+            status, results = self._read_response()
+            if status in ('JOB_TOO_BIG', 'BURIED', 'DRAINING'):
+                raise beanstalkc.CommandFailed('put', status, results)
+            elif status != 'INSERTED':
+                raise beanstalkc.UnexpectedResponse('put', status, results)
+            jids.append(int(results[0]))
+        return jids
 
 
 def watch_tube(connection, tube_name):
@@ -25,31 +65,268 @@ def watch_tube(connection, tube_name):
     connection.ignore('default')
 
 
+def put_jobs(connection, bodies, priority, ttr=60 * 60 * 24):
+    """
+    Put several jobs into the tube currently in use, with a single round
+    trip to beanstalkd where the connection supports it (see `Connection`).
+
+    :param connection: A beanstalkc.Connection, as returned by connect()
+    :param bodies:     A list of job bodies (str)
+    :param priority:   The beanstalk priority of every job
+    :param ttr:        The time-to-run of every job, in seconds
+    :returns:          A list of the new job ids, in the same order as bodies
+    """
+    if isinstance(connection, Connection):
+        return connection.put_many(bodies, priority, ttr)
+    return [connection.put(body, priority=priority, ttr=ttr)
+            for body in bodies]
+
+
+class QueueIndex(object):
+    """
+    A local SQLite index of the jobs in the beanstalk queue, so that tubes can
+    be listed and filtered without reserving every job in them.
+
+    Jobs are added when they are scheduled. reconcile() checks the index
+    against beanstalkd with non-destructive commands only: stats-job for the
+    jobs it is asked about, plus stats-job and peek for jobs that were queued
+    since the tube was last reconciled.
+    """
+    # how many job ids in a row must be missing before we decide there are
+    # no newer jobs; see newest_job_id()
+    max_id_gap = 20
+    # the states of the jobs that are indexed; reserved and buried jobs are
+    # being run by workers
+    indexed_states = ('ready', 'delayed')
+    # how many job ids a tube's first scan walks between checking how many
+    # of its jobs were deleted meanwhile
+    recount_interval = 100
+
+    def __init__(self, path=None):
+        self.path = path or config.queue_index or os.path.join(
+            os.path.expanduser('~'), '.teuthology-queue.sqlite')
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id INTEGER PRIMARY KEY,
+                tube TEXT NOT NULL,
+                name TEXT,
+                priority INTEGER,
+                description TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_tube_name ON jobs (tube, name);
+            CREATE TABLE IF NOT EXISTS tubes (
+                tube TEXT PRIMARY KEY,
+                scanned_through INTEGER NOT NULL
+            );
+        """)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, job_id, tube, job_config, priority):
+        self.add_many([(job_id, tube, job_config, priority)])
+
+    def add_many(self, jobs):
+        """
+        :param jobs: A list of (job_id, tube, job_config, priority) tuples
+        """
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)",
+                [(int(job_id), tube, job_config.get('name'), priority,
+                  job_config.get('description'))
+                 for job_id, tube, job_config, priority in jobs])
+
+    def remove(self, job_ids):
+        with self.db:
+            self.db.executemany("DELETE FROM jobs WHERE job_id = ?",
+                                [(int(job_id),) for job_id in job_ids])
+
+    def jobs(self, tube, pattern=None, name=None):
+        """
+        The indexed jobs of a tube, as dicts, in job id order.
+
+        :param pattern: Only return jobs with this in their name
+        :param name:    Only return jobs with exactly this name
+        """
+        query = "SELECT job_id, name, priority, description FROM jobs " + \
+            "WHERE tube = ?"
+        params = [tube]
+        if name is not None:
+            query += " AND name = ?"
+            params.append(name)
+        if pattern is not None:
+            query += " AND instr(name, ?) > 0"
+            params.append(pattern)
+        query += " ORDER BY job_id"
+        return [dict(job_id=row[0], name=row[1], priority=row[2],
+                     description=row[3])
+                for row in self.db.execute(query, params)]
+
+    def newest_job_id(self, connection):
+        """
+        The id of the newest job in beanstalkd, as far as we can tell.
+
+        beanstalkd doesn't report it. Its 'total-jobs' count starts again
+        from 0 when beanstalkd restarts, while job ids carry on from its
+        binlog. So we start from the highest of that count and the ids we
+        have already seen, and look past it until max_id_gap ids in a row
+        don't exist.
+        """
+        newest = max(
+            connection.stats()['total-jobs'],
+            self.db.execute("SELECT max(job_id) FROM jobs").fetchone()[0],
+            self.db.execute(
+                "SELECT max(scanned_through) FROM tubes").fetchone()[0],
+            )
+        job_id = newest + 1
+        while job_id - newest <= self.max_id_gap:
+            try:
+                connection.stats_job(job_id)
+                newest = job_id
+            except beanstalkc.CommandFailed:
+                pass
+            job_id += 1
+        return newest
+
+    def scan_new_jobs(self, connection, tube):
+        """
+        Index the ready and delayed jobs that were put into a tube since it
+        was last scanned, without reserving them.
+
+        The first time a tube is scanned, it is walked backwards from the
+        newest job id until every job beanstalkd reports for the tube, in
+        any state, has been seen - less those deleted during the walk.
+        """
+        newest = self.newest_job_id(connection)
+        row = self.db.execute(
+            "SELECT scanned_through FROM tubes WHERE tube = ?",
+            (tube,)).fetchone()
+        if row is None:
+            found = self._scan_tube(connection, tube, newest)
+        else:
+            known = set(job['job_id'] for job in self.jobs(tube))
+            found = []
+            for job_id in xrange(row[0] + 1, newest + 1):
+                if job_id in known:
+                    continue
+                job = self._index_entry(connection, tube, job_id)
+                if job:
+                    found.append(job)
+        self.add_many(found)
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO tubes VALUES (?, ?)",
+                            (tube, newest))
+
+    def _tube_counts(self, connection, tube):
+        """
+        :returns: (the number of jobs in the tube, how many of its jobs were
+                  ever deleted), or None if the tube doesn't exist
+        """
+        try:
+            stats = connection.stats_tube(tube)
+        except beanstalkc.CommandFailed:
+            return None
+        return (sum(stats['current-jobs-' + state] for state in
+                    ('ready', 'delayed', 'reserved', 'buried')),
+                stats['cmd-delete'])
+
+    def _scan_tube(self, connection, tube, newest):
+        """
+        Walk a tube backwards from job id newest; see scan_new_jobs().
+
+        :returns: The jobs to index, as for add_many()
+        """
+        counts = self._tube_counts(connection, tube)
+        if counts is None:
+            # the tube doesn't exist (yet)
+            return []
+        total, deleted_before = counts
+        deleted = 0
+        seen = 0
+        found = []
+        for walked, job_id in enumerate(xrange(newest, 0, -1)):
+            if walked and walked % self.recount_interval == 0:
+                counts = self._tube_counts(connection, tube)
+                if counts is None:
+                    break
+                # jobs deleted since we started won't be found
+                deleted = counts[1] - deleted_before
+            if seen >= total - deleted:
+                break
+            job = self._index_entry(connection, tube, job_id)
+            if job is None:
+                continue
+            seen += 1
+            if job:
+                found.append(job)
+        return found
+
+    def _index_entry(self, connection, tube, job_id):
+        """
+        :returns: None if there is no such job in tube. Otherwise the job's
+                  (job_id, tube, job_config, priority) tuple if it should be
+                  indexed, or an empty tuple if it shouldn't.
+        """
+        try:
+            stats = connection.stats_job(job_id)
+        except beanstalkc.CommandFailed:
+            return None
+        if stats['tube'] != tube:
+            return None
+        if stats['state'] not in self.indexed_states:
+            return ()
+        job = connection.peek(job_id)
+        if job is None or job.body is None:
+            return ()
+        return (job_id, tube, yaml.safe_load(job.body), stats['pri'])
+
+    def reconcile(self, connection, tube, pattern=None, name=None):
+        """
+        Bring the index up to date and return the tube's ready jobs whose
+        names match, as jobs() does. Only the matching jobs and the newly
+        queued ones cost a round trip each.
+        """
+        self.scan_new_jobs(connection, tube)
+        ready = []
+        gone = []
+        for job in self.jobs(tube, pattern=pattern, name=name):
+            try:
+                stats = connection.stats_job(job['job_id'])
+            except beanstalkc.CommandFailed:
+                gone.append(job['job_id'])
+                continue
+            if stats['state'] in ('ready', 'delayed'):
+                job['priority'] = stats['pri']
+                ready.append(job)
+        self.remove(gone)
+        return ready
+
+
 def walk_jobs(connection, tube_name, processor, pattern=None):
     """
-    def callback(jobs_dict)
+    Feed the ready jobs of a tube whose names contain pattern to a
+    JobProcessor, using the QueueIndex.
     """
     log.info("Checking Beanstalk Queue...")
-    job_count = connection.stats_tube(tube_name)['current-jobs-ready']
-    if job_count == 0:
-        log.info('No jobs in Beanstalk Queue')
-        return
-
-    # Try to figure out a sane timeout based on how many jobs are in the queue
-    timeout = job_count / 2000.0 * 60
-    for i in range(1, job_count + 1):
-        print_progress(i, job_count, "Loading")
-        job = connection.reserve(timeout=timeout)
-        if job is None or job.body is None:
-            continue
-        job_config = yaml.safe_load(job.body)
-        job_name = job_config['name']
-        job_id = job.stats()['id']
-        if pattern is not None and pattern not in job_name:
-            continue
-        processor.add_job(job_id, job_config, job)
-    end_progress()
-    processor.complete()
+    index = QueueIndex()
+    try:
+        jobs = index.reconcile(connection, tube_name, pattern=pattern)
+        if not jobs:
+            log.info('No jobs in Beanstalk Queue')
+            return
+        for job in jobs:
+            job_obj = beanstalkc.Job(connection, job['job_id'], None,
+                                     reserved=False)
+            job_config = dict(name=job['name'],
+                              description=job['description'],
+                              priority=job['priority'])
+            processor.add_job(job['job_id'], job_config, job_obj)
+        processor.complete()
+        index.remove(processor.deleted)
+    finally:
+        index.close()
 
 
 def print_progress(index, total, message=None):
@@ -67,6 +344,8 @@ def end_progress():
 class JobProcessor(object):
     def __init__(self):
         self.jobs = OrderedDict()
+        # ids of the jobs that were deleted from the queue
+        self.deleted = []
 
     def add_job(self, job_id, job_config, job_obj=None):
         job_id = str(job_id)
@@ -130,7 +409,14 @@ class JobDeleter(JobProcessor):
             )
         job_obj = self.jobs[job_id].get('job_obj')
         if job_obj:
-            job_obj.delete()
+            try:
+                job_obj.delete()
+            except beanstalkc.CommandFailed:
+                # a worker reserved it since the queue was listed
+                log.warning("Job %s was taken by a worker; not deleting it",
+                            job_id)
+                return
+            self.deleted.append(job_id)
         report.try_delete_jobs(job_name, job_id)
 
 
@@ -144,7 +430,7 @@ def main(args):
         watch_tube(connection, machine_type)
         if delete:
             walk_jobs(connection, machine_type,
-                      JobDeleter())
+                      JobDeleter(), pattern=delete)
         elif runs:
             walk_jobs(connection, machine_type,
                       RunPrinter())
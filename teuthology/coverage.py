@@ -4,9 +4,9 @@ import os
 import shutil
 import subprocess
 import MySQLdb
-import yaml
 
 import teuthology
+from teuthology import archive
 from teuthology.misc import read_config
 
 log = logging.getLogger(__name__)
@@ -108,25 +108,22 @@ def main(args):
 
 
 def analyze(args):
-    tests = [
-        f for f in sorted(os.listdir(args.test_dir))
-        if not f.startswith('.')
-        and os.path.isdir(os.path.join(args.test_dir, f))
-        and os.path.exists(os.path.join(args.test_dir, f, 'summary.yaml'))
-        and os.path.exists(os.path.join(args.test_dir, f, 'ceph-sha1'))]
+    tests = []
+    for job in archive.run_jobs(args.test_dir):
+        test = job['job_id']
+        if job['status'] == 'running' or not os.path.exists(
+                os.path.join(args.test_dir, test, 'ceph-sha1')):
+            continue
+        if job['flavor'] != 'gcov':
+            log.debug('Skipping %s, since it does not include coverage', test)
+            continue
+        tests.append(test)
+    tests.sort()
 
     test_summaries = {}
     for test in tests:
-        summary = {}
-        with file(os.path.join(args.test_dir, test, 'summary.yaml')) as f:
-            g = yaml.safe_load_all(f)
-            for new in g:
-                summary.update(new)
-
-        if summary['flavor'] != 'gcov':
-            log.debug('Skipping %s, since it does not include coverage', test)
-            continue
-        test_summaries[test] = summary
+        test_summaries[test] = archive.load_yaml(
+            os.path.join(args.test_dir, test, 'summary.yaml'))
 
     assert len(test_summaries) > 0
 
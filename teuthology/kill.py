@@ -1,16 +1,17 @@
 #!/usr/bin/python
 import os
 import sys
-import beanstalkc
 import yaml
+import beanstalkc
 import psutil
 import subprocess
 import tempfile
 import logging
 import getpass
 
+from . import archive
+from . import beanstalk
 from . import report
-from .config import config
 
 log = logging.getLogger(__name__)
 
@@ -71,17 +72,12 @@ def find_run_info(run_archive_dir):
     ]
 
     run_info = dict(pids=[])
-    job_info = {}
-    for job_id in os.listdir(run_archive_dir):
-        job_dir = os.path.join(run_archive_dir, job_id)
-        if not os.path.isdir(job_dir):
-            continue
-        job_info = find_job_info(job_dir)
-        for key in job_info.keys():
-            if key in run_info_fields and key not in run_info:
-                run_info[key] = job_info[key]
-        if 'pid' in job_info:
-            run_info['pids'].append(job_info['pid'])
+    for job in archive.run_jobs(run_archive_dir):
+        for key in run_info_fields:
+            if job[key] is not None and key not in run_info:
+                run_info[key] = job[key]
+        if job['pid'] is not None:
+            run_info['pids'].append(job['pid'])
     return run_info
 
 
@@ -113,39 +109,34 @@ def remove_paddles_jobs(run_name):
 
 
 def remove_beanstalk_jobs(run_name, tube_name):
-    qhost = config.queue_host
-    qport = config.queue_port
-    if qhost is None or qport is None:
-        raise RuntimeError(
-            'Beanstalk queue information not found in {conf_path}'.format(
-                conf_path=config.teuthology_yaml))
     log.info("Checking Beanstalk Queue...")
-    beanstalk = beanstalkc.Connection(host=qhost, port=qport)
-    beanstalk.watch(tube_name)
-    beanstalk.ignore('default')
-
-    curjobs = beanstalk.stats_tube(tube_name)['current-jobs-ready']
-    if curjobs != 0:
-        x = 1
-        while x != curjobs:
-            x += 1
-            job = beanstalk.reserve(timeout=20)
-            if job is None:
+    connection = beanstalk.connect()
+    index = beanstalk.QueueIndex()
+    try:
+        jobs = index.reconcile(connection, tube_name, name=run_name)
+        if not jobs:
+            print "No jobs in Beanstalk Queue"
+        deleted = []
+        for job in jobs:
+            msg = "Deleting job from queue. ID: " + \
+                "{id} Name: {name} Desc: {desc}".format(
+                    id=str(job['job_id']),
+                    name=job['name'],
+                    desc=job['description'],
+                )
+            log.info(msg)
+            try:
+                connection.delete(job['job_id'])
+            except beanstalkc.CommandFailed:
+                # a worker reserved it since the queue was listed
+                log.warning("Job %s was taken by a worker; not deleting it",
+                            job['job_id'])
                 continue
-            job_config = yaml.safe_load(job.body)
-            if run_name == job_config['name']:
-                job_id = job.stats()['id']
-                msg = "Deleting job from queue. ID: " + \
-                    "{id} Name: {name} Desc: {desc}".format(
-                        id=str(job_id),
-                        name=job_config['name'],
-                        desc=job_config['description'],
-                    )
-                log.info(msg)
-                job.delete()
-    else:
-        print "No jobs in Beanstalk Queue"
-    beanstalk.close()
+            deleted.append(job['job_id'])
+        index.remove(deleted)
+    finally:
+        index.close()
+        connection.close()
 
 
 def kill_processes(run_name, pids=None):
@@ -40,14 +40,7 @@ def lock_many(ctx, num, machinetype, user=None, description=None):
             log.debug('locked {machines}'.format(
                 machines=', '.join(machines.keys())))
             if machinetype == 'vps':
-                ok_machs = {}
-                for machine in machines:
-                    if create_if_vm(ctx, machine):
-                        ok_machs[machine] = machines[machine]
-                    else:
-                        log.error('Unable to create virtual machine: %s' % machine)
-                        unlock_one(ctx, machine)
-                return ok_machs
+                return create_vms(ctx, machines)
             return machines
         if status == 503:
             log.error('Insufficient nodes available to lock %d %s nodes.', num,machinetype)
@@ -56,6 +49,68 @@ def lock_many(ctx, num, machinetype, user=None, description=None):
     return []
 
 
+def create_vms(ctx, machines):
+    """
+    Create the virtual machines that were just locked, unlocking any that
+    could not be created.
+
+    :returns: The machines that were created, as a dict of name to key
+    """
+    ok_machs = {}
+    for machine in machines:
+        if create_if_vm(ctx, machine):
+            ok_machs[machine] = machines[machine]
+        else:
+            log.error('Unable to create virtual machine: %s' % machine)
+            unlock_one(ctx, machine)
+    return ok_machs
+
+
+def reserve_many(ctx, num, machinetype, user=None, description=None,
+                 min_free=0, priority=1000, timeout=20):
+    """
+    Wait in the lock server's reservation queue until num machines of
+    machinetype have been locked for us. The server hands machines out in
+    priority and then arrival order as soon as they are free, so there is
+    no need to poll the whole machine table.
+
+    :param min_free: Only lock once at least this many machines are free
+    :param timeout:  How long each request may wait on the server, which
+                     caps it at 30 seconds
+    :returns:        The locked machines, as a dict of name to ssh public
+                     key, or None if the lock server has no reservation queue
+    """
+    if user is None:
+        user = misc.get_user()
+    params = dict(user=user, num=num, machinetype=machinetype,
+                  desc=description, min_free=min_free, priority=priority,
+                  timeout=timeout)
+    while True:
+        success, content, status = ls.send_request(
+            'POST',
+            config.lock_server + '/reserve',
+            urllib.urlencode(params))
+        if not success:
+            if status in (404, 405):
+                log.info('The lock server has no reservation queue')
+                return None
+            assert status != 400, 'not enough machines are up'
+            log.warn('Reservation request failed, trying again')
+            time.sleep(10)
+            continue
+        result = json.loads(content)
+        params['ticket'] = result['ticket']
+        machines = result['machines']
+        if machines:
+            log.debug('locked {machines}'.format(
+                machines=', '.join(machines.keys())))
+            if result['type'] == 'vps':
+                return create_vms(ctx, machines)
+            return machines
+        log.info('waiting for %d %s machines (%s requests ahead)...', num,
+                 machinetype, result['position'])
+
+
 def lock_one(ctx, name, user=None, description=None):
     if user is None:
         user = misc.get_user()
@@ -91,11 +146,71 @@ def unlock_one(ctx, name, user=None):
     return success
 
 
-def list_locks():
-    success, content, _ = ls.send_request('GET', config.lock_server)
-    if success:
-        return json.loads(content)
-    return None
+def list_locks(machine_type=None, up=None, locked=None, owner=None,
+               description=None, desc_pattern=None, fields=None):
+    """
+    List machines from the lock server. The filters are applied by the lock
+    server, and again here in case it is too old to know them.
+
+    :param machine_type: A machine type, or several separated by commas
+    :param up:           If not None, only machines that are (not) up
+    :param locked:       If not None, only machines that are (not) locked
+    :param owner:        Only machines locked by this user
+    :param description:  Only machines with exactly this description
+    :param desc_pattern: Only machines whose description contains this
+    :param fields:       Only return these fields (and 'name') of each machine,
+                         plus those that the filters need
+    :returns:            A list of dicts, or None on error
+    """
+    if fields is not None:
+        fields = list(fields)
+        for value, field in ((machine_type, 'type'), (up, 'up'),
+                             (locked, 'locked'), (owner, 'locked_by'),
+                             (description, 'description'),
+                             (desc_pattern, 'description')):
+            if value is not None and field not in fields:
+                fields.append(field)
+    params = []
+    if machine_type is not None:
+        machine_types = misc.get_multi_machine_types(machine_type)
+        params.append(('type', ','.join(machine_types)))
+    if up is not None:
+        params.append(('up', 'true' if up else 'false'))
+    if locked is not None:
+        params.append(('locked', 'true' if locked else 'false'))
+    if owner is not None:
+        params.append(('owner', owner))
+    if description is not None:
+        params.append(('desc', description))
+    if desc_pattern is not None:
+        params.append(('desc_pattern', desc_pattern))
+    if fields is not None:
+        params.append(('fields', ','.join(fields)))
+    url = config.lock_server
+    if params:
+        url += '?' + urllib.urlencode(params)
+
+    success, content, status = ls.get_cached(url)
+    if not success:
+        # a filtered listing with no matches
+        if status == 404 and params:
+            return []
+        return None
+    statuses = json.loads(content)
+    if machine_type is not None:
+        statuses = [s for s in statuses if s['type'] in machine_types]
+    if up is not None:
+        statuses = [s for s in statuses if bool(s['up']) == up]
+    if locked is not None:
+        statuses = [s for s in statuses if bool(s['locked']) == locked]
+    if owner is not None:
+        statuses = [s for s in statuses if s['locked_by'] == owner]
+    if description is not None:
+        statuses = [s for s in statuses if s['description'] == description]
+    if desc_pattern is not None:
+        statuses = [s for s in statuses if s['description'] is not None and
+                    desc_pattern in s['description']]
+    return statuses
 
 
 def update_lock(ctx, name, description=None, status=None, sshpubkey=None):
@@ -178,16 +293,28 @@ def main(ctx):
         assert ctx.desc is None, '--desc does nothing with --list/--brief'
 
         if machines:
+            known = ls.get_statuses(ctx, machines) or {}
             statuses = []
             for machine in machines:
-                status = ls.get_status(ctx, machine)
-                if status:
-                    statuses.append(status)
+                if machine in known:
+                    statuses.append(known[machine])
                 else:
                     log.error("Lockserver doesn't know about machine: %s" %
                               machine)
         else:
-            statuses = list_locks()
+            if ctx.owner is None and not ctx.all:
+                ctx.owner = misc.get_user()
+            filters = dict(
+                machine_type=ctx.machine_type,
+                owner=ctx.owner,
+                description=ctx.desc,
+                desc_pattern=ctx.desc_pattern,
+            )
+            if ctx.status is not None:
+                filters['up'] = ctx.status == 'up'
+            if ctx.locked is not None:
+                filters['locked'] = ctx.locked == 'true'
+            statuses = list_locks(**filters)
         vmachines = []
 
         for vmachine in statuses:
@@ -199,10 +326,10 @@ def main(ctx):
             # Listing specific machines will update the keys.
             if machines:
                 scan_for_locks(ctx, vmachines)
-                statuses = [ls.get_status(ctx, machine)
-                            for machine in machines]
+                known = ls.get_statuses(ctx, machines) or {}
+                statuses = [known.get(machine) for machine in machines]
             else:
-                statuses = list_locks()
+                statuses = list_locks(**filters)
         if statuses:
             if ctx.machine_type:
                 statuses = [_status for _status in statuses
@@ -337,7 +464,7 @@ def updatekeys(ctx):
 
 
 def keyscan_check(ctx, machines):
-    locks = list_locks()
+    locks = list_locks(fields=['sshpubkey'])
     current_locks = {}
     for lock in locks:
         current_locks[lock['name']] = lock
@@ -382,7 +509,7 @@ def scan_for_locks(ctx, machines):
 
 def do_summary(ctx):
     lockd = collections.defaultdict(lambda: [0, 0, 'unknown'])
-    for l in list_locks():
+    for l in list_locks(machine_type=ctx.machine_type):
         if ctx.machine_type and l['type'] != ctx.machine_type:
             continue
         who = l['locked_by'] if l['locked'] == 1 else '(free)', l['type']
@@ -1,4 +1,8 @@
+import hashlib
 import json
+import re
+import threading
+import time
 import web
 import subprocess
 
@@ -15,38 +19,223 @@ def load_machine(name):
         raise web.NotFound()
     return results[0]
 
-def get_sshkey(name):
-    if '@' in name:
-        _, name = name.rsplit('@')
-    args = ['ssh-keyscan']
-    args.append(name)
+def get_sshkeys(names):
+    """
+    Scan the ssh host keys of several machines with a single ssh-keyscan,
+    which queries them all in parallel.
+
+    :returns: A dict of machine name to host key, for the machines that
+              answered.
+    """
+    hosts = {}
+    for name in names:
+        host = name.rsplit('@')[-1]
+        hosts[host] = name
+    args = ['ssh-keyscan', '-T', '5']
+    args.extend(sorted(hosts))
     p = subprocess.Popen(
         args=args,
         stdout=subprocess.PIPE,
         )
     out, _ = p.communicate()
-    pubkey = None
+    keys = {}
     for key_entry in out.splitlines():
+        if key_entry.startswith('#') or ' ' not in key_entry:
+            continue
         hostname, pubkey = key_entry.split(' ', 1)
-    if not pubkey:
-        status = 1
-    else:
-        status = 0
-    return (pubkey), status
-
-def update_sshkey(name, key, type):
-    if type == 'vps':
-        return
-    res = DB.update('machine', where='name = $name AND locked = false',
-                    vars=dict(name=name),
-                    sshpubkey=key,)
-    assert res == 1, 'Failed to update key of machine {name}'.format(name=name)
-    print 'Updated key on ', name
+        if hostname in hosts:
+            keys[hosts[hostname]] = pubkey
+    return keys
+
+def sshpubkey_ages(rows):
+    """
+    Replace the sshpubkey_scanned column of machine rows with sshpubkey_age:
+    the seconds since the key was last scanned, or None if it hasn't been
+    since the machine was last unlocked.
+    """
+    now = DB.query('SELECT NOW() AS now')[0].now
+    for row in rows:
+        scanned = row.pop('sshpubkey_scanned', None)
+        if scanned is None:
+            row.sshpubkey_age = None
+        else:
+            row.sshpubkey_age = int((now - scanned).total_seconds())
+
+class KeyScanner(threading.Thread):
+    """
+    Keeps the host keys in the machine table fresh in the background, so that
+    locking machines never waits on ssh-keyscan.
+
+    Only one server process scans: the one whose scanner holds the database
+    lock lock_name. When each key was last scanned is kept in the machine's
+    sshpubkey_scanned column. Unlocked machines that weren't scanned within
+    interval seconds are scanned again; unlocking a machine - possibly after
+    it was reimaged - clears the column, so it is scanned within
+    poll_interval seconds. Keys are only replaced on unlocked machines. Those
+    that are locked again before being scanned are fixed by refresh_locked(),
+    once they are locked.
+    """
+    interval = 300
+    poll_interval = 5
+    lock_name = 'teuthology_key_scanner'
+
+    def __init__(self):
+        super(KeyScanner, self).__init__(name='KeyScanner')
+        self.daemon = True
+        # name -> time.time() of the last scan that got no key
+        self.failed = {}
+
+    def elected(self):
+        """
+        Whether this process is the one that scans. The lock is held by this
+        thread's database connection, and released if it is closed.
+        """
+        return DB.query('SELECT GET_LOCK($name, 0) AS got',
+                        vars=dict(name=self.lock_name))[0].got == 1
+
+    def run(self):
+        while True:
+            try:
+                if self.elected():
+                    self.scan_due()
+                else:
+                    self.failed.clear()
+            except Exception:
+                log.exception("Key scan failed")
+            time.sleep(self.poll_interval)
+
+    def scan_due(self):
+        """
+        Scan the unlocked machines whose keys are older than interval, or
+        weren't scanned since they were unlocked. Machines that didn't answer
+        are only tried again after interval.
+        """
+        now = time.time()
+        where = "type != 'vps' AND locked = false AND " + \
+            "(sshpubkey_scanned IS NULL OR " + \
+            "sshpubkey_scanned < NOW() - INTERVAL {secs} SECOND)".format(
+                secs=self.interval)
+        names = [row.name for row in DB.select('machine', what='name',
+                                                where=where)
+                 if self.failed.get(row.name, 0) < now - self.interval]
+        if not names:
+            return
+        keys = self.scan(names)
+        for name in names:
+            if name in keys:
+                self.failed.pop(name, None)
+            else:
+                self.failed[name] = now
+
+    def scan(self, names):
+        """
+        Scan the keys of machines, and store them on those that are still
+        unlocked.
+
+        :returns: A dict of machine name to host key, for the machines that
+                  answered
+        """
+        keys = get_sshkeys(names)
+        if not keys:
+            return keys
+        current = dict(
+            (row.name, row.sshpubkey) for row in
+            DB.select('machine', what='name, sshpubkey',
+                      where=web.db.sqlors('name = ', keys.keys())))
+        unchanged = []
+        for name, key in keys.iteritems():
+            if current.get(name) == key:
+                unchanged.append(name)
+                continue
+            res = DB.update('machine', where='name = $name AND locked = false',
+                            vars=dict(name=name), sshpubkey=key,
+                            sshpubkey_scanned=web.db.SQLLiteral('NOW()'))
+            if res == 1:
+                print 'Updated key on ', name
+        if unchanged:
+            DB.update('machine',
+                      where=web.db.sqlors('name = ', unchanged) +
+                      ' AND locked = false',
+                      sshpubkey_scanned=web.db.SQLLiteral('NOW()'))
+        return keys
+
+    def refresh_locked(self, name_keys):
+        """
+        Scan those of the machines that were just locked whose keys weren't
+        scanned since they were last unlocked, and store their new keys.
+        Must be called once the lock is committed, not inside its
+        transaction.
+
+        :param name_keys: A dict of machine name to the key it was locked
+                          with, which is updated
+        """
+        if not name_keys:
+            return
+        stale = [row.name for row in
+                 DB.select('machine', what='name',
+                           where=web.db.sqlors('name = ', name_keys.keys()) +
+                           " AND type != 'vps' AND sshpubkey_scanned IS NULL")]
+        if not stale:
+            return
+        for name, key in get_sshkeys(stale).iteritems():
+            DB.update('machine', where='name = $name', vars=dict(name=name),
+                      sshpubkey=key,
+                      sshpubkey_scanned=web.db.SQLLiteral('NOW()'))
+            name_keys[name] = key
+
+key_scanner = KeyScanner()
+
+def lock_free_machines(user, desc, num, machinetype):
+    """
+    Lock num free machines of a type. Must be called inside a transaction.
+
+    :returns: A dict of machine name to ssh public key, or None if not enough
+              machines are free.
+    """
+    # the keys are kept fresh by key_scanner; prefer the machines it has
+    # scanned since they were unlocked, and leave the others to
+    # key_scanner.refresh_locked()
+    results = list(DB.select('machine', dict(machinetype=machinetype),
+                             what='name, sshpubkey',
+                             where='locked = false AND up = true AND type = $machinetype',
+                             order='sshpubkey_scanned IS NULL',
+                             limit=num))
+    if len(results) < num:
+        return None
+    name_keys = {}
+    for row in results:
+        name_keys[row.name] = row.sshpubkey
+    where_cond = web.db.sqlors('name = ', name_keys.keys()) \
+        + ' AND locked = false AND up = true'
+    num_locked = DB.update('machine',
+                           where=where_cond,
+                           locked=True,
+                           locked_by=user,
+                           description=desc,
+                           locked_since=web.db.SQLLiteral('NOW()'))
+    assert num_locked == num, 'Failed to lock machines'
+    return name_keys
+
+def count_machines(where, machinetype):
+    return DB.select('machine', dict(machinetype=machinetype),
+                     what='count(*) AS count',
+                     where=where + ' AND type = $machinetype')[0].count
+
+# Notified whenever machines may have been freed in this process, so that
+# reservations waiting here don't have to wait out their poll interval.
+# Machines freed through other server processes are noticed at the next
+# poll of the database.
+machines_freed = threading.Condition()
+
+def notify_machines_freed():
+    with machines_freed:
+        machines_freed.notify_all()
 
 class MachineLock:
     def GET(self, name):
         row = load_machine(name)
         row.locked_since = row.locked_since.isoformat()
+        sshpubkey_ages([row])
         web.header('Content-type', 'text/json')
         return json.dumps(row)
 
@@ -58,12 +247,17 @@ class MachineLock:
         if machine.locked_by != user:
             raise web.Forbidden()
 
+        # it may have been reimaged, so its key is stale
         res = DB.update('machine',
                         where='locked = true AND name = $name AND locked_by = $user',
                         vars=dict(name=name, user=user),
-                        locked=False, locked_by=None, description=None)
+                        locked=False, locked_by=None, description=None,
+                        sshpubkey_scanned=None)
         assert res == 1, 'Failed to unlock machine {name}'.format(name=name)
         print user, 'unlocked', name
+        if machine.type != 'vps':
+            key_scanner.scan([name])
+        notify_machines_freed()
 
     def POST(self, name):
         user = web.input('user')['user']
@@ -72,25 +266,15 @@ class MachineLock:
         if machine.locked:
             raise web.Forbidden()
 
-        if machine.type == 'vps':
-            curkey = machine.sshpubkey
-        else:
-            curkey, getstatus = get_sshkey(name)
-            if getstatus != 0:
-                curkey = machine.sshpubkey
-        if machine.sshpubkey != curkey:
-            newkey = curkey
-        else:
-            newkey = machine.sshpubkey
         res = DB.update('machine', where='name = $name AND locked = false',
                         vars=dict(name=name),
                         locked=True,
                         description=desc,
-                        sshpubkey=newkey,
                         locked_by=user,
                         locked_since=web.db.SQLLiteral('NOW()'))
         assert res == 1, 'Failed to lock machine {name}'.format(name=name)
         print user, 'locked single machine', name, 'desc', desc
+        key_scanner.refresh_locked({name: machine.sshpubkey})
 
     def PUT(self, name):
         desc = web.input(desc=None)['desc']
@@ -110,14 +294,78 @@ class MachineLock:
         DB.update('machine', where='name = $name',
                   vars=dict(name=name), **updated)
         print 'updated', name, 'with', updated, 'desc', desc
+        if updated.get('up'):
+            notify_machines_freed()
 
 class Lock:
     def GET(self):
-        rows = list(DB.select('machine', what='*'))
-        if not rows:
+        """
+        List machines, optionally filtered by the query parameters:
+
+            name:         a comma-separated list of machine names
+            type:         a comma-separated list of machine types
+            locked, up:   'true' or 'false'
+            owner:        who the machines are locked by
+            desc:         the exact description
+            desc_pattern: a substring of the description
+            fields:       a comma-separated list of the columns to return
+
+        The response has an ETag; a request whose If-None-Match matches it
+        gets a 304 Not Modified. sshpubkey_age doesn't count as a change.
+        """
+        params = web.input(name=None, type=None, locked=None, up=None,
+                           owner=None, desc=None, desc_pattern=None,
+                           fields=None)
+        where = []
+        vars = {}
+        if params.name is not None:
+            where.append(web.db.sqlors('name = ', params.name.split(',')))
+        if params.type is not None:
+            where.append(web.db.sqlors('type = ', params.type.split(',')))
+        for column in ('locked', 'up'):
+            if params[column] is not None:
+                where.append('{col} = ${col}'.format(col=column))
+                vars[column] = params[column] == 'true'
+        if params.owner is not None:
+            where.append('locked_by = $owner')
+            vars['owner'] = params.owner
+        if params.desc is not None:
+            where.append('description = $desc')
+            vars['desc'] = params.desc
+        if params.desc_pattern is not None:
+            where.append('description LIKE $desc_pattern')
+            vars['desc_pattern'] = '%' + re.sub(r'([\\%_])', r'\\\1',
+                                                params.desc_pattern) + '%'
+        what = '*'
+        with_age = True
+        if params.fields is not None:
+            fields = [field for field in params.fields.split(',')
+                      if re.match(r'^\w+$', field)]
+            if 'name' not in fields:
+                fields.insert(0, 'name')
+            with_age = 'sshpubkey' in fields
+            if with_age and 'sshpubkey_scanned' not in fields:
+                fields.append('sshpubkey_scanned')
+            what = ', '.join(fields)
+
+        rows = list(DB.select('machine', vars, what=what,
+                              where=' AND '.join(where) or None))
+        if not rows and not where:
             raise web.NotFound()
         for row in rows:
-            row.locked_since = row.locked_since.isoformat()
+            if 'locked_since' in row:
+                row.locked_since = row.locked_since.isoformat()
+        if with_age:
+            sshpubkey_ages(rows)
+
+        unaged = [dict((key, value) for key, value in row.iteritems()
+                       if key != 'sshpubkey_age') for row in rows]
+        etag = '"{sha1}"'.format(
+            sha1=hashlib.sha1(json.dumps(unaged, sort_keys=True)).hexdigest())
+        web.header('ETag', etag)
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+            raise web.notmodified()
+
         web.header('Content-type', 'text/json')
         return json.dumps(rows)
 
@@ -156,35 +404,10 @@ class Lock:
                             print 'reusing machines', name_keys.keys()
                             break
 
-                    results = list(DB.select('machine', machinetype,
-                                             what='name, sshpubkey, type',
-                                             where='locked = false AND up = true AND type = $machinetype',
-                                             limit=num))
-                    if len(results) < num:
+                    name_keys = lock_free_machines(user, desc, num,
+                                                   machinetype['machinetype'])
+                    if name_keys is None:
                         raise web.HTTPError(status='503 Service Unavailable')
-                    name_keys = {}
-                    for row in results:
-                        if row.type == 'vps':
-                            curkey = row.sshpubkey
-                        else:
-                            curkey, getstatus = get_sshkey(row.name)
-                            if getstatus != 0:
-                                curkey = row.sshpubkey
-                        if row.sshpubkey != curkey:
-                            newkey = curkey
-                            update_sshkey(row.name, curkey, row.type)
-                        else:
-                            newkey = row.sshpubkey
-                        name_keys[row.name] = newkey
-                    where_cond = web.db.sqlors('name = ', name_keys.keys()) \
-                        + ' AND locked = false AND up = true'
-                    num_locked = DB.update('machine',
-                                           where=where_cond,
-                                           locked=True,
-                                           locked_by=user,
-                                           description=desc,
-                                           locked_since=web.db.SQLLiteral('NOW()'))
-                    assert num_locked == num, 'Failed to lock machines'
             except Exception:
                 log.exception("Saw exception")
                 tries += 1
@@ -195,6 +418,101 @@ class Lock:
                 break
 
         print user, 'locked', name_keys.keys(), 'desc', desc
+        key_scanner.refresh_locked(name_keys)
 
         web.header('Content-type', 'text/json')
         return json.dumps(name_keys)
+
+class Reservation:
+    """
+    A queue of requests for machines.
+
+    A request is granted once it is at the head of the queue for its machine
+    type and enough machines are free. The queue is ordered by priority
+    (lower is sooner) and then by arrival. A request that can't be granted
+    right away waits on the server for up to 'timeout' seconds (at most
+    max_timeout, so that waiting clients hold few server threads). It is
+    woken as soon as a machine is unlocked or marked up in this process, and
+    checks the database every poll_interval seconds for machines freed
+    through other processes. Every response carries the request's 'ticket'
+    and its position in the queue; a client that got no machines repeats the
+    request with that ticket to keep its place. Tickets that aren't renewed
+    within expire_grace seconds of their timeout are dropped.
+    """
+    poll_interval = 2
+    max_timeout = 30
+    expire_grace = 60
+
+    def POST(self):
+        user = web.input('user')['user']
+        desc = web.input(desc=None)['desc']
+        num = int(web.input('num')['num'])
+        machinetype = web.input(machinetype='plana')['machinetype']
+        priority = int(web.input(priority=1000)['priority'])
+        min_free = int(web.input(min_free=0)['min_free'])
+        timeout = min(int(web.input(timeout=0)['timeout']), self.max_timeout)
+        ticket = web.input(ticket=None)['ticket']
+
+        if num < 1:
+            raise web.BadRequest()
+        if count_machines('up = true', machinetype) < num:
+            raise web.BadRequest()
+
+        expires = web.db.SQLLiteral('NOW() + INTERVAL {secs} SECOND'.format(
+            secs=timeout + self.expire_grace))
+        DB.delete('reservation', where='expires < NOW()')
+        if ticket is None or not DB.update('reservation',
+                                           where='id = $id',
+                                           vars=dict(id=int(ticket)),
+                                           expires=expires):
+            ticket = DB.insert('reservation', type=machinetype, num=num,
+                               priority=priority, locked_by=user,
+                               description=desc, expires=expires)
+        ticket = int(ticket)
+
+        deadline = time.time() + timeout
+        while True:
+            name_keys = None
+            ahead = self.ahead(ticket, machinetype, priority)
+            if ahead == 0 and \
+                    count_machines('locked = false AND up = true',
+                                   machinetype) >= max(num, min_free):
+                try:
+                    with DB.transaction():
+                        name_keys = lock_free_machines(user, desc, num,
+                                                       machinetype)
+                        if name_keys is not None:
+                            DB.delete('reservation', where='id = $id',
+                                      vars=dict(id=ticket))
+                except Exception:
+                    # try again at the next poll, or the client will ask
+                    # again
+                    log.exception("Saw exception")
+                    name_keys = None
+            if name_keys is not None:
+                print user, 'locked', name_keys.keys(), 'desc', desc, \
+                    'by reservation', ticket
+                key_scanner.refresh_locked(name_keys)
+                break
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            with machines_freed:
+                machines_freed.wait(min(self.poll_interval, remaining))
+
+        web.header('Content-type', 'text/json')
+        return json.dumps(dict(ticket=ticket, position=ahead,
+                               machines=name_keys, type=machinetype))
+
+    def ahead(self, ticket, machinetype, priority):
+        """
+        How many live reservations for the same machine type are ahead of
+        this one.
+        """
+        return DB.select(
+            'reservation',
+            dict(id=ticket, machinetype=machinetype, priority=priority),
+            what='count(*) AS count',
+            where='type = $machinetype AND expires > NOW() AND ' +
+            '(priority < $priority OR (priority = $priority AND id < $id))',
+        )[0].count
@@ -12,10 +12,27 @@ The schema can be created with::
         locked_by varchar(64),
         description text,
         sshpubkey text NOT NULL,
+        sshpubkey_scanned timestamp NULL DEFAULT NULL,
         PRIMARY KEY (name),
         INDEX (locked),
         INDEX (up));
 
+    CREATE TABLE reservation (
+        id integer NOT NULL AUTO_INCREMENT,
+        type varchar(255) NOT NULL,
+        num integer NOT NULL,
+        priority integer NOT NULL DEFAULT 1000,
+        locked_by varchar(64),
+        description text,
+        expires timestamp NOT NULL,
+        PRIMARY KEY (id),
+        INDEX (type));
+
+An existing machine table can be upgraded with::
+
+    ALTER TABLE machine
+        ADD sshpubkey_scanned timestamp NULL DEFAULT NULL;
+
 If using MySQL, be sure to use an engine that supports
 transactions, like InnoDB.
 """
@@ -8,12 +8,15 @@ abspath = os.path.dirname(__file__)
 if abspath not in sys.path:
     sys.path.append(abspath)
 
-from api import Lock, MachineLock # noqa
+from api import Lock, MachineLock, Reservation, key_scanner # noqa
 
 urls = (
     '/lock', 'Lock',
+    '/lock/reserve', 'Reservation',
     '/lock/(.*)', 'MachineLock',
     )
 
 app = web.application(urls, globals())
 application = app.wsgifunc()
+# every server process starts one, but only one of them scans
+key_scanner.start()
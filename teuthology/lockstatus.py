@@ -1,15 +1,115 @@
+import collections
+import httplib
 import json
 import httplib2
 import logging
 import os
+import random
+import socket
+import time
+import urllib
+import urlparse
 from .config import config
 
 log = logging.getLogger(__name__)
 
+# How many times an idempotent request is retried after a connection error or
+# a 502/503/504, and the backoff before the first retry (doubled each time,
+# with jitter)
+max_retries = 3
+retry_backoff = 0.5
+
+# Idle httplib2.Http objects. Each one keeps its connections open between
+# requests; they're pooled because they can't be shared between greenlets.
+_idle_clients = []
+max_idle_clients = 8
+
+# (method, endpoint) -> latency counters, see log_request_stats()
+request_stats = collections.defaultdict(
+    lambda: dict(count=0, errors=0, retries=0, total=0.0, max=0.0))
+
+
+def _get_client():
+    if _idle_clients:
+        return _idle_clients.pop()
+    return httplib2.Http()
+
+
+def _put_client(http):
+    if len(_idle_clients) < max_idle_clients:
+        _idle_clients.append(http)
+
+
+def _endpoint(url):
+    """
+    The part of url that identifies the API endpoint, with machine names
+    replaced, so that requests for different machines are counted together.
+    """
+    path = urlparse.urlparse(url).path
+    lock_path = urlparse.urlparse(config.lock_server or '').path.rstrip('/')
+    if lock_path and path.startswith(lock_path + '/'):
+        rest = path[len(lock_path) + 1:]
+        if rest and rest != 'reserve':
+            rest = '<name>'
+        return lock_path + '/' + rest
+    return path
+
+
+def _request(method, url, body=None, headers=None):
+    """
+    Make a request with a pooled keep-alive client, retrying idempotent
+    requests on connection errors and gateway errors.
+
+    :returns: (response, content) as from httplib2.Http.request()
+    """
+    stats = request_stats[(method, _endpoint(url))]
+    retry = method in ('GET', 'HEAD', 'PUT', 'DELETE')
+    attempt = 0
+    while True:
+        http = _get_client()
+        start = time.time()
+        try:
+            resp, content = http.request(url, method=method, body=body,
+                                         headers=headers)
+        except (socket.error, httplib.HTTPException):
+            # the client's connections may be in any state; drop it
+            stats['errors'] += 1
+            if not retry or attempt >= max_retries:
+                raise
+            log.debug("%s request to '%s' failed, retrying", method, url,
+                      exc_info=True)
+        else:
+            _put_client(http)
+            elapsed = time.time() - start
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            if not (retry and resp.status in (502, 503, 504) and
+                    attempt < max_retries):
+                return resp, content
+            stats['errors'] += 1
+            log.debug("%s request to '%s' got %d, retrying", method, url,
+                      resp.status)
+        stats['retries'] += 1
+        time.sleep(retry_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        attempt += 1
+
+
+def log_request_stats():
+    """
+    Log the latency of the lock server requests made by this process.
+    """
+    for (method, endpoint), stats in sorted(request_stats.iteritems()):
+        if not stats['count']:
+            continue
+        log.info(
+            '%s %s: %d requests, avg %.3fs, max %.3fs, %d errors, %d retries',
+            method, endpoint, stats['count'], stats['total'] / stats['count'],
+            stats['max'], stats['errors'], stats['retries'])
+
 
 def send_request(method, url, body=None, headers=None):
-    http = httplib2.Http()
-    resp, content = http.request(url, method=method, body=body, headers=headers)
+    resp, content = _request(method, url, body=body, headers=headers)
     if resp.status == 200:
         return (True, content, resp.status)
     log.info("%s request to '%s' with body '%s' failed with response code %d",
@@ -17,8 +117,57 @@ def send_request(method, url, body=None, headers=None):
     return (False, None, resp.status)
 
 
+# url -> (etag, content) of the last successful GET through get_cached()
+_etag_cache = {}
+
+
+def get_cached(url):
+    """
+    GET url, letting the server answer 304 Not Modified when the content
+    hasn't changed since the last time it was fetched.
+
+    :returns: The same (success, content, status) tuple as send_request()
+    """
+    headers = {}
+    cached = _etag_cache.get(url)
+    if cached is not None:
+        headers['If-None-Match'] = cached[0]
+    resp, content = _request('GET', url, headers=headers)
+    if resp.status == 304 and cached is not None:
+        return (True, cached[1], 200)
+    if resp.status == 200:
+        if 'etag' in resp:
+            _etag_cache[url] = (resp['etag'], content)
+        return (True, content, resp.status)
+    log.info("GET request to '%s' failed with response code %d",
+             url, resp.status)
+    return (False, None, resp.status)
+
+
 def get_status(ctx, name):
     success, content, _ = send_request('GET', os.path.join(config.lock_server, name))
     if success:
         return json.loads(content)
     return None
+
+
+def get_statuses(ctx, names):
+    """
+    Look up several machines with a single request.
+
+    :returns: A dict mapping each name the lock server knows about to its
+              status, or None on error
+    """
+    names = list(names)
+    if not names:
+        return {}
+    url = config.lock_server + '?' + urllib.urlencode(
+        [('name', ','.join(names))])
+    success, content, status = send_request('GET', url)
+    if not success:
+        if status == 404:
+            return {}
+        return None
+    # older lock servers ignore the name filter
+    return dict((machine['name'], machine) for machine in json.loads(content)
+                if machine['name'] in names)
@@ -18,12 +18,13 @@ import urlparse
 import yaml
 import json
 import re
-import tempfile
+import shutil
 
 from teuthology import safepath
 from .orchestra import run
 from .config import config
 from .contextutil import safe_while
+from .parallel import parallel
 
 log = logging.getLogger(__name__)
 
@@ -418,15 +419,7 @@ def write_file(remote, path, data):
     :param path: Path on the remote being written to.
     :param data: Data to be written.
     """
-    remote.run(
-        args=[
-            'python',
-            '-c',
-            'import shutil, sys; shutil.copyfileobj(sys.stdin, file(sys.argv[1], "wb"))',
-            path,
-            ],
-        stdin=data,
-        )
+    remote.write_file(path, data)
 
 
 def sudo_write_file(remote, path, data, perms=None, owner=None):
@@ -439,24 +432,10 @@ def sudo_write_file(remote, path, data, perms=None, owner=None):
     :param perms: Permissions on the file being written
     :param owner: Owner for the file being written
 
-    Both perms and owner are passed directly to chmod.
+    An existing file keeps its owner and mode unless perms or owner are
+    given. See `Remote.write_file`.
     """
-    permargs = []
-    if perms:
-        permargs = [run.Raw('&&'), 'sudo', 'chmod', perms, path]
-    owner_args = []
-    if owner:
-        owner_args = [run.Raw('&&'), 'sudo', 'chown', owner, path]
-    remote.run(
-        args=[
-            'sudo',
-            'python',
-            '-c',
-            'import shutil, sys; shutil.copyfileobj(sys.stdin, file(sys.argv[1], "wb"))',
-            path,
-            ] + owner_args + permargs,
-        stdin=data,
-        )
+    remote.write_file(path, data, sudo=True, mode=perms, owner=owner)
 
 
 def copy_file(from_remote, from_path, to_remote, to_path=None):
@@ -639,51 +618,236 @@ def get_file(remote, path, sudo=False, dest_dir='/tmp'):
     return file_data
 
 
-def pull_directory(remote, remotedir, localdir):
+class RateLimiter(object):
+    """
+    Share a bytes-per-second budget between concurrent transfers.
+
+    Transfers call consume() after each chunk; it sleeps whenever the
+    combined total gets ahead of the budget.
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.start = time.time()
+        self.total = 0
+
+    def consume(self, nbytes):
+        self.total += nbytes
+        ahead = self.total / self.rate - (time.time() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class _CountingReader(object):
+    """
+    Wrap a file-like object and count the bytes read from it, optionally
+    throttled by a RateLimiter.
+    """
+    def __init__(self, wrapped, rate_limiter=None):
+        self.wrapped = wrapped
+        self.rate_limiter = rate_limiter
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.wrapped.read(size)
+        self.count += len(data)
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(len(data))
+        return data
+
+    def drain(self, bufsize=65536):
+        """
+        Read and discard whatever is left.
+        """
+        while self.read(bufsize):
+            pass
+
+
+def _log_transfer(remote, remotedir, nbytes, start):
+    """
+    Log the size and throughput of a transfer from remote.
+    """
+    duration = max(time.time() - start, 0.001)
+    log.info('Transferred %d bytes from %s:%s in %.1f seconds (%.2f MB/s)',
+             nbytes, remote.shortname, remotedir, duration,
+             nbytes / duration / (1024 * 1024))
+
+
+def pull_directory(remote, remotedir, localdir, rate_limiter=None):
     """
     Copy a remote directory to a local directory.
+
+    The remote tar output is extracted as it arrives over the ssh channel;
+    nothing is staged on either side.
+
+    :param rate_limiter: optional RateLimiter to throttle the transfer
+    :returns: the number of (compressed) bytes transferred
     """
     log.debug('Transferring archived files from %s:%s to %s',
               remote.shortname, remotedir, localdir)
     if not os.path.exists(localdir):
         os.mkdir(localdir)
-    _, local_tarfile = tempfile.mkstemp(dir=localdir)
-    remote.get_tar(remotedir, local_tarfile, sudo=True)
-    with open(local_tarfile, 'r+') as fb1:
-        tar = tarfile.open(mode='r|gz', fileobj=fb1)
-        while True:
-            ti = tar.next()
-            if ti is None:
-                break
+    start = time.time()
+    proc = remote.get_tar_stream(remotedir, sudo=True)
+    stream = _CountingReader(proc.stdout, rate_limiter)
+    tar = tarfile.open(mode='r|gz', fileobj=stream)
+    while True:
+        ti = tar.next()
+        if ti is None:
+            break
 
-            if ti.isdir():
-                # ignore silently; easier to just create leading dirs below
-                pass
-            elif ti.isfile():
-                sub = safepath.munge(ti.name)
-                safepath.makedirs(root=localdir, path=os.path.dirname(sub))
-                tar.makefile(ti, targetpath=os.path.join(localdir, sub))
+        if ti.isdir():
+            # ignore silently; easier to just create leading dirs below
+            pass
+        elif ti.isfile():
+            sub = safepath.munge(ti.name)
+            safepath.makedirs(root=localdir, path=os.path.dirname(sub))
+            tar.makefile(ti, targetpath=os.path.join(localdir, sub))
+        else:
+            if ti.isdev():
+                type_ = 'device'
+            elif ti.issym():
+                type_ = 'symlink'
+            elif ti.islnk():
+                type_ = 'hard link'
             else:
-                if ti.isdev():
-                    type_ = 'device'
-                elif ti.issym():
-                    type_ = 'symlink'
-                elif ti.islnk():
-                    type_ = 'hard link'
-                else:
-                    type_ = 'unknown'
-                    log.info('Ignoring tar entry: %r type %r', ti.name, type_)
-                    continue
-    os.remove(local_tarfile)
+                type_ = 'unknown'
+                log.info('Ignoring tar entry: %r type %r', ti.name, type_)
+                continue
+    # tarfile may stop before the end of the gzip stream; don't leave the
+    # remote tar blocked on a full channel
+    stream.drain()
+    proc.exitstatus.get()
+    _log_transfer(remote, remotedir, stream.count, start)
+    return stream.count
 
 
-def pull_directory_tarball(remote, remotedir, localfile):
+def pull_directory_tarball(remote, remotedir, localfile, rate_limiter=None):
     """
     Copy a remote directory to a local tarball.
+
+    :param rate_limiter: optional RateLimiter to throttle the transfer
+    :returns: the number of bytes transferred
     """
     log.debug('Transferring archived files from %s:%s to %s',
               remote.shortname, remotedir, localfile)
-    remote.get_tar(remotedir, localfile, sudo=True)
+    start = time.time()
+    proc = remote.get_tar_stream(remotedir, sudo=True)
+    stream = _CountingReader(proc.stdout, rate_limiter)
+    with open(localfile, 'wb') as f:
+        shutil.copyfileobj(stream, f)
+    proc.exitstatus.get()
+    _log_transfer(remote, remotedir, stream.count, start)
+    return stream.count
+
+
+def pull_directories(ctx, transfers, report_key):
+    """
+    Run several pull_directory/pull_directory_tarball transfers at once.
+
+    If ctx.config has 'archive-max-rate' (in MB/s), the transfers share
+    that much bandwidth between them. The bytes and seconds taken by each
+    transfer are stored in ctx.summary[report_key][label].
+
+    A failed transfer does not stop the others; once they have all
+    finished, the first failure is re-raised.
+
+    :param transfers: list of (label, function, remote, remotedir,
+                      localpath) tuples, where function is pull_directory
+                      or pull_directory_tarball
+    :param report_key: ctx.summary key to store the report under
+    """
+    rate_limiter = None
+    max_rate = ctx.config.get('archive-max-rate')
+    if max_rate:
+        rate_limiter = RateLimiter(max_rate * 1024 * 1024)
+    report = ctx.summary.setdefault(report_key, {})
+    failures = []
+
+    def _pull(label, function, remote, remotedir, localpath):
+        start = time.time()
+        try:
+            nbytes = function(remote, remotedir, localpath,
+                              rate_limiter=rate_limiter)
+        except Exception:
+            log.exception('Failed to transfer %s:%s', remote.shortname,
+                          remotedir)
+            failures.append(sys.exc_info())
+            report[label] = dict(failed=True)
+        else:
+            report[label] = dict(
+                bytes=nbytes,
+                seconds=round(time.time() - start, 3),
+                )
+
+    with parallel() as p:
+        for transfer in transfers:
+            p.spawn(_pull, *transfer)
+    if failures:
+        exc_info = failures[0]
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def scan_logs_command(paths, patterns, excludes=(), max_hits=1,
+                      unique=False):
+    """
+    The command that `scan_logs` runs on each remote, for running it some
+    other way. Its output is the JSON result for that remote.
+
+    :returns: (args, script) where script must be fed to args on stdin
+    """
+    with file(os.path.join(os.path.dirname(__file__), 'task', 'scan-logs'),
+              'rb') as f:
+        script = f.read()
+    args = ['sudo', 'python', '-', '--max-hits', str(max_hits)]
+    if unique:
+        args.append('--unique')
+    for name, regex in patterns:
+        args.extend(['--pattern', '{name}={regex}'.format(name=name,
+                                                          regex=regex)])
+    for regex in excludes:
+        args.extend(['--exclude', regex])
+    args.append('--')
+    args.extend(paths)
+    return args, script
+
+
+def scan_logs(remotes, paths, patterns, excludes=(), max_hits=1,
+              unique=False):
+    """
+    Scan log files on several remotes at once with the scan-logs helper,
+    reading each file only once.
+
+    The helper is fed to the remote python on stdin, so it does not need
+    to have been shipped. Paths are globbed on the remote, and gzipped
+    logs are read transparently.
+
+    :param remotes: Remotes to scan on.
+    :param paths: Log file paths or globs.
+    :param patterns: List of (name, regex) tuples to count matches of.
+    :param excludes: Regexes of lines to ignore.
+    :param max_hits: How many matching lines to return per pattern.
+    :param unique: Count repeated lines in the same file only once.
+    :returns: dict of remote -> {'counts': {name: count},
+                                 'hits': {name: [[file, line], ...]}}
+    """
+    args, script = scan_logs_command(paths, patterns, excludes=excludes,
+                                     max_hits=max_hits, unique=unique)
+
+    def _scan(remote):
+        proc = remote.run(
+            args=args,
+            stdin=script,
+            stdout=StringIO(),
+            )
+        return remote, json.loads(proc.stdout.getvalue())
+
+    results = {}
+    with parallel() as p:
+        for remote in remotes:
+            p.spawn(_scan, remote)
+        for remote, result in p:
+            results[remote] = result
+    return results
 
 
 def get_wwn_id_map(remote, devs):
@@ -735,49 +899,28 @@ def get_wwn_id_map(remote, devs):
 def get_scratch_devices(remote):
     """
     Read the scratch disk list from remote host
+
+    Which devices exist and are readable comes from remote.facts; whether
+    they are mounted is checked each time.
     """
     devs = []
-    try:
-        file_data = get_file(remote, "/scratch_devs")
-        devs = file_data.split()
-    except Exception:
-        r = remote.run(
-            args=['ls', run.Raw('/dev/[sv]d?')],
-            stdout=StringIO()
-            )
-        devs = r.stdout.getvalue().strip().split('\n')
-
-    # Remove root device (vm guests) from the disk list
-    for dev in devs:
+    for dev in remote.facts['scratch_candidates']:
+        # Remove root device (vm guests) from the disk list
         if 'vda' in dev:
-            devs.remove(dev)
             log.warn("Removing root device: %s from device list" % dev)
+            continue
+        devs.append(dev)
 
     log.debug('devs={d}'.format(d=devs))
 
+    r = remote.run(args=['mount'], stdout=StringIO())
+    mounts = r.stdout.getvalue()
     retval = []
     for dev in devs:
-        try:
-            # FIXME: Split this into multiple calls.
-            remote.run(
-                args=[
-                    # node exists
-                    'stat',
-                    dev,
-                    run.Raw('&&'),
-                    # readable
-                    'sudo', 'dd', 'if=%s' % dev, 'of=/dev/null', 'count=1',
-                    run.Raw('&&'),
-                    # not mounted
-                    run.Raw('!'),
-                    'mount',
-                    run.Raw('|'),
-                    'grep', '-q', dev,
-                ]
-            )
-            retval.append(dev)
-        except run.CommandFailedError:
+        if dev not in remote.facts['scratch_readable'] or dev in mounts:
             log.debug("get_scratch_devices: %s is in use" % dev)
+            continue
+        retval.append(dev)
     return retval
 
 
@@ -875,6 +1018,7 @@ def reboot(node, timeout=300, interval=30):
     """
     log.info("Rebooting {host}...".format(host=node.hostname))
     node.run(args=['sudo', 'shutdown', '-r', 'now'])
+    node.invalidate_facts()
     reboot_start_time = time.time()
     while time.time() - reboot_start_time < timeout:
         time.sleep(interval)
@@ -1104,13 +1248,7 @@ def get_system_type(remote, distro=False):
     """
     Return this system type (deb or rpm) or Distro.
     """
-    r = remote.run(
-        args=[
-            'sudo', 'lsb_release', '-is',
-        ],
-        stdout=StringIO(),
-    )
-    system_value = r.stdout.getvalue().strip()
+    system_value = remote.facts['distro']
     log.debug("System to be installed: %s" % system_value)
     if distro:
         return system_value.lower()
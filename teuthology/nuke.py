@@ -25,62 +25,51 @@ log = logging.getLogger(__name__)
 
 
 def shutdown_daemons(ctx):
-    nodes = {}
-    for remote in ctx.cluster.remotes.iterkeys():
-        proc = remote.run(
-            args=[
-                'if', 'grep', '-q', 'ceph-fuse', '/etc/mtab', run.Raw(';'),
-                'then',
-                'grep', 'ceph-fuse', '/etc/mtab', run.Raw('|'),
-                'grep', '-o', " /.* fuse", run.Raw('|'),
-                'grep', '-o', "/.* ", run.Raw('|'),
-                'xargs', 'sudo', 'fusermount', '-u', run.Raw(';'),
-                'fi',
-                run.Raw(';'),
-                'sudo',
-                'killall',
-                '--quiet',
-                'ceph-mon',
-                'ceph-osd',
-                'ceph-mds',
-                'ceph-fuse',
-                'ceph-disk',
-                'radosgw',
-                'ceph_test_rados',
-                'rados',
-                'apache2',
-                run.Raw('||'),
-                'true',  # ignore errors from ceph binaries not being found
-            ],
-            wait=False,
-        )
-        nodes[remote.name] = proc
-
-    for name, proc in nodes.iteritems():
-        log.info('Waiting for %s to finish shutdowns...', name)
-        proc.exitstatus.get()
+    log.info('Waiting for all nodes to finish shutdowns...')
+    ctx.cluster.run_all(
+        args=[
+            'if', 'grep', '-q', 'ceph-fuse', '/etc/mtab', run.Raw(';'),
+            'then',
+            'grep', 'ceph-fuse', '/etc/mtab', run.Raw('|'),
+            'grep', '-o', " /.* fuse", run.Raw('|'),
+            'grep', '-o', "/.* ", run.Raw('|'),
+            'xargs', 'sudo', 'fusermount', '-u', run.Raw(';'),
+            'fi',
+            run.Raw(';'),
+            'sudo',
+            'killall',
+            '--quiet',
+            'ceph-mon',
+            'ceph-osd',
+            'ceph-mds',
+            'ceph-fuse',
+            'ceph-disk',
+            'radosgw',
+            'ceph_test_rados',
+            'rados',
+            'apache2',
+            run.Raw('||'),
+            'true',  # ignore errors from ceph binaries not being found
+        ],
+    )
 
 
 def find_kernel_mounts(ctx):
-    nodes = {}
     log.info('Looking for kernel mounts to handle...')
-    for remote in ctx.cluster.remotes.iterkeys():
-        proc = remote.run(
-            args=[
-                'grep', '-q', ' ceph ', '/etc/mtab',
-                run.Raw('||'),
-                'grep', '-q', '^/dev/rbd', '/etc/mtab',
-            ],
-            wait=False,
-        )
-        nodes[remote] = proc
+    result = ctx.cluster.run_all(
+        args=[
+            'grep', '-q', ' ceph ', '/etc/mtab',
+            run.Raw('||'),
+            'grep', '-q', '^/dev/rbd', '/etc/mtab',
+        ],
+        check_status=False,
+    )
     kernel_mounts = list()
-    for remote, proc in nodes.iteritems():
-        try:
-            proc.exitstatus.get()
+    for remote, proc in result.processes.iteritems():
+        if proc.exitstatus == 0:
             log.debug('kernel mount exists on %s', remote.name)
             kernel_mounts.append(remote)
-        except run.CommandFailedError:  # no mounts!
+        else:  # no mounts!
             log.debug('no kernel mount on %s', remote.name)
 
     return kernel_mounts
@@ -115,7 +104,7 @@ def remove_osd_mounts(ctx):
     """
     unmount any osd data mounts (scratch disks)
     """
-    ctx.cluster.run(
+    ctx.cluster.run_all(
         args=[
             'grep',
             '/var/lib/ceph/osd/',
@@ -133,7 +122,7 @@ def remove_osd_tmpfs(ctx):
     """
     unmount tmpfs mounts
     """
-    ctx.cluster.run(
+    ctx.cluster.run_all(
         args=[
             'egrep', 'tmpfs\s+/mnt', '/etc/mtab', run.Raw('|'),
             'awk', '{print $2}', run.Raw('|'),
@@ -173,49 +162,34 @@ def reboot(ctx, remotes):
 
 
 def reset_syslog_dir(ctx):
-    nodes = {}
-    for remote in ctx.cluster.remotes.iterkeys():
-        proc = remote.run(
-            args=[
-                'if', 'test', '-e', '/etc/rsyslog.d/80-cephtest.conf',
-                run.Raw(';'),
-                'then',
-                'sudo', 'rm', '-f', '--', '/etc/rsyslog.d/80-cephtest.conf',
-                run.Raw('&&'),
-                'sudo', 'service', 'rsyslog', 'restart',
-                run.Raw(';'),
-                'fi',
-                run.Raw(';'),
-            ],
-            wait=False,
-        )
-        nodes[remote.name] = proc
-
-    for name, proc in nodes.iteritems():
-        log.info('Waiting for %s to restart syslog...', name)
-        proc.exitstatus.get()
+    log.info('Waiting for all nodes to restart syslog...')
+    ctx.cluster.run_all(
+        args=[
+            'if', 'test', '-e', '/etc/rsyslog.d/80-cephtest.conf',
+            run.Raw(';'),
+            'then',
+            'sudo', 'rm', '-f', '--', '/etc/rsyslog.d/80-cephtest.conf',
+            run.Raw('&&'),
+            'sudo', 'service', 'rsyslog', 'restart',
+            run.Raw(';'),
+            'fi',
+            run.Raw(';'),
+        ],
+    )
 
 
 def dpkg_configure(ctx):
-    nodes = {}
-    for remote in ctx.cluster.remotes.iterkeys():
-        proc = remote.run(
-            args=[
-                'sudo', 'dpkg', '--configure', '-a',
-                run.Raw('&&'),
-                'sudo', 'apt-get', '-f', 'install',
-                run.Raw('||'),
-                ':',
-            ],
-            wait=False,
-        )
-        nodes[remote.name] = proc
-
-    for name, proc in nodes.iteritems():
-        log.info(
-            'Waiting for %s to dpkg --configure -a and apt-get -f install...',
-            name)
-        proc.exitstatus.get()
+    log.info(
+        'Waiting for all nodes to dpkg --configure -a and apt-get -f install...')
+    ctx.cluster.run_all(
+        args=[
+            'sudo', 'dpkg', '--configure', '-a',
+            run.Raw('&&'),
+            'sudo', 'apt-get', '-f', 'install',
+            run.Raw('||'),
+            ':',
+        ],
+    )
 
 
 def remove_installed_packages(ctx):
@@ -232,26 +206,19 @@ def remove_installed_packages(ctx):
 
 
 def remove_testing_tree(ctx):
-    nodes = {}
-    for remote in ctx.cluster.remotes.iterkeys():
-        proc = remote.run(
-            args=[
-                'sudo', 'rm', '-rf', get_testdir(ctx),
-                # just for old time's sake
-                run.Raw('&&'),
-                'sudo', 'rm', '-rf', '/tmp/cephtest',
-                run.Raw('&&'),
-                'sudo', 'rm', '-rf', '/home/ubuntu/cephtest',
-                run.Raw('&&'),
-                'sudo', 'rm', '-rf', '/etc/ceph',
-            ],
-            wait=False,
-        )
-        nodes[remote.name] = proc
-
-    for name, proc in nodes.iteritems():
-        log.info('Waiting for %s to clear filesystem...', name)
-        proc.exitstatus.get()
+    log.info('Waiting for all nodes to clear filesystem...')
+    ctx.cluster.run_all(
+        args=[
+            'sudo', 'rm', '-rf', get_testdir(ctx),
+            # just for old time's sake
+            run.Raw('&&'),
+            'sudo', 'rm', '-rf', '/tmp/cephtest',
+            run.Raw('&&'),
+            'sudo', 'rm', '-rf', '/home/ubuntu/cephtest',
+            run.Raw('&&'),
+            'sudo', 'rm', '-rf', '/etc/ceph',
+        ],
+    )
 
 
 def synch_clocks(remotes):
@@ -326,7 +293,7 @@ def nuke(ctx, should_unlock, sync_clocks=True, reboot_all=True, noipmi=False):
     targets = dict(ctx.config['targets'])
     if ctx.name:
         log.info('Checking targets against current locks')
-        locks = list_locks()
+        locks = list_locks(locked=True, fields=['description'])
         # Remove targets who's description doesn't match archive name.
         for lock in locks:
             for target in targets:
@@ -448,7 +415,7 @@ def nuke_helper(ctx):
     synch_clocks(need_reboot)
 
     log.info('Making sure firmware.git is not locked...')
-    ctx.cluster.run(args=['sudo', 'rm', '-f',
+    ctx.cluster.run_all(args=['sudo', 'rm', '-f',
                           '/lib/firmware/updates/.git/index.lock', ])
 
     log.info('Reseting syslog output locations...')
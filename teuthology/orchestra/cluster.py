@@ -2,7 +2,65 @@
 Cluster definition
 part of context, Cluster is used to save connection information.
 """
-import teuthology.misc
+import logging
+import time
+
+from teuthology.parallel import parallel
+
+log = logging.getLogger(__name__)
+
+
+class RunAllResult(object):
+    """
+    Per-host outcome of `Cluster.run_all`.
+
+    :attr processes: dict of Remote -> RemoteProcess, for hosts where the
+                     command completed
+    :attr errors:    dict of Remote -> exception, for hosts where it failed
+    :attr durations: dict of Remote -> wall-clock seconds spent on that host
+    """
+
+    def __init__(self):
+        self.processes = {}
+        self.errors = {}
+        self.durations = {}
+
+    def latency_table(self):
+        """
+        Return a human readable table of how long each host took, slowest
+        first.
+        """
+        rows = sorted(self.durations.items(), key=lambda tup: -tup[1])
+        lines = []
+        for remote, duration in rows:
+            if remote in self.errors:
+                status = 'failed'
+            elif remote in self.processes:
+                status = 'ok'
+            else:
+                status = 'cancelled'
+            lines.append('{name:<30} {duration:>9.3f}s {status}'.format(
+                name=remote.name, duration=duration, status=status))
+        return '\n'.join(lines)
+
+
+class ClusterRunError(Exception):
+    """
+    Raised by `Cluster.run_all` when the command failed on one or more hosts
+    and fail_fast was False.
+    """
+
+    def __init__(self, result):
+        self.result = result
+
+    def __str__(self):
+        errors = sorted(self.result.errors.items(),
+                        key=lambda tup: tup[0].name)
+        return 'Command failed on {count} host(s): {errors}'.format(
+            count=len(errors),
+            errors='; '.join('{name}: {err}'.format(name=remote.name, err=err)
+                             for remote, err in errors),
+            )
 
 
 class Cluster(object):
@@ -63,6 +121,49 @@ class Cluster(object):
         remotes = sorted(self.remotes.iterkeys(), key=lambda rem: rem.name)
         return [remote.run(**kwargs) for remote in remotes]
 
+    def run_all(self, max_concurrency=None, fail_fast=True, **kwargs):
+        """
+        Run a command on all the nodes in this cluster concurrently and wait
+        for it to finish everywhere.
+
+        :param max_concurrency: Run on at most this many nodes at a time.
+                                Default is all of them at once.
+        :param fail_fast: If True, raise the first failure as soon as it
+                          happens and stop waiting on the other nodes. If
+                          False, run everywhere and then raise a
+                          `ClusterRunError` describing every failure.
+        :param kwargs: Passed to `Remote.run`; wait=False and PIPE are not
+                       supported, and a file-like stdout/stderr would be
+                       shared by all nodes.
+
+        Returns a `RunAllResult`.
+        """
+        assert kwargs.get('wait', True), \
+            "run_all() always waits; use run(wait=False) instead"
+        result = RunAllResult()
+
+        def _run(remote):
+            start = time.time()
+            try:
+                result.processes[remote] = remote.run(**kwargs)
+            except Exception as e:
+                result.errors[remote] = e
+                if fail_fast:
+                    raise
+            finally:
+                result.durations[remote] = time.time() - start
+
+        remotes = sorted(self.remotes.iterkeys(), key=lambda rem: rem.name)
+        try:
+            with parallel(size=max_concurrency) as p:
+                for remote in remotes:
+                    p.spawn(_run, remote)
+        finally:
+            log.debug('Per-host durations:\n%s', result.latency_table())
+        if result.errors:
+            raise ClusterRunError(result)
+        return result
+
     def write_file(self, file_name, content, sudo=False, perms=None):
         """
         Write text to a file on each node.
@@ -72,14 +173,43 @@ class Cluster(object):
         :param sudo: use sudo
         :param perms: file permissions (passed to chmod) ONLY if sudo is True
         """
+        if perms is not None and not sudo:
+            raise ValueError("To specify perms, sudo must be True")
+        self.broadcast_file(file_name, content, sudo=sudo, mode=perms)
+
+    def broadcast_file(self, path, data, sudo=False, mode=None, owner=None,
+                       max_concurrency=None):
+        """
+        Write the same file on every node, concurrently.
+
+        :param data: A str, or a file-like object; it is read only once
+        :param max_concurrency: Write to at most this many nodes at a time.
+                                Default is all of them at once.
+
+        The other arguments are passed to `Remote.write_file`.
+        """
+        if not isinstance(data, basestring):
+            data = data.read()
         remotes = sorted(self.remotes.iterkeys(), key=lambda rem: rem.name)
-        for remote in remotes:
-            if sudo:
-                teuthology.misc.sudo_write_file(remote, file_name, content, perms)
-            else:
-                if perms is not None:
-                    raise ValueError("To specify perms, sudo must be True")
-                teuthology.misc.write_file(remote, file_name, content, perms)
+        with parallel(size=max_concurrency) as p:
+            for remote in remotes:
+                p.spawn(remote.write_file, path, data, sudo=sudo, mode=mode,
+                        owner=owner)
+
+    def broadcast_files(self, files, sudo=False, max_concurrency=None):
+        """
+        Write the same set of files on every node, concurrently, with one
+        tar stream per node.
+
+        :param files: A list of (path, data, mode) tuples, as taken by
+                      `Remote.write_files`
+        """
+        files = [(path, data if isinstance(data, basestring) else data.read(),
+                  mode) for path, data, mode in files]
+        remotes = sorted(self.remotes.iterkeys(), key=lambda rem: rem.name)
+        with parallel(size=max_concurrency) as p:
+            for remote in remotes:
+                p.spawn(remote.write_files, files, sudo=sudo)
 
     def only(self, *roles):
         """
@@ -11,6 +11,15 @@ from ..contextutil import safe_while
 
 log = logging.getLogger(__name__)
 
+# (user@host, host key) -> paramiko.SSHClient; see get_connection()
+_connections = {}
+
+# paramiko.SSHClient -> how many holders it has; see release_connection()
+_holders = {}
+
+# path -> (mtime, paramiko.SSHConfig); see get_ssh_config()
+_ssh_configs = {}
+
 
 def split_user(user_at_host):
     """
@@ -37,6 +46,30 @@ def create_key(keytype, key):
         raise ValueError('keytype must be ssh-rsa or ssh-dsa')
 
 
+def get_ssh_config(path="~/.ssh/config"):
+    """
+    Parse an ssh config file, reusing the previous parse unless the file
+    has changed since.
+
+    :param path: path to the ssh config file
+    :return: paramiko.SSHConfig, or None if the file does not exist
+    """
+    path = os.path.expanduser(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        _ssh_configs.pop(path, None)
+        return None
+    cached = _ssh_configs.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    ssh_config = paramiko.SSHConfig()
+    with open(path) as f:
+        ssh_config.parse(f)
+    _ssh_configs[path] = (mtime, ssh_config)
+    return ssh_config
+
+
 def connect(user_at_host, host_key=None, keep_alive=False,
             _SSHClient=None, _create_key=None):
     """
@@ -76,10 +109,8 @@ def connect(user_at_host, host_key=None, keep_alive=False,
         timeout=60
     )
 
-    ssh_config_path = os.path.expanduser("~/.ssh/config")
-    if os.path.exists(ssh_config_path):
-        ssh_config = paramiko.SSHConfig()
-        ssh_config.parse(open(ssh_config_path))
+    ssh_config = get_ssh_config()
+    if ssh_config is not None:
         opts = ssh_config.lookup(host)
         opts_to_args = {
             'identityfile': 'key_filename',
@@ -102,3 +133,89 @@ def connect(user_at_host, host_key=None, keep_alive=False,
                 log.exception("Error connecting to {host}".format(host=host))
     ssh.get_transport().set_keepalive(keep_alive)
     return ssh
+
+
+def is_active(ssh):
+    """
+    Check whether an SSHClient still has a live transport.
+    """
+    transport = ssh.get_transport()
+    return transport is not None and transport.is_active()
+
+
+def get_connection(user_at_host, host_key=None, keep_alive=False,
+                   _connect=None):
+    """
+    Return the SSH connection to user_at_host shared by this process,
+    opening a new one if there is none yet or the previous one has died.
+    Connections are only shared by callers that expect the same host key.
+
+    Every command run over the returned client gets its own channel on
+    the same transport, so the handshake is paid once per host. Give it
+    back with release_connection() once done with it.
+
+    :param user_at_host: user@host
+    :param host_key: ssh key
+    :param keep_alive: keep_alive indicator
+    :param _connect: routine to open a connection (defaults to connect)
+    :return: ssh connection.
+    """
+    if _connect is None:
+        _connect = connect
+    key = (user_at_host, host_key)
+    ssh = _connections.get(key)
+    if ssh is not None and not is_active(ssh):
+        log.info('Connection to %s was lost, reconnecting', user_at_host)
+        ssh.close()
+        ssh = None
+    if ssh is None:
+        ssh = _connect(user_at_host=user_at_host, host_key=host_key,
+                       keep_alive=keep_alive)
+        _connections[key] = ssh
+    elif keep_alive:
+        # whoever opened it may not have asked for keepalives
+        ssh.get_transport().set_keepalive(keep_alive)
+    _holders[ssh] = _holders.get(ssh, 0) + 1
+    return ssh
+
+
+def _is_shared(ssh):
+    return any(shared is ssh for shared in _connections.itervalues())
+
+
+def release_connection(ssh, forget=False):
+    """
+    Give back a connection from get_connection(). It is closed once nobody
+    holds it any more, unless it is still handed out.
+
+    :param forget: Stop handing it out, e.g. because the host is being
+                   rebooted; the next get_connection() opens a new one
+    """
+    if forget:
+        for key, shared in _connections.items():
+            if shared is ssh:
+                del _connections[key]
+    holders = _holders.pop(ssh, 0) - 1
+    if holders > 0:
+        _holders[ssh] = holders
+    elif not _is_shared(ssh):
+        ssh.close()
+
+
+def close_connection(user_at_host):
+    """
+    Close and forget the shared connections to user_at_host, if any.
+    """
+    for key in list(_connections):
+        if key[0] == user_at_host:
+            ssh = _connections.pop(key)
+            _holders.pop(ssh, None)
+            ssh.close()
+
+
+def close_all():
+    """
+    Close and forget every shared connection.
+    """
+    for user_at_host in list(_connections):
+        close_connection(user_at_host)
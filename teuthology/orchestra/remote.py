@@ -12,6 +12,8 @@ from cStringIO import StringIO
 from teuthology import lockstatus as ls
 import os
 import pwd
+import shutil
+import tarfile
 import tempfile
 
 try:
@@ -21,6 +23,27 @@ except ImportError:
 
 log = logging.getLogger(__name__)
 
+# Run by Remote.gather_facts(); prints one 'key value' line per fact
+FACTS_SCRIPT = """
+echo "distro $(lsb_release -is 2>/dev/null)"
+echo "distro_version $(lsb_release -rs 2>/dev/null)"
+echo "codename $(lsb_release -cs 2>/dev/null)"
+echo "arch $(uname -m)"
+echo "kernel $(uname -r)"
+if [ -r /scratch_devs ]; then
+    devs=$(cat /scratch_devs)
+else
+    devs=$(ls /dev/[sv]d? 2>/dev/null)
+fi
+for dev in $devs; do
+    echo "scratch_candidates $dev"
+    if stat $dev >/dev/null 2>&1 &&
+            sudo dd if=$dev of=/dev/null count=1 >/dev/null 2>&1; then
+        echo "scratch_readable $dev"
+    fi
+done
+"""
+
 
 class Remote(object):
 
@@ -47,12 +70,22 @@ class Remote(object):
         self.host_key = host_key
         self.keep_alive = keep_alive
         self.console = console
-        self.ssh = ssh or self.connect()
+        self._sftp = None
+        self._facts = None
+        self.ssh = ssh
+        if ssh is None:
+            self.connect()
 
     def connect(self):
-        self.ssh = connection.connect(user_at_host=self.name,
-                                      host_key=self.host_key,
-                                      keep_alive=self.keep_alive)
+        """
+        Use the process-wide connection to this host, opening it if needed.
+        """
+        ssh = connection.get_connection(user_at_host=self.name,
+                                        host_key=self.host_key,
+                                        keep_alive=self.keep_alive)
+        if self.ssh is not None:
+            connection.release_connection(self.ssh)
+        self.ssh = ssh
         return self.ssh
 
     def reconnect(self):
@@ -60,7 +93,12 @@ class Remote(object):
         Attempts to re-establish connection. Returns True for success; False
         for failure.
         """
-        self.ssh.close()
+        if self.ssh is not None:
+            connection.release_connection(self.ssh, forget=True)
+            self.ssh = None
+        self._sftp = None
+        # it may have been rebooted, possibly into another kernel
+        self.invalidate_facts()
         try:
             self.ssh = self.connect()
             return self.is_online
@@ -89,6 +127,56 @@ class Remote(object):
         if not self.is_online:
             return self.connect()
 
+    @property
+    def facts(self):
+        """
+        A dict of facts about the host, gathered the first time they're
+        needed and cached until `invalidate_facts` is called:
+
+            distro:             lsb_release -is, e.g. 'Ubuntu'
+            distro_version:     lsb_release -rs, e.g. '12.04'
+            codename:           lsb_release -cs, e.g. 'precise'
+            arch:               uname -m
+            kernel:             uname -r
+            scratch_candidates: devices listed in /scratch_devs, or /dev/[sv]d?
+            scratch_readable:   those of them that exist and can be read
+        """
+        if self._facts is None:
+            self.gather_facts()
+        return self._facts
+
+    def gather_facts(self):
+        """
+        (Re)gather `facts` with a single remote command, and return them.
+        """
+        proc = self.run(
+            args=['sh', '-c', FACTS_SCRIPT],
+            stdout=StringIO(),
+            )
+        return self.load_facts(proc.stdout.getvalue())
+
+    def load_facts(self, output):
+        """
+        Set `facts` from the output of FACTS_SCRIPT, when it was run some
+        other way, and return them.
+        """
+        facts = dict(scratch_candidates=[], scratch_readable=[])
+        for line in output.splitlines():
+            key, _, value = line.partition(' ')
+            if isinstance(facts.get(key), list):
+                facts[key].append(value)
+            else:
+                facts[key] = value.strip()
+        log.debug('Facts for %s: %s', self.shortname, facts)
+        self._facts = facts
+        return facts
+
+    def invalidate_facts(self):
+        """
+        Forget the cached `facts`, e.g. after a reboot or kernel install.
+        """
+        self._facts = None
+
     @property
     def system_type(self):
         """
@@ -153,12 +241,21 @@ class Remote(object):
             args=args,
             )
 
+    @property
+    def sftp(self):
+        """
+        A paramiko.SFTPClient on our SSH connection, opened the first time
+        it's needed and kept for later transfers.
+        """
+        if self._sftp is None or self._sftp.sock.closed:
+            self._sftp = self.ssh.open_sftp()
+        return self._sftp
+
     def _sftp_get_file(self, remote_path, local_path):
         """
         Use the paramiko.SFTPClient to get a file. Returns the local filename.
         """
-        sftp = self.ssh.open_sftp()
-        sftp.get(remote_path, local_path)
+        self.sftp.get(remote_path, local_path)
         return local_path
 
     def _sftp_open_file(self, remote_path):
@@ -166,8 +263,86 @@ class Remote(object):
         Use the paramiko.SFTPClient to open a file. Returns a
         paramiko.SFTPFile object.
         """
-        sftp = self.ssh.open_sftp()
-        return sftp.open(remote_path)
+        return self.sftp.open(remote_path)
+
+    def write_file(self, path, data, sudo=False, mode=None, owner=None):
+        """
+        Write data to a remote file.
+
+        Without sudo the file is written over SFTP. With sudo and neither
+        mode nor owner, an existing file is overwritten in place by 'sudo
+        tee', so it keeps its owner and mode. Otherwise the file is replaced
+        by a single 'sudo install' reading from stdin, which also sets its
+        mode (default 0644) and owner (default root).
+
+        :param path:  The remote path
+        :param data:  A str, or a file-like object to read the data from
+        :param sudo:  Write the file as root
+        :param mode:  Octal permissions, e.g. '0755'. Symbolic modes like
+                      'a=rx' are only supported with sudo.
+        :param owner: 'user' or 'user:group'; requires sudo
+        """
+        if isinstance(data, basestring):
+            data = StringIO(data)
+        if not sudo:
+            if owner is not None:
+                raise ValueError("To specify owner, sudo must be True")
+            # paramiko < 1.10 has no SFTPClient.putfo()
+            remote_file = self.sftp.open(path, 'wb')
+            try:
+                shutil.copyfileobj(data, remote_file)
+            finally:
+                remote_file.close()
+            if mode is not None:
+                self.sftp.chmod(path, int(mode, 8))
+            return
+        if mode is None and owner is None:
+            self.run(args=['sudo', 'tee', path, run.Raw('>/dev/null')],
+                     stdin=data)
+            return
+        args = ['sudo', 'install', '-m', mode or '0644']
+        if owner is not None:
+            user, _, group = owner.partition(':')
+            args.extend(['-o', user])
+            if group:
+                args.extend(['-g', group])
+        args.extend(['/dev/stdin', path])
+        self.run(args=args, stdin=data)
+
+    def write_files(self, files, sudo=False):
+        """
+        Write several remote files with a single tar stream.
+
+        Missing parent directories are created. The files are owned by root
+        with sudo and by our user without.
+
+        :param files: A list of (path, data, mode) tuples. path must be
+                      absolute, data is a str or file-like object, and mode
+                      is octal permissions like '0644' or None for 0644.
+        """
+        tar_fp = StringIO()
+        tar = tarfile.open(fileobj=tar_fp, mode='w')
+        for path, data, mode in files:
+            assert os.path.isabs(path), \
+                "write_files() needs absolute paths, not {path}".format(
+                    path=path)
+            if not isinstance(data, basestring):
+                data = data.read()
+            info = tarfile.TarInfo(path.lstrip('/'))
+            info.size = len(data)
+            info.mode = int(mode or '0644', 8)
+            info.mtime = time.time()
+            tar.addfile(info, StringIO(data))
+        tar.close()
+        tar_fp.seek(0)
+
+        args = []
+        if sudo:
+            args.append('sudo')
+        args.extend([
+            'tar', '-x', '-p', '--no-same-owner', '-f', '-', '-C', '/',
+            ])
+        self.run(args=args, stdin=tar_fp)
 
     def remove(self, path):
         self.run(args=['rm', '-fr', path])
@@ -194,27 +369,39 @@ class Remote(object):
             self.remove(path)
         return local_temp_path
 
-    def get_tar(self, path, to_path, sudo=False):
+    def get_tar_stream(self, path, sudo=False):
         """
-        Tar a remote directory and copy it locally
+        Start tarring a remote directory to stdout.
+
+        Returns the RemoteProcess; read the gzipped tar stream from its
+        stdout, then wait on its exitstatus. Nothing is staged on the
+        remote.
         """
-        remote_temp_path = self.mktemp()
         args = []
         if sudo:
             args.append('sudo')
         args.extend([
             'tar',
             'cz',
-            '-f', remote_temp_path,
+            '-f', '-',
             '-C', path,
             '--',
             '.',
             ])
-        self.run(args=args)
-        if sudo:
-            self.chmod(remote_temp_path, '0666')
-        self._sftp_get_file(remote_temp_path, to_path)
-        self.remove(remote_temp_path)
+        return self.run(
+            args=args,
+            stdout=run.PIPE,
+            wait=False,
+            )
+
+    def get_tar(self, path, to_path, sudo=False):
+        """
+        Tar a remote directory and copy it locally
+        """
+        proc = self.get_tar_stream(path, sudo=sudo)
+        with open(to_path, 'wb') as f:
+            shutil.copyfileobj(proc.stdout, f)
+        proc.exitstatus.get()
 
 
 def getShortName(name):
@@ -9,8 +9,10 @@ import gevent.event
 import pipes
 import logging
 import shutil
+import time
 
-from ..contextutil import safe_while
+from ..contextutil import MaxWhileTries
+from .. import timing
 
 log = logging.getLogger(__name__)
 
@@ -134,7 +136,9 @@ def copy_to_log(f, logger, loglevel=logging.INFO):
 
     # i can't seem to get fudge to fake an iterable, so using this old
     # api for now
+    count = 0
     for line in f.xreadlines():
+        count += len(line)
         line = line.rstrip()
         # Second part of work-around for http://tracker.ceph.com/issues/8313
         try:
@@ -142,6 +146,21 @@ def copy_to_log(f, logger, loglevel=logging.INFO):
             logger.log(loglevel, line)
         except (UnicodeDecodeError, UnicodeEncodeError):
             logger.exception("Encountered unprintable line in command output")
+    return count
+
+
+def copy_and_count(fsrc, fdst, length=16 * 1024):
+    """
+    shutil.copyfileobj that returns the number of bytes copied.
+    """
+    count = 0
+    while True:
+        buf = fsrc.read(length)
+        if not buf:
+            break
+        fdst.write(buf)
+        count += len(buf)
+    return count
 
 
 def copy_and_close(src, fdst):
@@ -161,13 +180,15 @@ def copy_file_to(f, dst):
     :param f: file to be copied.
     :param dst: destination
     :param host: original host location
+
+    Returns the number of bytes copied.
     """
     if hasattr(dst, 'log'):
         # looks like a Logger to me; not using isinstance to make life
         # easier for unit tests
         handler = copy_to_log
     else:
-        handler = shutil.copyfileobj
+        handler = copy_and_count
     return handler(f, dst)
 
 
@@ -203,6 +224,32 @@ class CommandCrashedError(Exception):
             )
 
 
+class CommandTimeoutError(MaxWhileTries):
+
+    """
+    Exception thrown when processes did not exit before a timeout.
+
+    Subclasses MaxWhileTries, which is what wait() used to raise on timeout.
+    """
+    def __init__(self, timeout, processes):
+        self.timeout = timeout
+        self.processes = processes
+
+    def __str__(self):
+        def describe(proc):
+            remote = getattr(proc, 'remote', None)
+            if remote is None:
+                return repr(proc.command)
+            return '{node}: {cmd!r}'.format(node=remote.shortname,
+                                            cmd=proc.command)
+        return "{count} command(s) still running after {timeout}s: " \
+            "{procs}".format(
+                count=len(self.processes),
+                timeout=self.timeout,
+                procs='; '.join(describe(proc) for proc in self.processes),
+                )
+
+
 class ConnectionLostError(Exception):
 
     """
@@ -316,6 +363,8 @@ def run(
     if name is None:
         name = host
 
+    start = time.time()
+    task = timing.profile.current_task()
     r = execute(client, args, name=name)
 
     r.stdin = KludgeFile(wrapped=r.stdin)
@@ -356,14 +405,20 @@ def run(
         get values needed if uninitialized.  Handle ssh issues when checking
         the status.
         """
+        output_bytes = 0
         if g_err is not None:
-            g_err.get()
+            output_bytes += g_err.get() or 0
         if g_out is not None:
-            g_out.get()
+            output_bytes += g_out.get() or 0
         if g_in is not None:
             g_in.get()
 
         status = status()
+        # daemons are kept running until their stdin is closed
+        timing.profile.record_command(
+            host=name, command=r.command, task=task,
+            duration=time.time() - start, exitstatus=status,
+            output_bytes=output_bytes, background=stdin is PIPE)
         if check_status:
             if status is None:
                 # command either died due to a signal, or the connection
@@ -395,16 +450,19 @@ def wait(processes, timeout=None):
 
     Raise if any one of them fails.
 
-    Optionally, timeout after 'timeout' seconds.
+    Optionally, timeout after 'timeout' seconds, raising a
+    CommandTimeoutError naming the processes that were still running.
     """
+    processes = list(processes)
     if timeout and timeout > 0:
-        with safe_while(tries=(timeout / 6)) as check_time:
-            not_ready = list(processes)
-            while len(not_ready) > 0:
-                check_time()
-                for proc in list(not_ready):
-                    if proc.exitstatus.ready():
-                        not_ready.remove(proc)
+        deadline = time.time() + timeout
+        for proc in processes:
+            # wakes up as soon as the process exits, rather than polling
+            proc.exitstatus.wait(timeout=max(0, deadline - time.time()))
+        not_ready = [proc for proc in processes
+                     if not proc.exitstatus.ready()]
+        if not_ready:
+            raise CommandTimeoutError(timeout=timeout, processes=not_ready)
 
     for proc in processes:
         assert isinstance(proc.exitstatus, gevent.event.AsyncResult)
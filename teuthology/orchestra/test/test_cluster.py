@@ -1,6 +1,9 @@
+from cStringIO import StringIO
+
 import fudge
 
 from .. import cluster, remote
+from .util import assert_raises
 
 
 class TestCluster(object):
@@ -77,6 +80,91 @@ class TestCluster(object):
         assert got[0] is ret1
         assert got[1] is ret2
 
+    @fudge.with_fakes
+    def test_run_all_concurrent(self):
+        fudge.clear_expectations()
+        r1 = fudge.Fake('Remote').has_attr(name='r1')
+        ret1 = fudge.Fake('RemoteProcess')
+        r1.expects('run').with_args(args=['test']).returns(ret1)
+        r2 = fudge.Fake('Remote').has_attr(name='r2')
+        ret2 = fudge.Fake('RemoteProcess')
+        r2.expects('run').with_args(args=['test']).returns(ret2)
+        c = cluster.Cluster(
+            remotes=[
+                (r1, ['foo', 'bar']),
+                (r2, ['baz']),
+                ],
+            )
+        got = c.run_all(args=['test'], max_concurrency=1)
+        assert got.processes == {r1: ret1, r2: ret2}
+        assert got.errors == {}
+        assert sorted(got.durations.keys()) == sorted([r1, r2])
+        table = got.latency_table().splitlines()
+        assert len(table) == 2
+        assert all(line.endswith(' ok') for line in table)
+
+    @fudge.with_fakes
+    def test_run_all_fail_fast(self):
+        fudge.clear_expectations()
+        r1 = fudge.Fake('Remote').has_attr(name='r1')
+        r1.expects('run').with_args(args=['test']).raises(
+            RuntimeError('boom'))
+        c = cluster.Cluster(remotes=[(r1, ['foo'])])
+        e = assert_raises(RuntimeError, c.run_all, args=['test'])
+        assert str(e) == 'boom'
+
+    @fudge.with_fakes
+    def test_run_all_collect(self):
+        fudge.clear_expectations()
+        r1 = fudge.Fake('Remote').has_attr(name='r1')
+        r1.expects('run').with_args(args=['test']).raises(
+            RuntimeError('boom'))
+        r2 = fudge.Fake('Remote').has_attr(name='r2')
+        ret2 = fudge.Fake('RemoteProcess')
+        r2.expects('run').with_args(args=['test']).returns(ret2)
+        c = cluster.Cluster(
+            remotes=[
+                (r1, ['foo']),
+                (r2, ['bar']),
+                ],
+            )
+        e = assert_raises(cluster.ClusterRunError, c.run_all, args=['test'],
+                          fail_fast=False)
+        assert e.result.processes == {r2: ret2}
+        assert e.result.errors.keys() == [r1]
+        assert str(e) == 'Command failed on 1 host(s): r1: boom'
+
+    @fudge.with_fakes
+    def test_broadcast_file(self):
+        fudge.clear_expectations()
+        r1 = fudge.Fake('Remote').has_attr(name='r1')
+        r1.expects('write_file').with_args(
+            '/etc/foo', 'data', sudo=True, mode='0600', owner=None)
+        r2 = fudge.Fake('Remote').has_attr(name='r2')
+        r2.expects('write_file').with_args(
+            '/etc/foo', 'data', sudo=True, mode='0600', owner=None)
+        c = cluster.Cluster(remotes=[(r1, ['foo']), (r2, ['bar'])])
+        c.broadcast_file('/etc/foo', StringIO('data'), sudo=True, mode='0600')
+
+    @fudge.with_fakes
+    def test_write_file_perms_need_sudo(self):
+        fudge.clear_expectations()
+        c = cluster.Cluster(remotes=[(fudge.Fake('Remote'), ['foo'])])
+        assert_raises(ValueError, c.write_file, '/tmp/foo', 'data',
+                      perms='0644')
+
+    @fudge.with_fakes
+    def test_broadcast_files(self):
+        fudge.clear_expectations()
+        files = [('/usr/bin/foo', 'foo', '0555'), ('/tmp/bar', 'bar', None)]
+        r1 = fudge.Fake('Remote').has_attr(name='r1')
+        r1.expects('write_files').with_args(files, sudo=True)
+        c = cluster.Cluster(remotes=[(r1, ['foo'])])
+        c.broadcast_files(
+            [('/usr/bin/foo', StringIO('foo'), '0555'),
+             ('/tmp/bar', 'bar', None)],
+            sudo=True)
+
     @fudge.with_fakes
     def test_only_one(self):
         fudge.clear_expectations()
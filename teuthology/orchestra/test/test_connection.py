@@ -104,3 +104,114 @@ class TestConnection(object):
             _create_key=create_key,
             )
         assert got is ssh
+
+
+class TestGetConnection(object):
+    key = ('jdoe@host.invalid', None)
+
+    def setup(self):
+        connection._connections.clear()
+        connection._holders.clear()
+
+    def teardown(self):
+        connection._connections.clear()
+        connection._holders.clear()
+
+    def make_ssh(self, active=True):
+        ssh = fudge.Fake('SSHClient')
+        transport = ssh.provides('get_transport').returns_fake()
+        transport.provides('is_active').returns(active)
+        return ssh
+
+    @fudge.with_fakes
+    def test_reuses_connection(self):
+        fudge.clear_expectations()
+        ssh = self.make_ssh()
+        connect = fudge.Fake('connect')
+        connect.expects_call().with_args(
+            user_at_host='jdoe@host.invalid',
+            host_key=None,
+            keep_alive=False,
+        ).times_called(1).returns(ssh)
+        got1 = connection.get_connection('jdoe@host.invalid',
+                                         _connect=connect)
+        # keepalives are turned on for the caller that asks for them
+        ssh.get_transport().expects('set_keepalive').with_args(True)
+        got2 = connection.get_connection('jdoe@host.invalid',
+                                         keep_alive=True, _connect=connect)
+        assert got1 is ssh
+        assert got2 is ssh
+        assert connection._holders[ssh] == 2
+
+    @fudge.with_fakes
+    def test_host_key(self):
+        fudge.clear_expectations()
+        ssh = self.make_ssh()
+        connection._connections[self.key] = ssh
+        other = self.make_ssh()
+        connect = fudge.Fake('connect')
+        connect.expects_call().with_args(
+            user_at_host='jdoe@host.invalid',
+            host_key='ssh-rsa key',
+            keep_alive=False,
+        ).returns(other)
+        got = connection.get_connection('jdoe@host.invalid',
+                                        host_key='ssh-rsa key',
+                                        _connect=connect)
+        assert got is other
+
+    @fudge.with_fakes
+    def test_reconnects_when_inactive(self):
+        fudge.clear_expectations()
+        dead = self.make_ssh(active=False)
+        dead.expects('close')
+        connection._connections[self.key] = dead
+        ssh = self.make_ssh()
+        connect = fudge.Fake('connect')
+        connect.expects_call().returns(ssh)
+        got = connection.get_connection('jdoe@host.invalid', _connect=connect)
+        assert got is ssh
+        assert connection._connections[self.key] is ssh
+
+    @fudge.with_fakes
+    def test_release_connection(self):
+        fudge.clear_expectations()
+        ssh = self.make_ssh()
+        connect = fudge.Fake('connect')
+        connect.expects_call().returns(ssh)
+        for i in range(3):
+            connection.get_connection('jdoe@host.invalid', _connect=connect)
+        # still handed out, so left open
+        connection.release_connection(ssh)
+        assert connection._connections[self.key] is ssh
+        # forgotten, but still held by someone else
+        connection.release_connection(ssh, forget=True)
+        assert self.key not in connection._connections
+        # closed by the last holder
+        ssh.expects('close')
+        connection.release_connection(ssh)
+        assert ssh not in connection._holders
+
+    @fudge.with_fakes
+    def test_release_replaced(self):
+        fudge.clear_expectations()
+        ssh = self.make_ssh()
+        connection._connections[self.key] = ssh
+        connection._holders[ssh] = 1
+        # one that was replaced after the host was rebooted
+        other = self.make_ssh()
+        other.expects('close')
+        connection.release_connection(other, forget=True)
+        assert connection._connections[self.key] is ssh
+        del connection._connections[self.key]
+        ssh.expects('close')
+        connection.release_connection(ssh, forget=True)
+
+    @fudge.with_fakes
+    def test_close_connection(self):
+        fudge.clear_expectations()
+        ssh = self.make_ssh()
+        ssh.expects('close')
+        connection._connections[self.key] = ssh
+        connection.close_connection('jdoe@host.invalid')
+        assert self.key not in connection._connections
@@ -1,3 +1,6 @@
+import tarfile
+from cStringIO import StringIO
+
 import fudge
 import fudge.inspector
 
@@ -56,3 +59,110 @@ class TestRemote(object):
             )
         assert got is ret
         assert got.remote is r
+
+
+class TestWriteFile(object):
+    def setup(self):
+        self.runs = []
+        self.remote = remote.Remote(name='jdoe@xyzzy.example.com',
+                                    ssh=fudge.Fake('SSHConnection'))
+        self.remote.run = self.run
+
+    def run(self, args, stdin):
+        self.runs.append((args, stdin.read()))
+
+    @fudge.with_fakes
+    def test_sftp(self):
+        fudge.clear_expectations()
+        written = []
+        remote_file = fudge.Fake('SFTPFile')
+        remote_file.provides('write').calls(written.append)
+        remote_file.expects('close')
+        sftp = fudge.Fake('SFTPClient').has_attr(
+            sock=fudge.Fake('Channel').has_attr(closed=False))
+        sftp.expects('open').with_args('/tmp/foo', 'wb').returns(remote_file)
+        sftp.expects('chmod').with_args('/tmp/foo', 0600)
+        self.remote._sftp = sftp
+        self.remote.write_file('/tmp/foo', 'data', mode='0600')
+        assert ''.join(written) == 'data'
+        assert self.runs == []
+
+    def test_owner_needs_sudo(self):
+        try:
+            self.remote.write_file('/tmp/foo', 'data', owner='root')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('ValueError not raised')
+
+    def test_sudo(self):
+        self.remote.write_file('/etc/foo', 'data', sudo=True, mode='0600',
+                               owner='ceph:ceph')
+        assert self.runs == [
+            (['sudo', 'install', '-m', '0600', '-o', 'ceph', '-g', 'ceph',
+              '/dev/stdin', '/etc/foo'], 'data'),
+            ]
+
+    def test_sudo_in_place(self):
+        self.remote.write_file('/etc/foo', 'data', sudo=True)
+        [(args, data)] = self.runs
+        assert args[:3] == ['sudo', 'tee', '/etc/foo']
+        assert args[3].value == '>/dev/null'
+        assert data == 'data'
+
+    def test_write_files(self):
+        self.remote.write_files(
+            [('/usr/bin/foo', 'foo', '0555'), ('/tmp/bar', 'bar', None)],
+            sudo=True)
+        args, data = self.runs[0]
+        assert args[:2] == ['sudo', 'tar']
+        tar = tarfile.open(fileobj=StringIO(data))
+        members = [(m.name, m.mode) for m in tar.getmembers()]
+        assert members == [('usr/bin/foo', 0555), ('tmp/bar', 0644)]
+        assert tar.extractfile('usr/bin/foo').read() == 'foo'
+
+
+class TestFacts(object):
+    output = '\n'.join([
+        'distro Ubuntu',
+        'distro_version 12.04',
+        'codename precise',
+        'arch x86_64',
+        'kernel 3.13.0-ceph',
+        'scratch_candidates /dev/sdb',
+        'scratch_candidates /dev/sdc',
+        'scratch_readable /dev/sdb',
+        '',
+        ])
+
+    def setup(self):
+        self.runs = 0
+        self.remote = remote.Remote(name='jdoe@xyzzy.example.com',
+                                    ssh=fudge.Fake('SSHConnection'))
+        self.remote.run = self.run
+
+    def run(self, args, stdout):
+        self.runs += 1
+        stdout.write(self.output)
+        return RemoteProcess(command=args, stdin=None, stdout=stdout,
+                             stderr=None, exitstatus=None, exited=None)
+
+    def test_facts(self):
+        assert self.remote.facts == dict(
+            distro='Ubuntu',
+            distro_version='12.04',
+            codename='precise',
+            arch='x86_64',
+            kernel='3.13.0-ceph',
+            scratch_candidates=['/dev/sdb', '/dev/sdc'],
+            scratch_readable=['/dev/sdb'],
+            )
+        assert self.remote.system_type == 'deb'
+
+    def test_cached(self):
+        self.remote.facts
+        self.remote.facts
+        assert self.runs == 1
+        self.remote.invalidate_facts()
+        self.remote.facts
+        assert self.runs == 2
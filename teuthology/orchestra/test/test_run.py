@@ -1,15 +1,25 @@
 from cStringIO import StringIO
 
 import fudge
+import gevent
 import gevent.event
 import logging
+import time
 
 from .. import run
+from ... import timing
 
 from .util import assert_raises
 
 
 class TestRun(object):
+    def setup(self):
+        self.orig_profile = timing.profile
+        timing.profile = timing.Profile()
+
+    def teardown(self):
+        timing.profile = self.orig_profile
+
     @fudge.with_fakes
     def test_run_log_simple(self):
         fudge.clear_expectations()
@@ -117,6 +127,9 @@ class TestRun(object):
         assert e.command == 'foo'
         assert e.exitstatus == 42
         assert str(e) == "Command failed on HOST with status 42: 'foo'"
+        # waited for along with others, so not a daemon
+        assert timing.profile.commands == 1
+        assert timing.profile.background_commands == 0
 
     @fudge.with_fakes
     def test_run_status_bad_nocheck(self):
@@ -319,6 +332,8 @@ class TestRun(object):
         assert r.exitstatus.ready() == False
         got = r.exitstatus.get()
         assert got == 0
+        assert timing.profile.commands == 0
+        assert timing.profile.background_commands == 1
 
     @fudge.with_fakes
     def test_run_stdout_pipe(self):
@@ -404,3 +419,43 @@ class TestRun(object):
     def test_quote_and_raw(self):
         got = run.quote(['true', run.Raw('&&'), 'echo', 'yay'])
         assert got == "true && echo yay"
+
+
+class TestWait(object):
+    def make_proc(self, command):
+        proc = run.RemoteProcess(
+            command=command,
+            stdin=None,
+            stdout=None,
+            stderr=None,
+            exitstatus=gevent.event.AsyncResult(),
+            exited=None,
+            )
+        return proc
+
+    def test_wait_wakes_on_exit(self):
+        proc = self.make_proc('foo')
+        gevent.spawn_later(0.01, proc.exitstatus.set, 0)
+        start = time.time()
+        run.wait([proc], timeout=60)
+        assert time.time() - start < 5
+        assert proc.exitstatus.get() == 0
+
+    def test_wait_timeout(self):
+        done = self.make_proc('done')
+        done.exitstatus.set(0)
+        stuck = self.make_proc('stuck')
+        e = assert_raises(
+            run.CommandTimeoutError,
+            run.wait,
+            [done, stuck],
+            timeout=0.01,
+            )
+        assert e.processes == [stuck]
+        assert str(e) == "1 command(s) still running after 0.01s: 'stuck'"
+
+    def test_wait_raises_failure(self):
+        proc = self.make_proc('foo')
+        proc.exitstatus.set_exception(
+            run.CommandFailedError(command='foo', exitstatus=1, node='HOST'))
+        assert_raises(run.CommandFailedError, run.wait, [proc], timeout=60)
@@ -54,10 +54,20 @@ class parallel(object):
     At the end of the with block, the main thread waits until all
     spawned functions have completed, or, if one exited with an exception,
     kills the rest and raises the exception.
+
+    To limit how many functions run at once, pass ``size``; spawn() will
+    then block until a slot is free::
+
+        with parallel(size=2) as p:
+            for dev in devs:
+                p.spawn(mkfs, dev)
     """
 
-    def __init__(self):
-        self.group = gevent.pool.Group()
+    def __init__(self, size=None):
+        if size:
+            self.group = gevent.pool.Pool(size)
+        else:
+            self.group = gevent.pool.Group()
         self.results = gevent.queue.Queue()
         self.count = 0
         self.any_spawned = False
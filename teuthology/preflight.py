@@ -0,0 +1,169 @@
+"""
+Run a series of shell steps on many hosts with one remote command per host,
+and get back each step's exit status and output.
+"""
+import collections
+import logging
+import re
+import uuid
+from cStringIO import StringIO
+
+from .orchestra import run
+from .parallel import parallel
+
+log = logging.getLogger(__name__)
+
+
+StepResult = collections.namedtuple('StepResult', ['exitstatus', 'output'])
+
+
+class Step(object):
+    """
+    One command in a `StepScript`.
+
+    :param name:  Identifies the step in the results; no whitespace
+    :param args:  The command: a list of arguments as for `Remote.run`, or a
+                  shell string
+    :param stdin: A str to feed to the command on stdin. If it is a chain of
+                  commands, only the last one gets it.
+    :param fatal: If the step fails, don't run the steps after it
+    """
+    def __init__(self, name, args, stdin=None, fatal=True):
+        assert not re.search(r'\s', name), \
+            "step names can't contain whitespace: {name!r}".format(name=name)
+        self.name = name
+        self.args = args
+        self.stdin = stdin
+        self.fatal = fatal
+
+    @property
+    def command(self):
+        if isinstance(self.args, basestring):
+            return self.args
+        return run.quote(self.args)
+
+
+class StepScript(object):
+    """
+    A shell script made of `Step` objects. Each step's stdout and stderr are
+    captured together, and steps never read the script's own stdin, which
+    is where the script itself is fed to the remote shell.
+    """
+    def __init__(self, steps=None):
+        self.steps = list(steps or [])
+        # delimits step output, and any stdin given to steps
+        self.marker = 'teuthology-step-{id}'.format(id=uuid.uuid4().hex)
+
+    def add(self, name, args, stdin=None, fatal=True):
+        self.steps.append(Step(name, args, stdin=stdin, fatal=fatal))
+
+    def get(self, name):
+        for step in self.steps:
+            if step.name == name:
+                return step
+
+    def __len__(self):
+        return len(self.steps)
+
+    def render(self):
+        """
+        :returns: The script, as a str
+        """
+        lines = []
+        for step in self.steps:
+            lines.append(run.quote(
+                ['printf', '%s start %s\\n', self.marker, step.name]))
+            command = step.command
+            if step.stdin is not None:
+                stdin = step.stdin
+                if not stdin.endswith('\n'):
+                    stdin += '\n'
+                command = "{command} <<'{marker}'\n{stdin}{marker}".format(
+                    command=command, marker=self.marker, stdin=stdin)
+            lines.append('(\n{command}\n) </dev/null 2>&1'.format(
+                command=command))
+            lines.append('rc=$?')
+            lines.append(run.quote(
+                ['printf', '\\n%s end %s %d\\n', self.marker, step.name,
+                 run.Raw('$rc')]))
+            if step.fatal:
+                lines.append('[ $rc -eq 0 ] || exit 0')
+        return '\n'.join(lines) + '\n'
+
+    def parse(self, output):
+        """
+        :returns: An OrderedDict of step name -> StepResult, for the steps
+                  that ran
+        """
+        pattern = re.compile(
+            r'^{marker} start (\S+)\n(.*?)\n{marker} end \1 (\d+)$'.format(
+                marker=re.escape(self.marker)),
+            re.MULTILINE | re.DOTALL)
+        results = collections.OrderedDict()
+        for match in pattern.finditer(output):
+            results[match.group(1)] = StepResult(
+                exitstatus=int(match.group(3)), output=match.group(2))
+        return results
+
+    def run(self, remote):
+        """
+        Run the script on remote. It is fed to sh on stdin, so that the
+        remote command that gets logged is short however long the steps and
+        their stdin are.
+
+        :returns: See `parse`
+        """
+        log.debug('%s: running %s', remote.shortname,
+                  ', '.join(step.name for step in self.steps))
+        proc = remote.run(
+            args=['sh', '-s'],
+            stdin=self.render(),
+            stdout=StringIO(),
+            )
+        results = self.parse(proc.stdout.getvalue())
+        for name, result in results.iteritems():
+            if result.output:
+                log.debug('%s: %s: %s', remote.shortname, name,
+                          result.output.rstrip('\n'))
+        return results
+
+
+def run_scripts(scripts):
+    """
+    Run a `StepScript` on each of several remotes, concurrently.
+
+    :param scripts: dict of remote -> StepScript
+    :returns: dict of remote -> results, as from `StepScript.parse`
+    """
+    def _run(remote, script):
+        return remote, script.run(remote)
+
+    results = {}
+    with parallel() as p:
+        for remote, script in scripts.iteritems():
+            if len(script):
+                p.spawn(_run, remote, script)
+        for remote, result in p:
+            results[remote] = result
+    return results
+
+
+def raise_for_failure(scripts, results, ignore=()):
+    """
+    Raise CommandFailedError for the first failed step, checking the hosts
+    in name order.
+
+    :param scripts: dict of remote -> the StepScript that was run there
+    :param results: As returned by `run_scripts`
+    :param ignore:  Names of steps whose failure is not an error
+    """
+    for remote in sorted(results, key=lambda remote: remote.name):
+        for name, result in results[remote].iteritems():
+            if result.exitstatus != 0 and name not in ignore:
+                log.error('%s: %s failed: %s', remote.shortname, name,
+                          result.output.rstrip('\n'))
+                raise run.CommandFailedError(
+                    command=scripts[remote].get(name).command,
+                    exitstatus=result.exitstatus,
+                    node=remote.name,
+                    )
@@ -1,13 +1,27 @@
 import os
 import yaml
+import atexit
+import contextlib
+import errno
+import fcntl
+import itertools
 import json
-import re
+import random
 import requests
 import logging
 import socket
+import time
+import urllib
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 
+import gevent
+import gevent.event
+import gevent.pool
+
 import teuthology
+from . import archive
 from .config import config
 
 report_exceptions = (requests.exceptions.RequestException, socket.error)
@@ -129,18 +143,14 @@ class ResultsSerializer(object):
         :param run_name: The name of the run.
         :returns:        A dict like: {'1': '/path/to/1', '2': 'path/to/2'}
         """
+        return self._jobs_for_run(run_name)
+
+    def _jobs_for_run(self, run_name, status=None):
         archive_dir = os.path.join(self.archive_base, run_name)
         if not os.path.isdir(archive_dir):
             return {}
-        jobs = {}
-        for item in os.listdir(archive_dir):
-            if not re.match('\d+$', item):
-                continue
-            job_id = item
-            job_dir = os.path.join(archive_dir, job_id)
-            if os.path.isdir(job_dir):
-                jobs[job_id] = job_dir
-        return jobs
+        return dict((job['job_id'], os.path.join(archive_dir, job['job_id']))
+                    for job in archive.run_jobs(archive_dir, status=status))
 
     def running_jobs_for_run(self, run_name):
         """
@@ -149,11 +159,7 @@ class ResultsSerializer(object):
         :param run_name: The name of the run.
         :returns:        A dict like: {'1': '/path/to/1', '2': 'path/to/2'}
         """
-        jobs = self.jobs_for_run(run_name)
-        for job_id in jobs.keys():
-            if os.path.exists(os.path.join(jobs[job_id], 'summary.yaml')):
-                jobs.pop(job_id)
-        return jobs
+        return self._jobs_for_run(run_name, status='running')
 
     @property
     def all_runs(self):
@@ -174,19 +180,28 @@ class ResultsSerializer(object):
 
 class ResultsReporter(object):
     last_run_file = 'last_successful_run'
+    # How many job documents go into each request to the batch endpoint
+    batch_size = 100
 
     def __init__(self, archive_base=None, base_uri=None, save=False,
-                 refresh=False, log=None):
+                 refresh=False, log=None, concurrency=None):
         self.log = log or init_logging()
         self.archive_base = archive_base or config.archive_base
         self.base_uri = base_uri or config.results_server
         if self.base_uri:
             self.base_uri = self.base_uri.rstrip('/')
 
-        self.serializer = ResultsSerializer(archive_base, log=self.log)
+        self.serializer = ResultsSerializer(self.archive_base, log=self.log)
         self.save_last_run = save
         self.refresh = refresh
         self.session = self._make_session()
+        # How many jobs are POSTed at once when the server can't take batches
+        self.concurrency = concurrency or config.results_concurrency
+        self.sessions = [self.session]
+        # None until we find out whether the server has the batch endpoint
+        self.batch_supported = None
+        # runs we have posted jobs to, so know to exist; see post_batch()
+        self.known_runs = set()
 
         if not self.base_uri:
             msg = "No results_server set in {yaml}; cannot report results"
@@ -220,13 +235,16 @@ class ResultsReporter(object):
         num_runs = len(run_names)
         num_jobs = 0
         self.log.info("Posting %s runs", num_runs)
+        start = time.time()
         for run in run_names:
             job_count = self.report_run(run)
             num_jobs += job_count
             if self.save_last_run:
                 self.last_run = run
         del self.last_run
-        self.log.info("Total: %s jobs in %s runs", num_jobs, len(run_names))
+        elapsed = time.time() - start
+        self.log.info("Total: %s jobs in %s runs (%.1f jobs/sec)", num_jobs,
+                      len(run_names), num_jobs / max(elapsed, 0.001))
 
     def report_run(self, run_name, dead=False):
         """
@@ -260,10 +278,124 @@ class ResultsReporter(object):
         :param run_name: The name of the run.
         :param job_ids:  The jobs' ids
         """
-        for job_id in job_ids:
-            self.report_job(run_name, job_id, dead=dead)
+        job_infos = (self.serializer.job_info(run_name, job_id)
+                     for job_id in job_ids)
+        if dead:
+            job_infos = (self._mark_dead(job_info) for job_info in job_infos)
+        start = time.time()
+        count = self.post_jobs(run_name, job_infos)
+        self.log.debug("    %s jobs in %.1fs", count, time.time() - start)
+
+    @staticmethod
+    def _mark_dead(job_info):
+        if job_info.get('success') is None:
+            job_info['status'] = 'dead'
+        return job_info
+
+    def post_jobs(self, run_name, job_infos):
+        """
+        Report several jobs of a run, given their info dicts. They are sent
+        batch_size at a time if the server has a batch endpoint, and
+        otherwise one per request with up to self.concurrency requests in
+        flight.
+
+        :param run_name:  The name of the run.
+        :param job_infos: An iterable of job info dicts, each with a job_id
+        :returns:         The number of jobs reported
+        """
+        job_infos = iter(job_infos)
+        count = 0
+        while self.batch_supported is not False:
+            batch = []
+            for job_info in job_infos:
+                batch.append(job_info)
+                if len(batch) >= self.batch_size:
+                    break
+            if not batch:
+                return count
+            if not self.post_batch(run_name, batch):
+                if self.batch_supported is False:
+                    job_infos = itertools.chain(batch, job_infos)
+                    break
+                # maybe just because the run doesn't exist yet; posting the
+                # jobs one at a time creates it
+                count += self.post_individually(run_name, batch)
+                if self.batch_supported is None:
+                    self.probe_batch(run_name)
+                continue
+            count += len(batch)
+        return count + self.post_individually(run_name, job_infos)
+
+    def post_individually(self, run_name, job_infos):
+        """
+        Report several jobs of a run with one request each, up to
+        self.concurrency at once.
+
+        :returns: The number of jobs reported
+        """
+        count = 0
+        pool = gevent.pool.Pool(self.concurrency)
+
+        def report(job_info):
+            session = (self.sessions.pop() if self.sessions
+                       else self._make_session())
+            try:
+                self.report_job(run_name, str(job_info['job_id']), job_info,
+                                session=session)
+            finally:
+                self.sessions.append(session)
+
+        for _ in pool.imap_unordered(report, job_infos):
+            count += 1
+        self.known_runs.add(run_name)
+        return count
+
+    def post_batch(self, run_name, job_infos):
+        """
+        POST several jobs, creating or replacing them, in a single request.
+
+        A 404 means either that the server has no batch endpoint, or that it
+        doesn't know the run yet. Only once the run is known to exist does a
+        404 stop us from trying batches again; 405 and 501 always do.
+
+        :returns: False if the jobs weren't posted
+        """
+        uri = "{base}/runs/{name}/jobs/batch/".format(
+            base=self.base_uri, name=run_name)
+        headers = {'content-type': 'application/json'}
+        response = self.session.post(uri, data=json.dumps(job_infos),
+                                     headers=headers)
+        if response.status_code in (405, 501) or (
+                response.status_code == 404 and run_name in self.known_runs):
+            if self.batch_supported is None:
+                self.log.debug("No batch endpoint at %s; posting jobs "
+                               "individually", uri)
+            self.batch_supported = False
+            return False
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        self.batch_supported = True
+        self.known_runs.add(run_name)
+        return True
 
-    def report_job(self, run_name, job_id, job_info=None, dead=False):
+    def probe_batch(self, run_name):
+        """
+        Find out whether the server has the batch endpoint, once a batch
+        POST for a run that didn't exist yet got a 404: a HEAD request to the
+        endpoint for the run, which exists now, only gets a 404 if the
+        endpoint is missing.
+        """
+        uri = "{base}/runs/{name}/jobs/batch/".format(
+            base=self.base_uri, name=run_name)
+        response = self.session.head(uri)
+        self.batch_supported = response.status_code != 404
+        if not self.batch_supported:
+            self.log.debug("No batch endpoint at %s; posting jobs "
+                           "individually", uri)
+
+    def report_job(self, run_name, job_id, job_info=None, dead=False,
+                   session=None):
         """
         Report a single job to the results server.
 
@@ -271,18 +403,21 @@ class ResultsReporter(object):
         :param job_id:   The job's id
         :param job_info: The job's info dict. Optional - if not present, we
                          look at the archive.
+        :param session:  The requests.Session to use. Defaults to
+                         self.session.
         """
         if job_info is not None and not isinstance(job_info, dict):
             raise TypeError("job_info must be a dict")
+        session = session or self.session
         run_uri = "{base}/runs/{name}/jobs/".format(
             base=self.base_uri, name=run_name,)
         if job_info is None:
             job_info = self.serializer.job_info(run_name, job_id)
-        if dead and job_info.get('success') is None:
-            job_info['status'] = 'dead'
+        if dead:
+            self._mark_dead(job_info)
         job_json = json.dumps(job_info)
         headers = {'content-type': 'application/json'}
-        response = self.session.post(run_uri, data=job_json, headers=headers)
+        response = session.post(run_uri, data=job_json, headers=headers)
 
         if response.status_code == 200:
             return job_id
@@ -301,8 +436,7 @@ class ResultsReporter(object):
 
         if msg and msg.endswith('already exists'):
             job_uri = os.path.join(run_uri, job_id, '')
-            response = self.session.put(job_uri, data=job_json,
-                                        headers=headers)
+            response = session.put(job_uri, data=job_json, headers=headers)
         elif msg:
             self.log.error(
                 "POST to {uri} failed with status {status}: {msg}".format(
@@ -386,6 +520,7 @@ class ResultsReporter(object):
         """
         uri = "{base}/runs/{name}/".format(
             base=self.base_uri, name=run_name)
+        self.known_runs.discard(run_name)
         response = self.session.delete(uri)
         response.raise_for_status()
 
@@ -406,39 +541,420 @@ def push_job_info(run_name, job_id, job_info, base_uri=None):
     reporter.report_job(run_name, job_id, job_info)
 
 
+def coalesce_job_info(pending, update):
+    """
+    Merge an update for a job into one that hasn't been sent yet.
+
+    A job's status follows from its 'success' once it has finished, so a
+    final update drops the pending 'running' or 'queued' status, and a 'dead'
+    status doesn't override a result that is already known - just like the
+    results server ignores 'dead' for jobs that passed or failed.
+    """
+    merged = pending.copy()
+    update = update.copy()
+    if update.get('success') is not None and 'status' not in update:
+        merged.pop('status', None)
+    if update.get('status') == 'dead' and \
+            merged.get('success') is not None:
+        update.pop('status')
+    merged.update(update)
+    return merged
+
+
+class PushQueue(object):
+    """
+    Push job info to the results server from a background greenlet, so that
+    a slow or unreachable server doesn't hold up the caller.
+
+    Updates are spooled to disk first, one file per job: a new update for a
+    job whose last one hasn't been sent yet is merged into it. The sender
+    sends everything in the spool - including what other processes, or this
+    one before an outage, left there - and backs off exponentially while the
+    server can't be reached.
+
+    Every queue sharing a spool may send its updates, so a sender first
+    claims what it is about to send by renaming it. A job's update is not
+    claimed while an older one is being sent by another queue, so that the
+    older one can't overwrite it on the server. Claims of processes that
+    died are taken back.
+    """
+    # seconds to wait after the first failure; doubled for each one after it
+    retry_backoff = 5
+    max_backoff = 300
+    # how often to look for updates spooled by other processes
+    poll_interval = 60
+    # how long flush() waits for this process's updates to be sent
+    flush_timeout = 30
+    # how soon to try again to send updates another queue was sending
+    claim_retry = 1
+
+    def __init__(self, spool_dir=None, reporter=None):
+        self.spool_dir = spool_dir or config.results_spool or os.path.join(
+            os.path.expanduser('~'), '.teuthology-results-spool')
+        try:
+            os.makedirs(self.spool_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.log = init_logging()
+        self._reporter = reporter
+        self.wakeup = gevent.event.Event()
+        self.sender = None
+        # identifies this queue's claims; see _claim()
+        self.owner = '{pid}-{id}'.format(pid=os.getpid(),
+                                         id=uuid.uuid4().hex)
+        # whether updates were left unclaimed because another queue was
+        # sending the job's previous one
+        self.blocked = False
+        # paths this process put updates in, that haven't been sent yet
+        self.unsent = set()
+        self.sent = 0
+        self.failures = 0
+        # whether flush() ran since the last put()
+        self.flushed = False
+
+    @property
+    def reporter(self):
+        if self._reporter is None:
+            self._reporter = ResultsReporter()
+        return self._reporter
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the spool's lock. The lock is taken without blocking the other
+        greenlets of this process.
+        """
+        with file(os.path.join(self.spool_dir, '.lock'), 'w') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    gevent.sleep(0.01)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _path(self, run_name, job_id):
+        return os.path.join(self.spool_dir, '{run}.{job}.json'.format(
+            run=urllib.quote(run_name, safe=''), job=job_id))
+
+    def _read(self, path):
+        try:
+            with file(path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            self.log.warning("Ignoring unreadable spool file %s", path)
+            os.remove(path)
+
+    def _spooled(self, path):
+        """
+        Whether an update for path is spooled, or being sent.
+        """
+        if os.path.exists(path):
+            return True
+        prefix = os.path.basename(path) + '.sending.'
+        return any(name.startswith(prefix)
+                   for name in os.listdir(self.spool_dir))
+
+    def pending(self):
+        """
+        The spooled updates, oldest first.
+
+        :returns: A list of (path, entry) tuples. Each entry is a dict with
+                  the job_info to send and when it was first queued.
+        """
+        entries = []
+        for name in os.listdir(self.spool_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            entry = self._read(path)
+            if entry is not None:
+                entries.append((path, entry))
+        entries.sort(key=lambda item: item[1]['queued'])
+        return entries
+
+    def put(self, job_info):
+        """
+        Queue an update for a job; job_info must contain name and job_id.
+        """
+        path = self._path(job_info['name'], job_info['job_id'])
+        with self._locked():
+            entry = self._read(path)
+            if entry is None:
+                entry = dict(queued=time.time(), job_info=job_info)
+            else:
+                entry['job_info'] = coalesce_job_info(entry['job_info'],
+                                                      job_info)
+            tmp_path = path + '.tmp'
+            with file(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.rename(tmp_path, path)
+        self.unsent.add(path)
+        self.flushed = False
+        self.start()
+        self.wakeup.set()
+
+    def start(self):
+        if self.sender is None or self.sender.dead:
+            self.sender = gevent.spawn(self._run)
+
+    @staticmethod
+    def _owner_alive(owner):
+        pid = int(owner.split('-', 1)[0])
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _claim(self):
+        """
+        Claim the spooled updates to send them, by renaming each from
+        <path> to <path>.sending.<owner>.
+
+        :returns: A list of (path, entry) tuples, oldest first
+        """
+        claimed = []
+        with self._locked():
+            busy = set()
+            for name in os.listdir(self.spool_dir):
+                base, sep, owner = name.rpartition('.sending.')
+                if not sep or not base.endswith('.json') or '.' in owner:
+                    continue
+                path = os.path.join(self.spool_dir, base)
+                if self._owner_alive(owner):
+                    busy.add(path)
+                else:
+                    self.log.info("Taking back updates claimed by %s", owner)
+                    self._unclaim(path, os.path.join(self.spool_dir, name))
+            self.blocked = False
+            for path, entry in self.pending():
+                if path in busy:
+                    self.blocked = True
+                    continue
+                os.rename(path, self._claim_path(path))
+                claimed.append((path, entry))
+        return claimed
+
+    def _claim_path(self, path):
+        return '{path}.sending.{owner}'.format(path=path, owner=self.owner)
+
+    def _unclaim(self, path, claim_path):
+        """
+        Put a claimed update back in the spool, merging into it any update
+        for the same job that was queued while it was claimed. The spool
+        must be locked.
+        """
+        entry = self._read(claim_path)
+        if entry is None:
+            return
+        newer = self._read(path)
+        if newer is not None:
+            entry['job_info'] = coalesce_job_info(entry['job_info'],
+                                                  newer['job_info'])
+        tmp_path = path + '.tmp'
+        with file(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, path)
+        os.remove(claim_path)
+
+    def send_pending(self):
+        """
+        Send what's in the spool, run by run, removing what was sent.
+
+        :returns: The number of updates sent
+        """
+        runs = OrderedDict()
+        for path, entry in self._claim():
+            runs.setdefault(entry['job_info']['name'], []).append(
+                (path, entry))
+        runs = runs.items()
+        count = 0
+        done = 0
+        try:
+            for run_name, entries in runs:
+                try:
+                    self.reporter.post_jobs(
+                        run_name, [entry['job_info'] for _, entry in entries])
+                except requests.exceptions.HTTPError as e:
+                    status = e.response.status_code \
+                        if e.response is not None else None
+                    if status is None or status >= 500:
+                        raise
+                    # retrying won't help
+                    self.log.error("Dropping %s updates for run %s: %s",
+                                   len(entries), run_name, e)
+                else:
+                    count += len(entries)
+                self._remove(entries)
+                done += 1
+        finally:
+            if done < len(runs):
+                # leave the rest for the next attempt, by any queue
+                with self._locked():
+                    for _, entries in runs[done:]:
+                        for path, _ in entries:
+                            self._unclaim(path, self._claim_path(path))
+            self.sent += count
+        return count
+
+    def _remove(self, entries):
+        with self._locked():
+            for path, _ in entries:
+                os.remove(self._claim_path(path))
+                self.unsent.discard(path)
+
+    def _run(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                self.send_pending()
+            except report_exceptions:
+                self.failures += 1
+                delay = min(self.max_backoff,
+                            self.retry_backoff * 2 ** (self.failures - 1))
+                delay *= random.uniform(0.5, 1.5)
+                stats = self.stats()
+                self.log.warning(
+                    "Could not report results to %s; %s updates queued, the "
+                    "oldest %ds ago. Retrying in %ds", self.reporter.base_uri,
+                    stats['depth'], stats['lag'], delay, exc_info=True)
+                # flush() cuts this short
+                self.wakeup.wait(timeout=delay)
+                continue
+            except Exception:
+                self.log.exception("Error sending queued results")
+                gevent.sleep(self.max_backoff)
+                continue
+            self.failures = 0
+            self.wakeup.wait(timeout=self.claim_retry if self.blocked
+                             else self.poll_interval)
+
+    def flush(self, timeout=None):
+        """
+        Wait for the updates this process queued to be sent, trying once
+        more straight away if sending them failed before. If that attempt
+        fails too, don't wait any longer: the updates stay in the spool for
+        the next process that reports results.
+
+        :returns: True if they all were sent, False if they weren't
+        """
+        if timeout is None:
+            timeout = self.flush_timeout
+        self.flushed = True
+        self.unsent = set(path for path in self.unsent
+                          if self._spooled(path))
+        if not self.unsent:
+            return True
+        failures = self.failures
+        self.start()
+        self.wakeup.set()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.unsent = set(path for path in self.unsent
+                              if self._spooled(path))
+            if not self.unsent:
+                return True
+            if self.failures > failures:
+                break
+            gevent.sleep(0.1)
+        self.log.warning(
+            "%s results updates not sent yet; they are spooled in %s",
+            len(self.unsent), self.spool_dir)
+        return False
+
+    def stats(self):
+        """
+        :returns: A dict with the number of spooled updates (depth), the age
+                  of the oldest in seconds (lag), how many updates this
+                  process sent (sent) and how many sends in a row failed
+                  (failures)
+        """
+        entries = self.pending()
+        lag = time.time() - entries[0][1]['queued'] if entries else 0
+        return dict(depth=len(entries), lag=lag, sent=self.sent,
+                    failures=self.failures)
+
+
+_push_queue = None
+
+
+def get_push_queue():
+    """
+    The process's PushQueue. It is flushed when the process exits, unless it
+    was flushed already.
+    """
+    global _push_queue
+    if _push_queue is None:
+        _push_queue = PushQueue()
+        atexit.register(_flush_at_exit)
+    return _push_queue
+
+
+def _flush_at_exit():
+    if _push_queue is not None and not _push_queue.flushed:
+        _push_queue.flush()
+
+
+def flush_push_queue(timeout=None):
+    if _push_queue is not None:
+        return _push_queue.flush(timeout)
+    return True
+
+
 def try_push_job_info(job_config, extra_info=None):
     """
-    Wrap push_job_info, gracefully doing nothing if:
-        Anything inheriting from requests.exceptions.RequestException is raised
-        A socket.error is raised
+    Queue job info to be pushed to the results server in the background,
+    gracefully doing nothing if:
         config.results_server is not set
         config['job_id'] is not present or is None
+    Failures to reach the results server are retried by the PushQueue.
 
     :param job_config: The ctx.config object to push
     :param extra_info: Optional second dict to push
     """
-    log = init_logging()
+    try_push_jobs_info([job_config], extra_info)
 
-    if job_config.get('job_id') is None:
-        log.warning('No job_id found; not reporting results')
-        return
 
-    run_name = job_config['name']
-    job_id = job_config['job_id']
+def try_push_jobs_info(job_configs, extra_info=None):
+    """
+    Like try_push_job_info(), but for several jobs at once. The queue sends
+    them in batches if the results server allows it.
 
-    if extra_info is not None:
-        job_info = extra_info.copy()
-        job_info.update(job_config)
-    else:
-        job_info = job_config
+    :param job_configs: A list of job config dicts, each with a job_id
+    :param extra_info:  Optional dict to push along with every job
+    """
+    log = init_logging()
 
-    try:
-        log.debug("Pushing job info to %s", config.results_server)
-        push_job_info(run_name, job_id, job_info)
+    if not config.results_server:
         return
-    except report_exceptions:
-        log.exception("Could not report results to %s",
-                      config.results_server)
+
+    log.debug("Queueing info for %s jobs for %s", len(job_configs),
+              config.results_server)
+    for job_config in job_configs:
+        if job_config.get('job_id') is None:
+            log.warning('No job_id found; not reporting results')
+            continue
+        if extra_info is not None:
+            job_info = extra_info.copy()
+            job_info.update(job_config)
+        else:
+            job_info = job_config
+        try:
+            get_push_queue().put(job_info)
+        except (IOError, OSError):
+            log.exception("Could not queue results for %s",
+                          config.results_server)
+            return
 
 
 def try_delete_jobs(run_name, job_ids, delete_empty_run=True):
@@ -1,15 +1,14 @@
 import os
 import sys
 import time
-import yaml
 import logging
 import subprocess
 from textwrap import dedent
 from textwrap import fill
 
 import teuthology
+from teuthology import archive
 from teuthology import misc
-from teuthology import suite
 from .report import ResultsSerializer
 
 log = logging.getLogger(__name__)
@@ -100,9 +99,8 @@ def build_email_body(name, archive_dir, timeout):
     hung = {}
     passed = {}
 
-    for job in suite.get_jobs(archive_dir):
-        job_dir = os.path.join(archive_dir, job)
-        summary_file = os.path.join(job_dir, 'summary.yaml')
+    for job_row in archive.run_jobs(archive_dir):
+        job = job_row['job_id']
 
         # Every job gets a link to e.g. pulpito's pages
         info_url = misc.get_results_url(name, job)
@@ -112,30 +110,19 @@ def build_email_body(name, archive_dir, timeout):
             info_line = ''
 
         # Unfinished jobs will have no summary.yaml
-        if not os.path.exists(summary_file):
-            info_file = os.path.join(job_dir, 'info.yaml')
-
-            desc = ''
-            if os.path.exists(info_file):
-                with file(info_file) as f:
-                    info = yaml.safe_load(f)
-                    desc = info['description']
-
+        if job_row['status'] == 'running':
             hung[job] = email_templates['hung_templ'].format(
                 job_id=job,
-                desc=desc,
+                desc=job_row['description'] or '',
                 info_line=info_line,
             )
             continue
 
-        with file(summary_file) as f:
-            summary = yaml.safe_load(f)
-
-        if summary['success']:
+        if job_row['status'] == 'pass':
             passed[job] = email_templates['pass_templ'].format(
                 job_id=job,
-                desc=summary.get('description'),
-                time=int(summary.get('duration', 0)),
+                desc=job_row['description'],
+                time=int(job_row['duration'] or 0),
                 info_line=info_line,
             )
         else:
@@ -144,12 +131,7 @@ def build_email_body(name, archive_dir, timeout):
                 log_line = email_templates['fail_log_templ'].format(log=log)
             else:
                 log_line = ''
-            # Transitioning from sentry_events -> sentry_event
-            sentry_events = summary.get('sentry_events')
-            if sentry_events:
-                sentry_event = sentry_events[0]
-            else:
-                sentry_event = summary.get('sentry_event', '')
+            sentry_event = job_row['sentry_event']
             if sentry_event:
                 sentry_line = email_templates['fail_sentry_templ'].format(
                     sentry_event=sentry_event)
@@ -160,13 +142,13 @@ def build_email_body(name, archive_dir, timeout):
             # string into multiple lines of a maximum width as specified. We
             # want 75 characters here so that when we indent by 4 on the next
             # line, we have 79-character exception paragraphs.
-            reason = fill(summary.get('failure_reason'), 75)
+            reason = fill(job_row['failure_reason'], 75)
             reason = '\n'.join(('    ') + line for line in reason.splitlines())
 
             failed[job] = email_templates['fail_templ'].format(
                 job_id=job,
-                desc=summary.get('description'),
-                time=int(summary.get('duration', 0)),
+                desc=job_row['description'],
+                time=int(job_row['duration'] or 0),
                 reason=reason,
                 info_line=info_line,
                 log_line=log_line,
@@ -7,6 +7,8 @@ import logging
 from traceback import format_tb
 
 import teuthology
+from . import archive
+from . import lockstatus
 from . import report
 from .misc import get_distro
 from .misc import get_user
@@ -129,11 +131,11 @@ def main(ctx):
         {'internal.check_lock': None},
         {'internal.connect': None},
         {'internal.serialize_remote_roles': None},
-        {'internal.check_conflict': None},
+        {'internal.check_hosts': dict(
+            ceph_data=not ctx.config.get('use_existing_cluster', False))},
     ])
     if not ctx.config.get('use_existing_cluster', False):
         init_tasks.extend([
-            {'internal.check_ceph_data': None},
             {'internal.vm_setup': None},
         ])
     if 'kernel' in ctx.config:
@@ -142,11 +144,7 @@ def main(ctx):
         if (distro == 'ubuntu') or (sha1 == 'distro'):
             init_tasks.append({'kernel': ctx.config['kernel']})
     init_tasks.extend([
-        {'internal.base': None},
-        {'internal.archive': None},
-        {'internal.coredump': None},
-        {'internal.sudo': None},
-        {'internal.syslog': None},
+        {'internal.setup_hosts': None},
         {'internal.timer': None},
     ])
 
@@ -158,9 +156,14 @@ def main(ctx):
         if not ctx.summary.get('success') and ctx.config.get('nuke-on-error'):
             # only unlock if we locked them in the first place
             nuke(ctx, ctx.lock)
+        lockstatus.log_request_stats()
         if ctx.archive is not None:
             with file(os.path.join(ctx.archive, 'summary.yaml'), 'w') as f:
                 yaml.safe_dump(ctx.summary, f, default_flow_style=False)
+            # jobs run by a worker are archived as <archive_base>/<run>/<id>
+            if os.path.basename(ctx.archive.rstrip('/')) == \
+                    str(ctx.config.get('job_id')):
+                archive.try_index_job(ctx.archive)
         with contextlib.closing(StringIO.StringIO()) as f:
             yaml.safe_dump(ctx.summary, f)
             log.info('Summary data:\n%s' % f.getvalue())
@@ -176,6 +179,7 @@ def main(ctx):
                               'email-on-error'], emsg)
 
         report.try_push_job_info(ctx.config, ctx.summary)
+        report.flush_push_queue()
 
         if ctx.summary.get('success', True):
             log.info('pass')
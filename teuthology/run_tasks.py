@@ -1,12 +1,21 @@
+import gevent
+import gevent.queue
+import os
 import sys
 import logging
+import time
+import yaml
 from .sentry import get_client as get_sentry_client
 from .misc import get_http_log_path
+from . import timing
 from .config import config as teuth_config
 from copy import deepcopy
 
 log = logging.getLogger(__name__)
 
+# Keys of a task entry that are about scheduling rather than being the task
+TASK_KEYWORDS = ('id', 'needs', 'after')
+
 
 def run_one_task(taskname, **kwargs):
     submod = taskname
@@ -31,20 +40,254 @@ def run_one_task(taskname, **kwargs):
     return fn(**kwargs)
 
 
+class TaskNode(object):
+    """
+    One entry in the tasks list, what it depends on, and when it ran.
+
+    Besides the task itself, an entry may have:
+
+    - ``id``: what other entries call it, if not the task name
+    - ``needs``: ids of earlier tasks it depends on; they must exist
+    - ``after``: ids of earlier tasks it must wait for, if they exist
+
+    An entry with neither ``needs`` nor ``after`` depends on every task
+    before it, which is how all tasks used to run. One with either depends
+    only on those, and on the last entry before it that has neither.
+    """
+    def __init__(self, index, taskdict):
+        if not isinstance(taskdict, dict):
+            raise RuntimeError('Invalid task definition: %s' % taskdict)
+        task = dict(taskdict)
+        keywords = dict((key, task.pop(key)) for key in TASK_KEYWORDS
+                        if key in task)
+        try:
+            ((self.name, self.config),) = task.iteritems()
+        except ValueError:
+            raise RuntimeError('Invalid task definition: %s' % taskdict)
+        self.index = index
+        self.id = str(keywords.get('id', self.name))
+        self.needs = _as_list(keywords.get('needs'))
+        self.after = _as_list(keywords.get('after'))
+        self.declared = 'needs' in keywords or 'after' in keywords
+        # indexes of the nodes this one waits for
+        self.deps = set()
+        # times, relative to the start of the run
+        self.started = None
+        self.entered = None
+        self.exit_duration = None
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return [value]
+    return [str(item) for item in value]
+
+
+class TaskGraph(object):
+    """
+    Enters the tasks' context managers concurrently where their ``needs``
+    and ``after`` allow, and reports the critical path.
+    """
+    def __init__(self, tasks):
+        self.nodes = []
+        barrier = None
+        for index, taskdict in enumerate(tasks):
+            node = TaskNode(index, taskdict)
+            if not node.declared:
+                node.deps = set(range(index))
+            else:
+                if barrier is not None:
+                    node.deps.add(barrier)
+                for ref in node.needs:
+                    dep = self._find(ref)
+                    if dep is None:
+                        raise RuntimeError(
+                            'Task {name} needs {ref}, which is not an '
+                            'earlier task'.format(name=node.id, ref=ref))
+                    node.deps.add(dep.index)
+                for ref in node.after:
+                    dep = self._find(ref)
+                    if dep is not None:
+                        node.deps.add(dep.index)
+            self.nodes.append(node)
+            if not node.declared:
+                barrier = index
+        self.start = None
+        # the task whose exception is being raised
+        self.failed = None
+
+    def _find(self, ref):
+        for node in reversed(self.nodes):
+            if ref in (node.id, node.name):
+                return node
+
+    def _now(self):
+        return time.time() - self.start
+
+    def _enter_one(self, node, ctx):
+        """
+        Run a task, entering its manager if it returns one.
+
+        :returns: The manager, or None
+        """
+        node.started = self._now()
+        log.info('Running task %s...', node.name)
+        with timing.profile.task(node.id):
+            manager = run_one_task(node.name, ctx=ctx, config=node.config)
+            if hasattr(manager, '__enter__'):
+                manager.__enter__()
+            else:
+                manager = None
+        node.entered = self._now()
+        return manager
+
+    def _spawned(self, node, ctx, finished):
+        # even KeyboardInterrupt and SystemExit go to enter(), which would
+        # otherwise wait for this task forever, to be raised there
+        try:
+            result = (self._enter_one(node, ctx), None)
+        except BaseException:
+            result = (None, sys.exc_info())
+        finished.put((node, result))
+
+    def enter(self, ctx, stack):
+        """
+        Enter every task, pushing (taskname, manager, node) onto stack in
+        the order they finish entering.
+
+        Tasks that depend on every task before them run on their own, as
+        they always have. When a task fails, no more are started, the ones
+        already starting are waited for, and the first failure is raised.
+        """
+        self.start = time.time()
+        entered = set()
+        pending = list(self.nodes)
+        running = set()
+        finished = gevent.queue.Queue()
+        errors = []
+        while pending or running:
+            ready = [] if errors else \
+                [node for node in pending if node.deps <= entered]
+            for node in ready:
+                pending.remove(node)
+                if node.declared:
+                    gevent.spawn(self._spawned, node, ctx, finished)
+                    running.add(node)
+                    continue
+                # everything before it has been entered, so it's alone
+                self.failed = node
+                manager = self._enter_one(node, ctx)
+                self.failed = None
+                if manager is not None:
+                    stack.append((node.name, manager, node))
+                entered.add(node.index)
+                break
+            if not running:
+                if errors or not ready:
+                    break
+                continue
+            node, (manager, exc_info) = finished.get()
+            running.remove(node)
+            if exc_info is not None:
+                errors.append((node, exc_info))
+                if running:
+                    log.info('Task %s failed; waiting for %s to start',
+                             node.name,
+                             ', '.join(sorted(n.name for n in running)))
+                continue
+            if manager is not None:
+                stack.append((node.name, manager, node))
+            entered.add(node.index)
+        if errors:
+            for node, exc_info in errors[1:]:
+                log.error('Task %s also failed', node.name, exc_info=exc_info)
+            self.failed, exc_info = errors[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def critical_path(self):
+        """
+        The chain of tasks that decided how long it took to enter them all:
+        the last task entered, the task it depends on that was entered last,
+        and so on.
+        """
+        done = [node for node in self.nodes if node.entered is not None]
+        if not done:
+            return []
+        node = max(done, key=lambda node: node.entered)
+        path = [node]
+        while node.deps:
+            node = max((self.nodes[index] for index in node.deps),
+                       key=lambda node: node.entered)
+            path.append(node)
+        path.reverse()
+        return path
+
+    def task_timings(self):
+        """
+        :returns: How long each task that ran took to enter and exit, as
+                  `timing.Profile.report` takes them
+        """
+        timings = []
+        for node in self.nodes:
+            if node.started is None:
+                continue
+            enter = None
+            if node.entered is not None:
+                enter = round(node.entered - node.started, 3)
+            exit_duration = None
+            if node.exit_duration is not None:
+                exit_duration = round(node.exit_duration, 3)
+            timings.append(dict(task=node.id, enter=enter,
+                                exit=exit_duration))
+        return timings
+
+    def report(self):
+        """
+        :returns: A dict of when each task ran, and the critical path
+        """
+        tasks = []
+        for node in self.nodes:
+            info = dict(name=node.name, id=node.id, started=node.started,
+                        entered=node.entered,
+                        exit_duration=node.exit_duration)
+            if node.declared:
+                info['deps'] = sorted(self.nodes[index].id
+                                      for index in node.deps)
+            tasks.append(info)
+        path = self.critical_path()
+        return dict(
+            tasks=tasks,
+            critical_path=[node.id for node in path],
+            critical_path_duration=path[-1].entered if path else 0,
+            )
+
+    def write_report(self, archive):
+        """
+        Log the critical path, and write the report to task_graph.yaml in
+        the archive directory, if there is one.
+        """
+        report = self.report()
+        if report['critical_path']:
+            log.info('Critical path (%.1fs): %s',
+                     report['critical_path_duration'],
+                     ' -> '.join(report['critical_path']))
+        if archive is not None:
+            with file(os.path.join(archive, 'task_graph.yaml'), 'w') as f:
+                yaml.safe_dump(report, f, default_flow_style=False)
+
+
 def run_tasks(tasks, ctx):
     stack = []
+    graph = None
+    taskname = None
     try:
-        for taskdict in tasks:
-            try:
-                ((taskname, config),) = taskdict.iteritems()
-            except ValueError:
-                raise RuntimeError('Invalid task definition: %s' % taskdict)
-            log.info('Running task %s...', taskname)
-            manager = run_one_task(taskname, ctx=ctx, config=config)
-            if hasattr(manager, '__enter__'):
-                manager.__enter__()
-                stack.append((taskname, manager))
+        graph = TaskGraph(tasks)
+        graph.enter(ctx, stack)
     except Exception as e:
+        if graph is not None and graph.failed is not None:
+            taskname = graph.failed.name
         ctx.summary['success'] = False
         if 'failure_reason' not in ctx.summary:
             ctx.summary['failure_reason'] = str(e)
@@ -99,10 +342,12 @@ def run_tasks(tasks, ctx):
         try:
             exc_info = sys.exc_info()
             while stack:
-                taskname, manager = stack.pop()
+                taskname, manager, node = stack.pop()
                 log.debug('Unwinding manager %s', taskname)
+                exit_start = time.time()
                 try:
-                    suppress = manager.__exit__(*exc_info)
+                    with timing.profile.task(node.id):
+                        suppress = manager.__exit__(*exc_info)
                 except Exception as e:
                     ctx.summary['success'] = False
                     if 'failure_reason' not in ctx.summary:
@@ -123,6 +368,18 @@ def run_tasks(tasks, ctx):
                     if suppress:
                         sys.exc_clear()
                         exc_info = (None, None, None)
+                finally:
+                    node.exit_duration = time.time() - exit_start
+
+            if graph is not None and graph.start is not None:
+                try:
+                    graph.write_report(getattr(ctx, 'archive', None))
+                except Exception:
+                    log.exception('Could not write the task graph report')
+                try:
+                    timing.write_profile(ctx, graph.task_timings())
+                except Exception:
+                    log.exception('Could not write the profile')
 
             if exc_info != (None, None, None):
                 log.debug('Exception was not quenched, exiting: %s: %s',
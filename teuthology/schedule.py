@@ -1,3 +1,7 @@
+import copy
+import logging
+import sqlite3
+import time
 import yaml
 
 import teuthology.beanstalk
@@ -5,6 +9,8 @@ from teuthology.misc import get_user
 from teuthology.misc import read_config
 from teuthology import report
 
+log = logging.getLogger(__name__)
+
 
 def main(ctx):
     if ctx.owner is None:
@@ -39,6 +45,17 @@ def main(ctx):
                     report.try_delete_jobs(name, job_id)
         return
 
+    job_config = build_config(ctx)
+    schedule_jobs(beanstalk, tube, [job_config], ctx.priority, num=ctx.num)
+
+
+def build_config(ctx):
+    """
+    Build the job config for a scheduled job.
+
+    :param ctx: An argparse.Namespace as created by teuthology-schedule
+    :returns:   The job config dict
+    """
     # strip out targets; the worker will allocate new ones when we run
     # the job with --lock.
     if ctx.config.get('targets'):
@@ -55,19 +72,70 @@ def main(ctx):
     )
     # Merge job_config and ctx.config
     job_config.update(ctx.config)
+    # the same priority the job is queued with, for the lock server's
+    # reservation queue
+    job_config['priority'] = ctx.priority
     if ctx.timeout is not None:
         job_config['results_timeout'] = ctx.timeout
+    return job_config
+
+
+def schedule_jobs(beanstalk, tube, job_configs, priority, num=1,
+                  batch_size=100):
+    """
+    Queue jobs on the beanstalk tube currently in use by beanstalk.
+
+    Up to batch_size jobs are put in a single round trip, and their 'queued'
+    status is then pushed to the results server together.
+
+    :param beanstalk:   A beanstalkc.Connection
+    :param tube:        The tube beanstalk uses, which the jobs are indexed
+                        under whatever their machine_type says
+    :param job_configs: An iterable of job config dicts
+    :param priority:    The beanstalk priority (lower is sooner)
+    :param num:         How many times to queue each job
+    :param batch_size:  How many jobs to queue per round trip
+    :returns:           The number of jobs queued
+    """
+    start = time.time()
+    count = 0
+    batch = []
+    try:
+        index = teuthology.beanstalk.QueueIndex()
+    except sqlite3.Error:
+        log.exception("Could not open the queue index")
+        index = None
+
+    def flush():
+        bodies = [yaml.safe_dump(job_config) for job_config in batch]
+        jids = teuthology.beanstalk.put_jobs(beanstalk, bodies, priority)
+        for job_config, jid in zip(batch, jids):
+            print 'Job scheduled with name {name} and ID {jid}'.format(
+                name=job_config['name'], jid=jid)
+            job_config['job_id'] = str(jid)
+        if index is not None:
+            try:
+                index.add_many([(job_config['job_id'], tube, job_config,
+                                 priority) for job_config in batch])
+            except sqlite3.Error:
+                log.exception("Could not update the queue index")
+        report.try_push_jobs_info(batch, dict(status='queued'))
+        del batch[:]
+
+    for job_config in job_configs:
+        for i in range(num):
+            batch.append(copy.deepcopy(job_config))
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+    if batch:
+        flush()
+    if index is not None:
+        index.close()
 
-    job = yaml.safe_dump(job_config)
-    num = ctx.num
-    while num > 0:
-        jid = beanstalk.put(
-            job,
-            ttr=60 * 60 * 24,
-            priority=ctx.priority,
-        )
-        print 'Job scheduled with name {name} and ID {jid}'.format(
-            name=ctx.name, jid=jid)
-        job_config['job_id'] = str(jid)
-        report.try_push_job_info(job_config, dict(status='queued'))
-        num -= 1
+    duration = time.time() - start
+    log.info('Scheduled {count} jobs in {duration:.1f}s '
+             '({rate:.1f} jobs/sec)'.format(
+                 count=count, duration=duration,
+                 rate=count / duration if duration else 0.0))
+    return count
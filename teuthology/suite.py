@@ -2,18 +2,20 @@
 # by generating combinations of facets found in
 # https://github.com/ceph/ceph-qa-suite.git
 
+import argparse
 import copy
-import errno
 import itertools
 import logging
 import os
-import re
-import subprocess
 import sys
 import yaml
 
 import teuthology
+import teuthology.beanstalk
+from teuthology import archive
 from teuthology import lock as lock
+from teuthology import schedule
+from teuthology.misc import config_file, deep_merge, get_user
 
 log = logging.getLogger(__name__)
 
@@ -39,57 +41,71 @@ def main(args):
         (os.path.join(args.base, collection), collection)
         for collection in args.collections
     ]
-    
-    count = 1
+
     num_jobs = 0
     for collection, collection_name in sorted(collections):
         log.debug('Collection %s in %s' % (collection_name, collection))
-        configs = [(combine_path(collection_name, item[0]), item[1])
-                   for item in build_matrix(collection)]
+        collection_jobs = count_matrix(collection)
         log.info('Collection %s in %s generated %d jobs' %
-                 (collection_name, collection, len(configs)))
-        num_jobs += len(configs)
-
+                 (collection_name, collection, collection_jobs))
+        num_jobs += collection_jobs
+
+    if args.count_only:
+        log.info('Suite %s would generate %d jobs' % (args.name, num_jobs))
+        return
+
+    def generate_jobs():
+        """
+        Yield the (description, [file list]) of every job to schedule,
+        stopping as soon as --limit is reached.
+        """
         arch = get_arch(args.config)
         machine_type = get_machine_type(args.config)
-        for description, config in configs:
-            if args.limit > 0:
-                if count > args.limit:
-                    log.info('Stopped after {limit} jobs due to --limit={limit}'.format(
-                    limit=args.limit))
-
-                    break
-            raw_yaml = '\n'.join([file(a, 'r').read() for a in config])
-
-            parsed_yaml = yaml.load(raw_yaml)
-            os_type = parsed_yaml.get('os_type')
-            exclude_arch = parsed_yaml.get('exclude_arch')
-            exclude_os_type = parsed_yaml.get('exclude_os_type')
-
-            if exclude_arch:
-                if exclude_arch == arch:
-                    log.info('Skipping due to excluded_arch: %s facets %s',
-                             exclude_arch, description)
-                    continue
-            if exclude_os_type:
-                if exclude_os_type == os_type:
-                    log.info('Skipping due to excluded_os_type: %s facets %s',
-                             exclude_os_type, description)
-                    continue
-            # We should not run multiple tests (changing distros) unless the
-            # machine is a VPS.
-            # Re-imaging baremetal is not yet supported.
-            if machine_type != 'vps':
-                if os_type and os_type != 'ubuntu':
-                    log.info(
-                        'Skipping due to non-ubuntu on baremetal facets %s',
-                        description)
-                    continue
-
-            log.info(
-                'Scheduling %s', description
-            )
+        count = 1
+        for collection, collection_name in sorted(collections):
+            for description, config in generate_matrix(collection):
+                description = combine_path(collection_name, description)
+                if args.limit > 0:
+                    if count > args.limit:
+                        log.info('Stopped after {limit} jobs due to '
+                                 '--limit={limit}'.format(limit=args.limit))
+                        return
+                parsed_yaml = {}
+                for path in config:
+                    parsed_yaml.update(load_fragment(path))
+                os_type = parsed_yaml.get('os_type')
+                exclude_arch = parsed_yaml.get('exclude_arch')
+                exclude_os_type = parsed_yaml.get('exclude_os_type')
+
+                if exclude_arch:
+                    if exclude_arch == arch:
+                        log.info('Skipping due to excluded_arch: %s facets %s',
+                                 exclude_arch, description)
+                        continue
+                if exclude_os_type:
+                    if exclude_os_type == os_type:
+                        log.info(
+                            'Skipping due to excluded_os_type: %s facets %s',
+                            exclude_os_type, description)
+                        continue
+                # We should not run multiple tests (changing distros) unless
+                # the machine is a VPS.
+                # Re-imaging baremetal is not yet supported.
+                if machine_type != 'vps':
+                    if os_type and os_type != 'ubuntu':
+                        log.info(
+                            'Skipping due to non-ubuntu on baremetal facets %s',
+                            description)
+                        continue
+
+                log.info(
+                    'Scheduling %s', description
+                )
+                yield description, config
+                count += 1
 
+    if args.dry_run:
+        for description, config in generate_jobs():
             arg = copy.deepcopy(base_arg)
             arg.extend([
                 '--description', description,
@@ -97,28 +113,76 @@ def main(args):
             ])
             arg.extend(args.config)
             arg.extend(config)
-
-            if args.dry_run:
-                log.info('dry-run: %s' % ' '.join(arg))
-            else:
-                subprocess.check_call(
-                    args=arg,
-                )
-            count += 1
-
-    if num_jobs:
-        arg = copy.deepcopy(base_arg)
-        arg.append('--last-in-suite')
-        if args.email:
-            arg.extend(['--email', args.email])
-        if args.timeout:
-            arg.extend(['--timeout', args.timeout])
-        if args.dry_run:
             log.info('dry-run: %s' % ' '.join(arg))
-        else:
-            subprocess.check_call(
-                args=arg,
+        if num_jobs:
+            arg = copy.deepcopy(base_arg)
+            arg.append('--last-in-suite')
+            if args.email:
+                arg.extend(['--email', args.email])
+            if args.timeout:
+                arg.extend(['--timeout', args.timeout])
+            log.info('dry-run: %s' % ' '.join(arg))
+        return
+
+    if not num_jobs:
+        return
+
+    base_configs = [config_file(path) for path in args.config]
+
+    def generate_job_configs():
+        for description, config in generate_jobs():
+            yield build_job_config(
+                args,
+                base_configs + [load_fragment(path) for path in config],
+                description=description,
             )
+        yield build_job_config(
+            args,
+            [],
+            last_in_suite=True,
+            email=args.email,
+            timeout=int(args.timeout) if args.timeout else None,
+        )
+
+    beanstalk = teuthology.beanstalk.connect()
+    beanstalk.use(args.worker)
+    try:
+        schedule.schedule_jobs(beanstalk, args.worker, generate_job_configs(),
+                               args.priority, num=args.num)
+    finally:
+        beanstalk.close()
+
+
+def build_job_config(args, configs, description=None, last_in_suite=False,
+                     email=None, timeout=None):
+    """
+    Build the config of a job the same way teuthology-schedule would, without
+    running it.
+
+    :param args:          The parsed teuthology-suite arguments
+    :param configs:       A list of config dicts, merged in order
+    :param description:   The job description
+    :param last_in_suite: Whether this is the suite's final (reporting) job
+    :param email:         Where to email the suite results
+    :param timeout:       How long to wait for the suite before reporting
+    :returns:             The job config dict
+    """
+    config = {}
+    for new in configs:
+        deep_merge(config, copy.deepcopy(new))
+    job_ctx = argparse.Namespace(
+        name=args.name,
+        last_in_suite=last_in_suite,
+        email=email,
+        description=description,
+        owner=args.owner or 'scheduled_{user}'.format(user=get_user()),
+        verbose=bool(args.verbose),
+        worker=args.worker,
+        priority=args.priority,
+        timeout=timeout,
+        config=config,
+    )
+    return schedule.build_config(job_ctx)
 
 
 def combine_path(left, right):
@@ -154,9 +218,19 @@ def build_matrix(path):
     component will appear as a file with braces listing the selection
     of chosen subitems.
     """
+    return list(generate_matrix(path))
+
+
+def generate_matrix(path):
+    """
+    Like build_matrix(), but yield the items one at a time instead of
+    building the whole list. The factors of a '%' product are expanded,
+    but the product itself never is.
+    """
     if os.path.isfile(path):
         if path.endswith('.yaml'):
-            return [(None, [path])]
+            yield (None, [path])
+        return
     if os.path.isdir(path):
         files = sorted(os.listdir(path))
         if '+' in files:
@@ -164,101 +238,125 @@ def build_matrix(path):
             files.remove('+')
             raw = []
             for fn in files:
-                raw.extend(build_matrix(os.path.join(path, fn)))
-            out = [(
+                raw.extend(generate_matrix(os.path.join(path, fn)))
+            yield (
                 '{' + ' '.join(files) + '}',
                 [a[1][0] for a in raw]
-            )]
-            return out
+            )
         elif '%' in files:
             # convolve items
             files.remove('%')
             sublists = []
             for fn in files:
-                raw = build_matrix(os.path.join(path, fn))
                 sublists.append([(combine_path(fn, item[0]), item[1])
-                                for item in raw])
-            out = []
+                                for item in generate_matrix(
+                                    os.path.join(path, fn))])
             if sublists:
                 for sublist in itertools.product(*sublists):
                     name = '{' + ' '.join([item[0] for item in sublist]) + '}'
                     val = []
                     for item in sublist:
                         val.extend(item[1])
-                    out.append((name, val))
-            return out
+                    yield (name, val)
         else:
             # list items
-            out = []
             for fn in files:
-                raw = build_matrix(os.path.join(path, fn))
-                out.extend([(combine_path(fn, item[0]), item[1])
-                           for item in raw])
-            return out
-    return []
+                for item in generate_matrix(os.path.join(path, fn)):
+                    yield (combine_path(fn, item[0]), item[1])
+
+
+def count_matrix(path):
+    """
+    Return len(build_matrix(path)) without generating any items.
+    """
+    if os.path.isfile(path):
+        if path.endswith('.yaml'):
+            return 1
+        return 0
+    if os.path.isdir(path):
+        files = sorted(os.listdir(path))
+        if '+' in files:
+            return 1
+        elif '%' in files:
+            files.remove('%')
+            if not files:
+                return 0
+            count = 1
+            for fn in files:
+                count *= count_matrix(os.path.join(path, fn))
+            return count
+        else:
+            return sum(count_matrix(os.path.join(path, fn)) for fn in files)
+    return 0
+
+
+# path -> (mtime, parsed yaml)
+_fragments = {}
+
+
+def load_fragment(path):
+    """
+    Parse a suite yaml fragment, caching the result until the file changes.
+
+    :returns: The parsed dict; callers must not modify it.
+    """
+    mtime = os.path.getmtime(path)
+    cached = _fragments.get(path)
+    if cached is None or cached[0] != mtime:
+        parsed = {}
+        with file(path) as f:
+            for new in yaml.safe_load_all(f):
+                parsed.update(new or {})
+        cached = (mtime, parsed)
+        _fragments[path] = cached
+    return cached[1]
 
 
 def ls(archive_dir, verbose):
-    for j in get_jobs(archive_dir):
+    jobs = sorted(archive.run_jobs(archive_dir), key=lambda job: job['job_id'])
+    for job in jobs:
+        j = job['job_id']
         job_dir = os.path.join(archive_dir, j)
-        summary = {}
-        try:
-            with file(os.path.join(job_dir, 'summary.yaml')) as f:
-                g = yaml.safe_load_all(f)
-                for new in g:
-                    summary.update(new)
-        except IOError as e:
-            if e.errno == errno.ENOENT:
-                print '%s      ' % j,
-
-                # pid
-                try:
-                    pidfile = os.path.join(job_dir, 'pid')
-                    found = False
-                    if os.path.isfile(pidfile):
-                        pid = open(pidfile, 'r').read()
-                        if os.path.isdir("/proc/%s" % pid):
-                            cmdline = open('/proc/%s/cmdline' % pid,
-                                           'r').read()
-                            if cmdline.find(archive_dir) >= 0:
-                                print '(pid %s)' % pid,
-                                found = True
-                    if not found:
-                        print '(no process or summary.yaml)',
-                    # tail
-                    tail = os.popen(
-                        'tail -1 %s/%s/teuthology.log' % (archive_dir, j)
-                    ).read().rstrip()
-                    print tail,
-                except IOError as e:
-                    continue
-                print ''
+        if job['status'] == 'running':
+            print '%s      ' % j,
+
+            # pid
+            try:
+                pidfile = os.path.join(job_dir, 'pid')
+                found = False
+                if os.path.isfile(pidfile):
+                    pid = open(pidfile, 'r').read()
+                    if os.path.isdir("/proc/%s" % pid):
+                        cmdline = open('/proc/%s/cmdline' % pid,
+                                       'r').read()
+                        if cmdline.find(archive_dir) >= 0:
+                            print '(pid %s)' % pid,
+                            found = True
+                if not found:
+                    print '(no process or summary.yaml)',
+                # tail
+                tail = os.popen(
+                    'tail -1 %s/%s/teuthology.log' % (archive_dir, j)
+                ).read().rstrip()
+                print tail,
+            except IOError:
                 continue
-            else:
-                raise
+            print ''
+            continue
 
         print "{job} {success} {owner} {desc} {duration}s".format(
             job=j,
-            owner=summary.get('owner', '-'),
-            desc=summary.get('description', '-'),
-            success='pass' if summary.get('success', False) else 'FAIL',
-            duration=int(summary.get('duration', 0)),
+            owner=job['owner'] or '-',
+            desc=job['description'] or '-',
+            success='pass' if job['status'] == 'pass' else 'FAIL',
+            duration=int(job['duration'] or 0),
         )
-        if verbose and 'failure_reason' in summary:
-            print '    {reason}'.format(reason=summary['failure_reason'])
+        if verbose and job['failure_reason'] is not None:
+            print '    {reason}'.format(reason=job['failure_reason'])
 
 
 def get_jobs(archive_dir):
-    dir_contents = os.listdir(archive_dir)
-
-    def is_job_dir(parent, subdir):
-        if (os.path.isdir(os.path.join(parent, subdir)) and re.match('\d+$',
-                                                                     subdir)):
-            return True
-        return False
-
-    jobs = [job for job in dir_contents if is_job_dir(archive_dir, job)]
-    return sorted(jobs)
+    return sorted(job['job_id'] for job in archive.run_jobs(archive_dir))
 
 
 def get_arch(config):
@@ -266,7 +364,8 @@ def get_arch(config):
         y = yaml.safe_load(file(yamlfile))
         machine_type = y.get('machine_type')
         if machine_type:
-            locks = lock.list_locks()
+            locks = lock.list_locks(machine_type=machine_type,
+                                    fields=['type', 'arch'])
             for machine in locks:
                 if machine['type'] == machine_type:
                     arch = machine['arch']
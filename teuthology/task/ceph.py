@@ -15,6 +15,7 @@ import time
 
 from teuthology import misc as teuthology
 from teuthology import contextutil
+from teuthology.parallel import parallel
 from ..orchestra import run
 import ceph_client as cclient
 
@@ -191,39 +192,30 @@ def ceph_log(ctx, config):
     :param config: Configuration
     """
     log.info('Making ceph log dir writeable by non-root...')
-    run.wait(
-        ctx.cluster.run(
-            args=[
-                'sudo',
-                'chmod',
-                '777',
-                '/var/log/ceph',
-                ],
-            wait=False,
-            )
+    ctx.cluster.run_all(
+        args=[
+            'sudo',
+            'chmod',
+            '777',
+            '/var/log/ceph',
+            ],
         )
     log.info('Disabling ceph logrotate...')
-    run.wait(
-        ctx.cluster.run(
-            args=[
-                'sudo',
-                'rm', '-f', '--',
-                '/etc/logrotate.d/ceph',
-                ],
-            wait=False,
-            )
+    ctx.cluster.run_all(
+        args=[
+            'sudo',
+            'rm', '-f', '--',
+            '/etc/logrotate.d/ceph',
+            ],
         )
     log.info('Creating extra log directories...')
-    run.wait(
-        ctx.cluster.run(
-            args=[
-                'sudo',
-                'install', '-d', '-m0755', '--',
-                '/var/log/ceph/valgrind',
-                '/var/log/ceph/profiling-logger',
-                ],
-            wait=False,
-            )
+    ctx.cluster.run_all(
+        args=[
+            'sudo',
+            'install', '-d', '-m0755', '--',
+            '/var/log/ceph/valgrind',
+            '/var/log/ceph/profiling-logger',
+            ],
         )
 
     try:
@@ -245,44 +237,21 @@ def ship_utilities(ctx, config):
     """
     assert config is None
     testdir = teuthology.get_testdir(ctx)
-    filenames = []
+    files = []
 
-    log.info('Shipping valgrind.supp...')
     with file(os.path.join(os.path.dirname(__file__), 'valgrind.supp'), 'rb') as f:
-        fn = os.path.join(testdir, 'valgrind.supp')
-        filenames.append(fn)
-        for rem in ctx.cluster.remotes.iterkeys():
-            teuthology.sudo_write_file(
-                remote=rem,
-                path=fn,
-                data=f,
-                )
-            f.seek(0)
+        files.append((os.path.join(testdir, 'valgrind.supp'), f.read(), None))
 
     FILES = ['daemon-helper', 'adjust-ulimits', 'kcon_most']
     destdir = '/usr/bin'
     for filename in FILES:
-        log.info('Shipping %r...', filename)
         src = os.path.join(os.path.dirname(__file__), filename)
-        dst = os.path.join(destdir, filename)
-        filenames.append(dst)
         with file(src, 'rb') as f:
-            for rem in ctx.cluster.remotes.iterkeys():
-                teuthology.sudo_write_file(
-                    remote=rem,
-                    path=dst,
-                    data=f,
-                )
-                f.seek(0)
-                rem.run(
-                    args=[
-                        'sudo',
-                        'chmod',
-                        'a=rx',
-                        '--',
-                        dst,
-                    ],
-                )
+            files.append((os.path.join(destdir, filename), f.read(), '0555'))
+
+    filenames = [path for path, _, _ in files]
+    log.info('Shipping %s...', ' '.join(filenames))
+    ctx.cluster.broadcast_files(files, sudo=True)
 
     try:
         yield
@@ -324,40 +293,19 @@ def valgrind_post(ctx, config):
     try:
         yield
     finally:
-        lookup_procs = list()
         log.info('Checking for errors in any valgrind logs...');
-        for remote in ctx.cluster.remotes.iterkeys():
-            #look at valgrind logs for each node
-            proc = remote.run(
-                args=[
-                    'sudo',
-                    'zgrep',
-                    '<kind>',
-                    run.Raw('/var/log/ceph/valgrind/*'),
-                    '/dev/null', # include a second file so that we always get a filename prefix on the output
-                    run.Raw('|'),
-                    'sort',
-                    run.Raw('|'),
-                    'uniq',
-                    ],
-                wait=False,
-                check_status=False,
-                stdout=StringIO(),
-                )
-            lookup_procs.append((proc, remote))
+        scans = teuthology.scan_logs(
+            ctx.cluster.remotes.keys(),
+            ['/var/log/ceph/valgrind/*'],
+            [('kind', '<kind>')],
+            max_hits=1000,
+            unique=True,
+            )
 
         valgrind_exception = None
-        for (proc, remote) in lookup_procs:
-            proc.exitstatus.get()
-            out = proc.stdout.getvalue()
-            for line in out.split('\n'):
-                if line == '':
-                    continue
-                try:
-                    (file, kind) = line.split(':')
-                except Exception:
-                    log.error('failed to split line %s', line)
-                    raise
+        for remote, scan in scans.iteritems():
+            for (file, line) in scan['hits']['kind']:
+                kind = line.strip()
                 log.debug('file %s kind %s', file, kind)
                 if (file.find('mds') >= 0) and kind.find('Lost') > 0:
                     continue
@@ -416,22 +364,151 @@ def write_conf(ctx, conf_path=DEFAULT_CONF_PATH):
     conf_fp = StringIO()
     ctx.ceph.conf.write(conf_fp)
     conf_fp.seek(0)
-    writes = ctx.cluster.run(
+    ctx.cluster.run_all(
+        args=['sudo', 'install', '-d', '-m0755', '--', '/etc/ceph'],
+        )
+    ctx.cluster.broadcast_file(conf_path, conf_fp, sudo=True, mode='0644')
+
+
+
+def prepare_osd(ctx, config, remote, id_, devs_to_clean):
+    """
+    Create the data directory for one osd, make and mount its filesystem
+    if it has a scratch device, and run ceph-osd --mkfs on it.
+
+    The time taken is stored in ctx.summary['osd_prepare_duration'].
+
+    :param ctx: Context
+    :param config: Configuration
+    :param remote: Remote site
+    :param id_: Osd id
+    :param devs_to_clean: Dictionary of mounted data dirs, indexed by remote
+    """
+    start = time.time()
+    testdir = teuthology.get_testdir(ctx)
+    coverage_dir = '{tdir}/archive/coverage'.format(tdir=testdir)
+    roles_to_devs = ctx.disk_config.remote_to_roles_to_dev[remote]
+    roles_to_journals = ctx.disk_config.remote_to_roles_to_journals[remote]
+
+    remote.run(
         args=[
-            'sudo', 'mkdir', '-p', '/etc/ceph', run.Raw('&&'),
-            'sudo', 'chmod', '0755', '/etc/ceph', run.Raw('&&'),
-            'sudo', 'python',
-            '-c',
-            'import shutil, sys; shutil.copyfileobj(sys.stdin, file(sys.argv[1], "wb"))',
-            conf_path,
-            run.Raw('&&'),
-            'sudo', 'chmod', '0644', conf_path,
-        ],
-        stdin=run.PIPE,
-        wait=False)
-    log.warn("writes: ")
-    teuthology.feed_many_stdins_and_close(conf_fp, writes)
-    run.wait(writes)
+            'sudo',
+            'mkdir',
+            '-p',
+            '/var/lib/ceph/osd/ceph-{id}'.format(id=id_),
+            ])
+    log.info(str(roles_to_journals))
+    log.info(id_)
+    if roles_to_devs.get(id_):
+        dev = roles_to_devs[id_]
+        fs = config.get('fs')
+        package = None
+        mkfs_options = config.get('mkfs_options')
+        mount_options = config.get('mount_options')
+        if fs == 'btrfs':
+            #package = 'btrfs-tools'
+            if mount_options is None:
+                mount_options = ['noatime','user_subvol_rm_allowed']
+            if mkfs_options is None:
+                mkfs_options = ['-m', 'single',
+                                '-l', '32768',
+                                '-n', '32768']
+        if fs == 'xfs':
+            #package = 'xfsprogs'
+            if mount_options is None:
+                mount_options = ['noatime']
+            if mkfs_options is None:
+                mkfs_options = ['-f', '-i', 'size=2048']
+        if fs == 'ext4' or fs == 'ext3':
+            if mount_options is None:
+                mount_options = ['noatime','user_xattr']
+
+        if mount_options is None:
+            mount_options = []
+        if mkfs_options is None:
+            mkfs_options = []
+        # other osds are being prepared concurrently; don't modify the
+        # lists they share from config
+        mkfs_options = list(mkfs_options)
+        mkfs = ['mkfs.%s' % fs] + mkfs_options
+        log.info('%s on %s on %s' % (mkfs, dev, remote))
+        if package is not None:
+            remote.run(
+                args=[
+                    'sudo',
+                    'apt-get', 'install', '-y', package
+                    ],
+                stdout=StringIO(),
+                )
+
+        try:
+            remote.run(args= ['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
+        except run.CommandFailedError:
+            # Newer btfs-tools doesn't prompt for overwrite, use -f
+            if '-f' not in mount_options:
+                mkfs_options.append('-f')
+                mkfs = ['mkfs.%s' % fs] + mkfs_options
+                log.info('%s on %s on %s' % (mkfs, dev, remote))
+            remote.run(args= ['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
+
+        log.info('mount %s on %s -o %s' % (dev, remote,
+                                           ','.join(mount_options)))
+        remote.run(
+            args=[
+                'sudo',
+                'mount',
+                '-t', fs,
+                '-o', ','.join(mount_options),
+                dev,
+                os.path.join('/var/lib/ceph/osd', 'ceph-{id}'.format(id=id_)),
+                ]
+            )
+        if not remote in ctx.disk_config.remote_to_roles_to_dev_mount_options:
+            ctx.disk_config.remote_to_roles_to_dev_mount_options[remote] = {}
+        ctx.disk_config.remote_to_roles_to_dev_mount_options[remote][id_] = mount_options
+        if not remote in ctx.disk_config.remote_to_roles_to_dev_fstype:
+            ctx.disk_config.remote_to_roles_to_dev_fstype[remote] = {}
+        ctx.disk_config.remote_to_roles_to_dev_fstype[remote][id_] = fs
+        devs_to_clean[remote].append(
+            os.path.join(
+                os.path.join('/var/lib/ceph/osd', 'ceph-{id}'.format(id=id_)),
+                )
+            )
+
+    remote.run(
+        args=[
+            'sudo',
+            'MALLOC_CHECK_=3',
+            'adjust-ulimits',
+            'ceph-coverage',
+            coverage_dir,
+            'ceph-osd',
+            '--mkfs',
+            '--mkkey',
+            '-i', id_,
+            '--monmap', '{tdir}/monmap'.format(tdir=testdir),
+            ],
+        )
+    duration = time.time() - start
+    log.info('Prepared osd.%s on %s in %f seconds', id_, remote, duration)
+    durations = ctx.summary.setdefault('osd_prepare_duration', {})
+    durations['osd.{id}'.format(id=id_)] = duration
+
+
+def prepare_osds(ctx, config, remote, roles_for_host, devs_to_clean):
+    """
+    Prepare all the osds on one remote, at most config['mkfs_concurrency']
+    of them at a time (all at once if that is not set).
+
+    :param ctx: Context
+    :param config: Configuration
+    :param remote: Remote site
+    :param roles_for_host: Roles on remote
+    :param devs_to_clean: Dictionary of mounted data dirs, indexed by remote
+    """
+    with parallel(size=config.get('mkfs_concurrency')) as p:
+        for id_ in teuthology.roles_of_type(roles_for_host, 'osd'):
+            p.spawn(prepare_osd, ctx, config, remote, id_, devs_to_clean)
 
 
 @contextlib.contextmanager
@@ -632,20 +709,9 @@ def cluster(ctx, config):
         path='{tdir}/monmap'.format(tdir=testdir),
         )
 
-    for rem in ctx.cluster.remotes.iterkeys():
-        # copy mon key and initial monmap
-        log.info('Sending monmap to node {remote}'.format(remote=rem))
-        teuthology.sudo_write_file(
-            remote=rem,
-            path=keyring_path,
-            data=keyring,
-            perms='0644'
-            )
-        teuthology.write_file(
-            remote=rem,
-            path='{tdir}/monmap'.format(tdir=testdir),
-            data=monmap,
-            )
+    # copy mon key and initial monmap
+    ctx.cluster.broadcast_file(keyring_path, keyring, sudo=True, mode='0644')
+    ctx.cluster.broadcast_file('{tdir}/monmap'.format(tdir=testdir), monmap)
 
     log.info('Setting up mon nodes...')
     mons = ctx.cluster.only(teuthology.is_type('mon'))
@@ -702,109 +768,10 @@ def cluster(ctx, config):
     ctx.disk_config.remote_to_roles_to_dev_fstype = {}
 
     log.info("ctx.disk_config.remote_to_roles_to_dev: {r}".format(r=str(ctx.disk_config.remote_to_roles_to_dev)))
-    for remote, roles_for_host in osds.remotes.iteritems():
-        roles_to_devs = remote_to_roles_to_devs[remote]
-        roles_to_journals = remote_to_roles_to_journals[remote]
-
-
-        for id_ in teuthology.roles_of_type(roles_for_host, 'osd'):
-            remote.run(
-                args=[
-                    'sudo',
-                    'mkdir',
-                    '-p',
-                    '/var/lib/ceph/osd/ceph-{id}'.format(id=id_),
-                    ])
-            log.info(str(roles_to_journals))
-            log.info(id_)
-            if roles_to_devs.get(id_):
-                dev = roles_to_devs[id_]
-                fs = config.get('fs')
-                package = None
-                mkfs_options = config.get('mkfs_options')
-                mount_options = config.get('mount_options')
-                if fs == 'btrfs':
-                    #package = 'btrfs-tools'
-                    if mount_options is None:
-                        mount_options = ['noatime','user_subvol_rm_allowed']
-                    if mkfs_options is None:
-                        mkfs_options = ['-m', 'single',
-                                        '-l', '32768',
-                                        '-n', '32768']
-                if fs == 'xfs':
-                    #package = 'xfsprogs'
-                    if mount_options is None:
-                        mount_options = ['noatime']
-                    if mkfs_options is None:
-                        mkfs_options = ['-f', '-i', 'size=2048']
-                if fs == 'ext4' or fs == 'ext3':
-                    if mount_options is None:
-                        mount_options = ['noatime','user_xattr']
-
-                if mount_options is None:
-                    mount_options = []
-                if mkfs_options is None:
-                    mkfs_options = []
-                mkfs = ['mkfs.%s' % fs] + mkfs_options
-                log.info('%s on %s on %s' % (mkfs, dev, remote))
-                if package is not None:
-                    remote.run(
-                        args=[
-                            'sudo',
-                            'apt-get', 'install', '-y', package
-                            ],
-                        stdout=StringIO(),
-                        )
-
-                try:
-                    remote.run(args= ['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
-                except run.CommandFailedError:
-                    # Newer btfs-tools doesn't prompt for overwrite, use -f
-                    if '-f' not in mount_options:
-                        mkfs_options.append('-f')
-                        mkfs = ['mkfs.%s' % fs] + mkfs_options
-                        log.info('%s on %s on %s' % (mkfs, dev, remote))
-                    remote.run(args= ['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
-
-                log.info('mount %s on %s -o %s' % (dev, remote,
-                                                   ','.join(mount_options)))
-                remote.run(
-                    args=[
-                        'sudo',
-                        'mount',
-                        '-t', fs,
-                        '-o', ','.join(mount_options),
-                        dev,
-                        os.path.join('/var/lib/ceph/osd', 'ceph-{id}'.format(id=id_)),
-                        ]
-                    )
-                if not remote in ctx.disk_config.remote_to_roles_to_dev_mount_options:
-                    ctx.disk_config.remote_to_roles_to_dev_mount_options[remote] = {}
-                ctx.disk_config.remote_to_roles_to_dev_mount_options[remote][id_] = mount_options
-                if not remote in ctx.disk_config.remote_to_roles_to_dev_fstype:
-                    ctx.disk_config.remote_to_roles_to_dev_fstype[remote] = {}
-                ctx.disk_config.remote_to_roles_to_dev_fstype[remote][id_] = fs
-                devs_to_clean[remote].append(
-                    os.path.join(
-                        os.path.join('/var/lib/ceph/osd', 'ceph-{id}'.format(id=id_)),
-                        )
-                    )
-
-        for id_ in teuthology.roles_of_type(roles_for_host, 'osd'):
-            remote.run(
-                args=[
-                    'sudo',
-                    'MALLOC_CHECK_=3',
-                    'adjust-ulimits',
-                    'ceph-coverage',
-                    coverage_dir,
-                    'ceph-osd',
-                    '--mkfs',
-                    '--mkkey',
-                    '-i', id_,
-                    '--monmap', '{tdir}/monmap'.format(tdir=testdir),
-                    ],
-                )
+    with parallel() as p:
+        for remote, roles_for_host in osds.remotes.iteritems():
+            p.spawn(prepare_osds, ctx, config, remote, roles_for_host,
+                    devs_to_clean)
 
 
     log.info('Reading keys from all nodes...')
@@ -914,46 +881,30 @@ def cluster(ctx, config):
         (mon0_remote,) = ctx.cluster.only(firstmon).remotes.keys()
 
         log.info('Checking cluster log for badness...')
-        def first_in_ceph_log(pattern, excludes):
-            """
-            Find the first occurence of the pattern specified in the Ceph log,
-            Returns None if none found.
-
-            :param pattern: Pattern scanned for.
-            :param excludes: Patterns to ignore.
-            :return: First line of text (or None if not found)
-            """
-            args = [
-                'sudo',
-                'egrep', pattern,
-                '/var/log/ceph/ceph.log',
-                ]
-            for exclude in excludes:
-                args.extend([run.Raw('|'), 'egrep', '-v', exclude])
-            args.extend([
-                    run.Raw('|'), 'head', '-n', '1',
-                    ])
-            r = mon0_remote.run(
-                stdout=StringIO(),
-                args=args,
-                )
-            stdout = r.stdout.getvalue()
-            if stdout != '':
-                return stdout
-            return None
-
-        if first_in_ceph_log('\[ERR\]|\[WRN\]|\[SEC\]',
-                             config['log_whitelist']) is not None:
-            log.warning('Found errors (ERR|WRN|SEC) in cluster log')
+        # most severe first
+        severities = [
+            ('SEC', '\[SEC\]'),
+            ('ERR', '\[ERR\]'),
+            ('WRN', '\[WRN\]'),
+            ]
+        scan = teuthology.scan_logs(
+            [mon0_remote],
+            ['/var/log/ceph/ceph.log'],
+            severities,
+            config['log_whitelist'],
+            )[mon0_remote]
+        if any(scan['counts'].values()):
+            log.warning('Found errors (ERR|WRN|SEC) in cluster log: %s',
+                        scan['counts'])
             ctx.summary['success'] = False
             # use the most severe problem as the failure reason
             if 'failure_reason' not in ctx.summary:
-                for pattern in ['\[SEC\]', '\[ERR\]', '\[WRN\]']:
-                    match = first_in_ceph_log(pattern, config['log_whitelist'])
-                    if match is not None:
+                for severity, _ in severities:
+                    hits = scan['hits'][severity]
+                    if hits:
                         ctx.summary['failure_reason'] = \
                             '"{match}" in cluster log'.format(
-                            match=match.rstrip('\n'),
+                            match=hits[0][1],
                             )
                         break
 
@@ -985,13 +936,14 @@ def cluster(ctx, config):
             log.info('Archiving mon data...')
             path = os.path.join(ctx.archive, 'data')
             os.makedirs(path)
-            for remote, roles in mons.remotes.iteritems():
-                for role in roles:
-                    if role.startswith('mon.'):
-                        teuthology.pull_directory_tarball(
-                            remote,
-                            '/var/lib/ceph/mon',
-                            path + '/' + role + '.tgz')
+            teuthology.pull_directories(
+                ctx,
+                [(role, teuthology.pull_directory_tarball, remote,
+                  '/var/lib/ceph/mon', path + '/' + role + '.tgz')
+                 for remote, roles_for_host in mons.remotes.iteritems()
+                 for role in roles_for_host if role.startswith('mon.')],
+                'mon_data_transfers',
+                )
 
             # and logs
             log.info('Compressing logs...')
@@ -1020,11 +972,14 @@ def cluster(ctx, config):
             log.info('Archiving logs...')
             path = os.path.join(ctx.archive, 'remote')
             os.makedirs(path)
+            transfers = []
             for remote in ctx.cluster.remotes.iterkeys():
                 sub = os.path.join(path, remote.shortname)
                 os.makedirs(sub)
-                teuthology.pull_directory(remote, '/var/log/ceph',
-                                          os.path.join(sub, 'log'))
+                transfers.append((remote.shortname, teuthology.pull_directory,
+                                  remote, '/var/log/ceph',
+                                  os.path.join(sub, 'log')))
+            teuthology.pull_directories(ctx, transfers, 'log_transfers')
 
 
         log.info('Cleaning ceph cluster...')
@@ -1372,6 +1327,15 @@ def task(ctx, config):
     Note, this will cause the task to check the /scratch_devs file on each node
     for available devices.  If no such file is found, /dev/sdb will be used.
 
+    Osds are prepared on all nodes at once, and all the osds on a node
+    are prepared concurrently. To limit how many osds on each node are
+    prepared at a time, use::
+
+        tasks:
+        - ceph:
+            fs: xfs
+            mkfs_concurrency: 2
+
     To run some daemons under valgrind, include their names
     and the tool/args to use in a valgrind section::
 
@@ -1450,6 +1414,7 @@ def task(ctx, config):
                 mount_options=config.get('mount_options',None),
                 block_journal=config.get('block_journal', None),
                 tmpfs_journal=config.get('tmpfs_journal', None),
+                mkfs_concurrency=config.get('mkfs_concurrency', None),
                 log_whitelist=config.get('log-whitelist', []),
                 cpu_profile=set(config.get('cpu_profile', [])),
                 )),
@@ -393,16 +393,85 @@ class Thrasher:
             time.sleep(delay)
         self.all_up()
 
+class PGStateSnapshot:
+    """
+    The states of all pgs from a single 'ceph pg dump', tallied once so
+    that every get_num_*/is_* query about that moment is answered
+    without another round trip.
+    """
+    def __init__(self, pg_stats):
+        self.pg_stats = pg_stats
+        self.timestamp = time.time()
+        self.num_pgs = len(pg_stats)
+        self.num_creating = 0
+        self.num_active = 0
+        self.num_active_clean = 0
+        self.num_active_recovered = 0
+        self.num_down = 0
+        self.num_active_down = 0
+        self.histogram = {}
+        for pg in pg_stats:
+            state = pg['state']
+            for status in state.split('+'):
+                self.histogram[status] = self.histogram.get(status, 0) + 1
+            if 'creating' in state:
+                self.num_creating += 1
+            if state.count('stale'):
+                continue
+            active = state.count('active')
+            down = state.count('down') or state.count('incomplete')
+            if active:
+                self.num_active += 1
+                if state.count('clean'):
+                    self.num_active_clean += 1
+                if not state.count('recover') and \
+                        not state.count('backfill'):
+                    self.num_active_recovered += 1
+            if down:
+                self.num_down += 1
+            if active or down:
+                self.num_active_down += 1
+
+    def is_clean(self):
+        """
+        True if all pgs are clean
+        """
+        return self.num_active_clean == self.num_pgs
+
+    def is_recovered(self):
+        """
+        True if all pgs have recovered
+        """
+        return self.num_active_recovered == self.num_pgs
+
+    def is_active(self):
+        """
+        True if all pgs are active
+        """
+        return self.num_active == self.num_pgs
+
+    def is_active_or_down(self):
+        """
+        True if all pgs are active or down
+        """
+        return self.num_active_down == self.num_pgs
+
+
 class CephManager:
     """
     Ceph manager object.
     Contains several local functions that form a bulk of this module.
     """
+
+    # how long, in seconds, a pg dump is reused for get_num_*/is_* queries
+    pg_snapshot_ttl = 1
+
     def __init__(self, controller, ctx=None, config=None, logger=None):
         self.lock = threading.RLock()
         self.ctx = ctx
         self.config = config
         self.controller = controller
+        self.pg_snapshot = None
         self.next_pool_id = 0
         self.created_erasure_pool = False
         if (logger):
@@ -425,6 +494,8 @@ class CephManager:
         """
         Start ceph on a raw cluster.  Return count
         """
+        # the command may change pg states
+        self.pg_snapshot = None
         testdir = teuthology.get_testdir(self.ctx)
         ceph_args = [
                 'adjust-ulimits',
@@ -443,6 +514,7 @@ class CephManager:
         """
         Start ceph on a cluster.  Return success or failure information.
         """
+        self.pg_snapshot = None
         testdir = teuthology.get_testdir(self.ctx)
         ceph_args = [
                 'adjust-ulimits',
@@ -696,11 +768,9 @@ class CephManager:
 
     def get_num_pgs(self):
         """
-        Check cluster status for the number of pgs
+        Get the number of pgs
         """
-        status = self.raw_cluster_status()
-        self.log(status)
-        return status['pgmap']['num_pgs']
+        return self.get_pg_snapshot().num_pgs
 
     def create_pool_with_unique_name(self, pg_num=16, ec_pool=False, ec_m=1, ec_k=2):
         """
@@ -874,20 +944,27 @@ class CephManager:
         """
         out = self.raw_cluster_cmd('pg', 'dump', '--format=json')
         j = json.loads('\n'.join(out.split('\n')[1:]))
+        self.pg_snapshot = PGStateSnapshot(j['pg_stats'])
         return j['pg_stats']
 
+    def get_pg_snapshot(self, max_age=None):
+        """
+        Return a PGStateSnapshot, reusing the last pg dump if it is no
+        older than max_age seconds (default pg_snapshot_ttl).
+        """
+        if max_age is None:
+            max_age = self.pg_snapshot_ttl
+        snapshot = self.pg_snapshot
+        if snapshot is None or time.time() - snapshot.timestamp > max_age:
+            self.get_pg_stats()
+            snapshot = self.pg_snapshot
+        return snapshot
+
     def compile_pg_status(self):
         """
         Return a histogram of pg state values
         """
-        ret = {}
-        j = self.get_pg_stats()
-        for pg in j:
-            for status in pg['state'].split('+'):
-                if status not in ret:
-                    ret[status] = 0
-                ret[status] += 1
-        return ret
+        return dict(self.get_pg_snapshot().histogram)
 
     def pg_scrubbing(self, pool, pgnum):
         """
@@ -971,34 +1048,19 @@ class CephManager:
         """
         Find the number of pgs in creating mode.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if 'creating' in pg['state']:
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_creating
 
     def get_num_active_clean(self):
         """
         Find the number of active and clean pgs.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if pg['state'].count('active') and pg['state'].count('clean') and not pg['state'].count('stale'):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active_clean
 
     def get_num_active_recovered(self):
         """
         Find the number of active and recovered pgs.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if pg['state'].count('active') and not pg['state'].count('recover') and not pg['state'].count('backfill') and not pg['state'].count('stale'):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active_recovered
 
     def get_is_making_recovery_progress(self):
         """
@@ -1015,55 +1077,37 @@ class CephManager:
         """
         Find the number of active pgs.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if pg['state'].count('active') and not pg['state'].count('stale'):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active
 
     def get_num_down(self):
         """
         Find the number of pgs that are down.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if (pg['state'].count('down') and not pg['state'].count('stale')) or \
-                    (pg['state'].count('incomplete') and not pg['state'].count('stale')):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_down
 
     def get_num_active_down(self):
         """
         Find the number of pgs that are either active or down.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if (pg['state'].count('active') and not pg['state'].count('stale')) or \
-                    (pg['state'].count('down') and not pg['state'].count('stale')) or \
-                    (pg['state'].count('incomplete') and not pg['state'].count('stale')):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active_down
 
     def is_clean(self):
         """
         True if all pgs are clean
         """
-        return self.get_num_active_clean() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_clean()
 
     def is_recovered(self):
         """
         True if all pgs have recovered
         """
-        return self.get_num_active_recovered() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_recovered()
 
     def is_active_or_down(self):
         """
         True if all pgs are active or down
         """
-        return self.get_num_active_down() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_active_or_down()
 
     def wait_for_clean(self, timeout=None):
         """
@@ -1071,8 +1115,9 @@ class CephManager:
         """
         self.log("waiting for clean")
         start = time.time()
-        num_active_clean = self.get_num_active_clean()
-        while not self.is_clean():
+        pgs = self.get_pg_snapshot()
+        num_active_clean = pgs.num_active_clean
+        while not pgs.is_clean():
             if timeout is not None:
                 if self.get_is_making_recovery_progress():
                     self.log("making progress, resetting timeout")
@@ -1081,11 +1126,11 @@ class CephManager:
                     self.log("no progress seen, keeping timeout for now")
                     assert time.time() - start < timeout, \
                         'failed to become clean before timeout expired'
-            cur_active_clean = self.get_num_active_clean()
-            if cur_active_clean != num_active_clean:
+            if pgs.num_active_clean != num_active_clean:
                 start = time.time()
-                num_active_clean = cur_active_clean
+                num_active_clean = pgs.num_active_clean
             time.sleep(3)
+            pgs = self.get_pg_snapshot()
         self.log("clean!")
 
     def are_all_osds_up(self):
@@ -1116,8 +1161,9 @@ class CephManager:
         """
         self.log("waiting for recovery to complete")
         start = time.time()
-        num_active_recovered = self.get_num_active_recovered()
-        while not self.is_recovered():
+        pgs = self.get_pg_snapshot()
+        num_active_recovered = pgs.num_active_recovered
+        while not pgs.is_recovered():
             if timeout is not None:
                 if self.get_is_making_recovery_progress():
                     self.log("making progress, resetting timeout")
@@ -1126,11 +1172,11 @@ class CephManager:
                     self.log("no progress seen, keeping timeout for now")
                     assert time.time() - start < timeout, \
                         'failed to recover before timeout expired'
-            cur_active_recovered = self.get_num_active_recovered()
-            if cur_active_recovered != num_active_recovered:
+            if pgs.num_active_recovered != num_active_recovered:
                 start = time.time()
-                num_active_recovered = cur_active_recovered
+                num_active_recovered = pgs.num_active_recovered
             time.sleep(3)
+            pgs = self.get_pg_snapshot()
         self.log("recovered!")
 
     def wait_for_active(self, timeout=None):
@@ -1139,16 +1185,17 @@ class CephManager:
         """
         self.log("waiting for peering to complete")
         start = time.time()
-        num_active = self.get_num_active()
-        while not self.is_active():
+        pgs = self.get_pg_snapshot()
+        num_active = pgs.num_active
+        while not pgs.is_active():
             if timeout is not None:
                 assert time.time() - start < timeout, \
                     'failed to recover before timeout expired'
-            cur_active = self.get_num_active()
-            if cur_active != num_active:
+            if pgs.num_active != num_active:
                 start = time.time()
-                num_active = cur_active
+                num_active = pgs.num_active
             time.sleep(3)
+            pgs = self.get_pg_snapshot()
         self.log("active!")
 
     def wait_for_active_or_down(self, timeout=None):
@@ -1158,16 +1205,17 @@ class CephManager:
         """
         self.log("waiting for peering to complete or become blocked")
         start = time.time()
-        num_active_down = self.get_num_active_down()
-        while not self.is_active_or_down():
+        pgs = self.get_pg_snapshot()
+        num_active_down = pgs.num_active_down
+        while not pgs.is_active_or_down():
             if timeout is not None:
                 assert time.time() - start < timeout, \
                     'failed to recover before timeout expired'
-            cur_active_down = self.get_num_active_down()
-            if cur_active_down != num_active_down:
+            if pgs.num_active_down != num_active_down:
                 start = time.time()
-                num_active_down = cur_active_down
+                num_active_down = pgs.num_active_down
             time.sleep(3)
+            pgs = self.get_pg_snapshot()
         self.log("active or down!")
 
     def osd_is_up(self, osd):
@@ -1194,7 +1242,7 @@ class CephManager:
         """
         Wrapper to check if active
         """
-        return self.get_num_active() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_active()
 
     def wait_till_active(self, timeout=None):
         """
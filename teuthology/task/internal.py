@@ -5,7 +5,7 @@ the calls are made from other modules, most notably teuthology/run.py
 """
 from cStringIO import StringIO
 import contextlib
-import gevent
+import json
 import logging
 import os
 import time
@@ -16,7 +16,9 @@ import subprocess
 from teuthology import lockstatus
 from teuthology import lock
 from teuthology import misc as teuthology
+from teuthology import preflight
 from teuthology.parallel import parallel
+from ..orchestra import remote as remote_module
 from ..orchestra import run
 
 log = logging.getLogger(__name__)
@@ -28,14 +30,11 @@ def base(ctx, config):
     """
     log.info('Creating test directory...')
     testdir = teuthology.get_testdir(ctx)
-    run.wait(
-        ctx.cluster.run(
-            args=[
-                'mkdir', '-m0755', '--',
-                testdir,
-                ],
-            wait=False,
-            )
+    ctx.cluster.run_all(
+        args=[
+            'mkdir', '-m0755', '--',
+            testdir,
+            ],
         )
     try:
         yield
@@ -43,16 +42,54 @@ def base(ctx, config):
         log.info('Tidying up after the test...')
         # if this fails, one of the earlier cleanups is flawed; don't
         # just cram an rm -rf here
-        run.wait(
-            ctx.cluster.run(
-                args=[
-                    'rmdir',
-                    '--',
-                    testdir,
-                    ],
-                wait=False,
-                ),
+        ctx.cluster.run_all(
+            args=[
+                'rmdir',
+                '--',
+                testdir,
+                ],
+            )
+
+
+def lock_when_free(ctx, how_many, machine_type, machine_types, min_free):
+    """
+    Check that enough machines are up and free, and if so try to lock them.
+
+    :returns: The newly locked machines, or None if the caller should check
+              again.
+    """
+    machines = lock.list_locks(machine_type=','.join(machine_types),
+                               fields=['up', 'locked', 'type'])
+    if machines is None:
+        if ctx.block:
+            log.warn('error listing machines, trying again')
+            time.sleep(20)
+            return None
+        else:
+            assert 0, 'error listing machines'
+
+    is_up = lambda machine: machine['up'] and machine['type'] in machine_types  # noqa
+    num_up = len(filter(is_up, machines))
+    assert num_up >= how_many, 'not enough machines are up'
+
+    # make sure there are machines for non-automated jobs to run
+    is_up_and_free = lambda machine: machine['up'] and machine['locked'] == 0 and machine['type'] in machine_types  # noqa
+    up_and_free = filter(is_up_and_free, machines)
+    num_free = len(up_and_free)
+    if num_free < min_free:
+        if ctx.block:
+            log.info(
+                'waiting for more machines to be free (need %s see %s)...',
+                how_many,
+                num_free,
             )
+            time.sleep(10)
+            return None
+        else:
+            assert 0, 'not enough machines free'
+
+    return lock.lock_many(ctx, how_many, machine_type, ctx.owner,
+                          ctx.archive)
 
 
 @contextlib.contextmanager
@@ -67,40 +104,24 @@ def lock_machines(ctx, config):
     machine_type = config[1]
     machine_types = teuthology.get_multi_machine_types(machine_type)
     how_many = config[0]
+    # make sure there are machines for non-automated jobs to run
+    min_free = 6 if ctx.owner.startswith('scheduled') else 0
+
+    reserved = None
+    if ctx.block and len(machine_types) == 1:
+        reserved = lock.reserve_many(ctx, how_many, machine_type, ctx.owner,
+                                     ctx.archive, min_free=min_free,
+                                     priority=ctx.config.get('priority', 1000))
 
     while True:
-        # make sure there are enough machines up
-        machines = lock.list_locks()
-        if machines is None:
-            if ctx.block:
-                log.warn('error listing machines, trying again')
-                time.sleep(20)
-                continue
-            else:
-                assert 0, 'error listing machines'
-
-        is_up = lambda machine: machine['up'] and machine['type'] in machine_types  # noqa
-        num_up = len(filter(is_up, machines))
-        assert num_up >= how_many, 'not enough machines are up'
-
-        # make sure there are machines for non-automated jobs to run
-        is_up_and_free = lambda machine: machine['up'] and machine['locked'] == 0 and machine['type'] in machine_types  # noqa
-        up_and_free = filter(is_up_and_free, machines)
-        num_free = len(up_and_free)
-        if num_free < 6 and ctx.owner.startswith('scheduled'):
-            if ctx.block:
-                log.info(
-                    'waiting for more machines to be free (need %s see %s)...',
-                    how_many,
-                    num_free,
-                )
-                time.sleep(10)
+        if reserved is not None:
+            newly_locked, reserved = reserved, None
+        else:
+            newly_locked = lock_when_free(ctx, how_many, machine_type,
+                                          machine_types, min_free)
+            if newly_locked is None:
                 continue
-            else:
-                assert 0, 'not enough machines free'
 
-        newly_locked = lock.lock_many(ctx, how_many, machine_type, ctx.owner,
-                                      ctx.archive)
         if len(newly_locked) == how_many:
             vmlist = []
             for lmach in newly_locked:
@@ -128,9 +149,14 @@ def lock_machines(ctx, config):
                 if lock.update_keys(ctx, keyscan_out, current_locks):
                     log.info("Error in virtual machine keys")
                 newscandict = {}
+                statuses = lockstatus.get_statuses(ctx, newly_locked)
+                assert statuses is not None, 'could not read lock statuses'
                 for dkey in newly_locked.iterkeys():
-                    stats = lockstatus.get_status(ctx, dkey)
-                    newscandict[dkey] = stats['sshpubkey']
+                    status = statuses.get(dkey)
+                    assert status is not None, \
+                        'could not read lock status for {name}'.format(
+                            name=dkey)
+                    newscandict[dkey] = status['sshpubkey']
                 ctx.config['targets'] = newscandict
             else:
                 ctx.config['targets'] = newly_locked
@@ -168,8 +194,10 @@ def check_lock(ctx, config):
         log.info('Lock checking disabled.')
         return
     log.info('Checking locks...')
+    statuses = lockstatus.get_statuses(ctx, ctx.config['targets'])
+    assert statuses is not None, 'could not read lock statuses'
     for machine in ctx.config['targets'].iterkeys():
-        status = lockstatus.get_status(ctx, machine)
+        status = statuses.get(machine)
         log.debug('machine status is %s', repr(status))
         assert status is not None, \
             'could not read lock status for {name}'.format(name=machine)
@@ -249,61 +277,76 @@ def check_ceph_data(ctx, config):
     """
     Check for old /var/lib/ceph directories and detect staleness.
     """
-    log.info('Checking for old /var/lib/ceph...')
-    processes = ctx.cluster.run(
-        args=[
-            'test', '!', '-e', '/var/lib/ceph',
-            ],
-        wait=False,
-        )
-    failed = False
-    for proc in processes:
-        assert isinstance(proc.exitstatus, gevent.event.AsyncResult)
-        try:
-            proc.exitstatus.get()
-        except run.CommandFailedError:
-            log.error('Host %s has stale /var/lib/ceph, check lock and nuke/cleanup.', proc.remote.shortname)
-            failed = True
-    if failed:
-        raise RuntimeError('Stale /var/lib/ceph detected, aborting.')
+    check_hosts(ctx, dict(conflict=False))
+
 
 def check_conflict(ctx, config):
     """
     Note directory use conflicts and stale directories.
     """
-    log.info('Checking for old test directory...')
+    check_hosts(ctx, dict(ceph_data=False))
+
+
+def check_hosts(ctx, config):
+    """
+    Do what check_conflict and check_ceph_data do, with one remote command
+    per host.
+
+    config may disable either check::
+
+        conflict: false
+        ceph_data: false
+    """
+    if config is None:
+        config = {}
     testdir = teuthology.get_testdir(ctx)
-    processes = ctx.cluster.run(
-        args=[
-            'test', '!', '-e', testdir,
-            ],
-        wait=False,
-        )
-    failed = False
-    for proc in processes:
-        assert isinstance(proc.exitstatus, gevent.event.AsyncResult)
-        try:
-            proc.exitstatus.get()
-        except run.CommandFailedError:
-            log.error('Host %s has stale test directory %s, check lock and cleanup.', proc.remote.shortname, testdir)
-            failed = True
-    if failed:
-        raise RuntimeError('Stale jobs detected, aborting.')
+    checks = []
+    if config.get('conflict', True):
+        log.info('Checking for old test directory...')
+        checks.append((
+            'conflict', testdir,
+            'Host %s has stale test directory %s, check lock and cleanup.',
+            'Stale jobs detected, aborting.',
+            ))
+    if config.get('ceph_data', True):
+        log.info('Checking for old /var/lib/ceph...')
+        checks.append((
+            'ceph_data', '/var/lib/ceph',
+            'Host %s has stale %s, check lock and nuke/cleanup.',
+            'Stale /var/lib/ceph detected, aborting.',
+            ))
+
+    script = preflight.StepScript()
+    for name, path, _, _ in checks:
+        script.add(name, ['test', '!', '-e', path], fatal=False)
+    results = preflight.run_scripts(
+        dict((remote, script) for remote in ctx.cluster.remotes.iterkeys()))
+
+    for name, path, message, error in checks:
+        failed = False
+        for remote in sorted(results, key=lambda remote: remote.name):
+            if results[remote][name].exitstatus != 0:
+                log.error(message, remote.shortname, path)
+                failed = True
+        if failed:
+            raise RuntimeError(error)
 
 @contextlib.contextmanager
 def archive(ctx, config):
     """
     Handle the creation and deletion of the archive directory.
+
+    Each remote's archive directory is transferred concurrently. Set
+    'archive-max-rate' (MB/s) in the job config to cap the combined
+    bandwidth; per-host sizes and durations go in the summary under
+    'archive_transfers'.
     """
     log.info('Creating archive directory...')
     archive_dir = teuthology.get_archive_dir(ctx)
-    run.wait(
-        ctx.cluster.run(
-            args=[
-                'install', '-d', '-m0755', '--', archive_dir,
-                ],
-            wait=False,
-            )
+    ctx.cluster.run_all(
+        args=[
+            'install', '-d', '-m0755', '--', archive_dir,
+            ],
         )
 
     try:
@@ -313,58 +356,70 @@ def archive(ctx, config):
         ctx.summary['success'] = False
         raise
     finally:
-        if ctx.archive is not None and \
-                not (ctx.config.get('archive-on-error') and ctx.summary['success']):
-            log.info('Transferring archived files...')
-            logdir = os.path.join(ctx.archive, 'remote')
-            if (not os.path.exists(logdir)):
-                os.mkdir(logdir)
-            for remote in ctx.cluster.remotes.iterkeys():
-                path = os.path.join(logdir, remote.shortname)
-                teuthology.pull_directory(remote, archive_dir, path)
+        _transfer_archive(ctx, ctx.cluster.remotes.keys(), archive_dir)
 
         log.info('Removing archive directory...')
-        run.wait(
-            ctx.cluster.run(
-                args=[
-                    'rm',
-                    '-rf',
-                    '--',
-                    archive_dir,
-                    ],
-                wait=False,
-                ),
+        ctx.cluster.run_all(
+            args=[
+                'rm',
+                '-rf',
+                '--',
+                archive_dir,
+                ],
+            )
+
+
+def _transfer_archive(ctx, remotes, archive_dir):
+    """
+    Pull each remote's archive directory into the job's archive, unless
+    we're not archiving or the job passed with 'archive-on-error' set.
+    """
+    if ctx.archive is not None and \
+            not (ctx.config.get('archive-on-error') and ctx.summary['success']):
+        log.info('Transferring archived files...')
+        logdir = os.path.join(ctx.archive, 'remote')
+        if (not os.path.exists(logdir)):
+            os.mkdir(logdir)
+        teuthology.pull_directories(
+            ctx,
+            [(remote.shortname, teuthology.pull_directory, remote,
+              archive_dir, os.path.join(logdir, remote.shortname))
+             for remote in remotes],
+            'archive_transfers',
             )
 
 
+SUDOERS_FILE = '/etc/sudoers'
+SUDOERS_BACKUP_EXT = '.orig.teuthology'
+# allow sudo without a tty, and with a visible password prompt
+SUDOERS_EDIT = "sudo sed -i{ext} -e '{tty}' -e '{pw}' {path}".format(
+    ext=SUDOERS_BACKUP_EXT,
+    tty=r's/^\([^#]*\) \(requiretty\)/\1 !\2/g',
+    pw=r's/^\([^#]*\) !\(visiblepw\)/\1 \2/g',
+    path=SUDOERS_FILE,
+    )
+SUDOERS_RESTORE = "sudo mv -f {path}{ext} {path}".format(
+    path=SUDOERS_FILE, ext=SUDOERS_BACKUP_EXT)
+
+
 @contextlib.contextmanager
 def sudo(ctx, config):
     """
     Enable use of sudo
     """
     log.info('Configuring sudo...')
-    sudoers_file = '/etc/sudoers'
-    backup_ext = '.orig.teuthology'
-    tty_expr = r's/^\([^#]*\) \(requiretty\)/\1 !\2/g'
-    pw_expr = r's/^\([^#]*\) !\(visiblepw\)/\1 \2/g'
-
     run.wait(
         ctx.cluster.run(
-            args="sudo sed -i{ext} -e '{tty}' -e '{pw}' {path}".format(
-                ext=backup_ext, tty=tty_expr, pw=pw_expr,
-                path=sudoers_file
-            ),
+            args=SUDOERS_EDIT,
             wait=False,
         )
     )
     try:
         yield
     finally:
-        log.info('Restoring {0}...'.format(sudoers_file))
+        log.info('Restoring {0}...'.format(SUDOERS_FILE))
         ctx.cluster.run(
-            args="sudo mv -f {path}{ext} {path}".format(
-                path=sudoers_file, ext=backup_ext
-            )
+            args=SUDOERS_RESTORE,
         )
 
 
@@ -377,12 +432,7 @@ def coredump(ctx, config):
     archive_dir = teuthology.get_archive_dir(ctx)
     run.wait(
         ctx.cluster.run(
-            args=[
-                'install', '-d', '-m0755', '--',
-                '{adir}/coredump'.format(adir=archive_dir),
-                run.Raw('&&'),
-                'sudo', 'sysctl', '-w', 'kernel.core_pattern={adir}/coredump/%t.%p.core'.format(adir=archive_dir),
-                ],
+            args=_coredump_setup_args(archive_dir),
             wait=False,
             )
         )
@@ -392,15 +442,7 @@ def coredump(ctx, config):
     finally:
         run.wait(
             ctx.cluster.run(
-                args=[
-                    'sudo', 'sysctl', '-w', 'kernel.core_pattern=core',
-                    run.Raw('&&'),
-                    # don't litter the archive dir if there were no cores dumped
-                    'rmdir',
-                    '--ignore-fail-on-non-empty',
-                    '--',
-                    '{adir}/coredump'.format(adir=archive_dir),
-                    ],
+                args=_coredump_teardown_args(archive_dir),
                 wait=False,
                 )
             )
@@ -417,11 +459,53 @@ def coredump(ctx, config):
                 stdout=StringIO(),
                 )
             if r.stdout.getvalue() != 'OK\n':
-                log.warning('Found coredumps on %s, flagging run as failed', remote)
-                ctx.summary['success'] = False
-                if 'failure_reason' not in ctx.summary:
-                    ctx.summary['failure_reason'] = \
-                        'Found coredumps on {remote}'.format(remote=remote)
+                _flag_coredumps(ctx, remote)
+
+
+def _coredump_setup_args(archive_dir):
+    return [
+        'install', '-d', '-m0755', '--',
+        '{adir}/coredump'.format(adir=archive_dir),
+        run.Raw('&&'),
+        'sudo', 'sysctl', '-w', 'kernel.core_pattern={adir}/coredump/%t.%p.core'.format(adir=archive_dir),
+        ]
+
+
+def _coredump_teardown_args(archive_dir):
+    return [
+        'sudo', 'sysctl', '-w', 'kernel.core_pattern=core',
+        run.Raw('&&'),
+        # don't litter the archive dir if there were no cores dumped
+        'rmdir',
+        '--ignore-fail-on-non-empty',
+        '--',
+        '{adir}/coredump'.format(adir=archive_dir),
+        ]
+
+
+def _flag_coredumps(ctx, remote):
+    log.warning('Found coredumps on %s, flagging run as failed', remote)
+    ctx.summary['success'] = False
+    if 'failure_reason' not in ctx.summary:
+        ctx.summary['failure_reason'] = \
+            'Found coredumps on {remote}'.format(remote=remote)
+
+# kernel log lines that match the syslog error patterns but are not
+# failures (python regexes)
+SYSLOG_WHITELIST = [
+    'task .* blocked for more than .* seconds',
+    'lockdep is turned off',
+    'trying to register non-static key',
+    'DEBUG: fsize',  # xfs_fsr
+    'CRON',  # ignore cron noise
+    'BUG: bad unlock balance detected', # #6097
+    'inconsistent lock state', # FIXME see #2523
+    '\\*\\*\\* DEADLOCK \\*\\*\\*', # part of lockdep output
+    'INFO: possible irq lock inversion dependency detected', # FIXME see #2590 and #147
+    'INFO: NMI handler \\(perf_event_nmi_handler\\) took too long to run',
+    'INFO: recovery required on readonly',
+    ]
+
 
 @contextlib.contextmanager
 def syslog(ctx, config):
@@ -446,19 +530,9 @@ def syslog(ctx, config):
             )
         )
 
-    CONF = '/etc/rsyslog.d/80-cephtest.conf'
-    conf_fp = StringIO('''
-kern.* -{adir}/syslog/kern.log;RSYSLOG_FileFormat
-*.*;kern.none -{adir}/syslog/misc.log;RSYSLOG_FileFormat
-'''.format(adir=archive_dir))
     try:
-        for rem in ctx.cluster.remotes.iterkeys():
-            teuthology.sudo_write_file(
-                remote=rem,
-                path=CONF,
-                data=conf_fp,
-                )
-            conf_fp.seek(0)
+        ctx.cluster.broadcast_file(SYSLOG_CONF, _syslog_conf(archive_dir),
+                                   sudo=True)
         run.wait(
             ctx.cluster.run(
                 args=[
@@ -484,7 +558,7 @@ kern.* -{adir}/syslog/kern.log;RSYSLOG_FileFormat
                     'rm',
                     '-f',
                     '--',
-                    CONF,
+                    SYSLOG_CONF,
                     run.Raw('&&'),
                     'sudo',
                     'service',
@@ -498,70 +572,216 @@ kern.* -{adir}/syslog/kern.log;RSYSLOG_FileFormat
         # flush the file fully. oh well.
 
         log.info('Checking logs for errors...')
-        for remote in ctx.cluster.remotes.iterkeys():
-            log.debug('Checking %s', remote.name)
-            r = remote.run(
-                args=[
-                    'egrep', '--binary-files=text',
-                    '\\bBUG\\b|\\bINFO\\b|\\bDEADLOCK\\b',
-                    run.Raw('{adir}/syslog/*.log'.format(adir=archive_dir)),
-                    run.Raw('|'),
-                    'grep', '-v', 'task .* blocked for more than .* seconds',
-                    run.Raw('|'),
-                    'grep', '-v', 'lockdep is turned off',
-                    run.Raw('|'),
-                    'grep', '-v', 'trying to register non-static key',
-                    run.Raw('|'),
-                    'grep', '-v', 'DEBUG: fsize',  # xfs_fsr
-                    run.Raw('|'),
-                    'grep', '-v', 'CRON',  # ignore cron noise
-                    run.Raw('|'),
-                    'grep', '-v', 'BUG: bad unlock balance detected', # #6097
-                    run.Raw('|'),
-                    'grep', '-v', 'inconsistent lock state', # FIXME see #2523
-                    run.Raw('|'),
-                    'grep', '-v', '*** DEADLOCK ***', # part of lockdep output
-                    run.Raw('|'),
-                    'grep', '-v', 'INFO: possible irq lock inversion dependency detected', # FIXME see #2590 and #147
-                    run.Raw('|'),
-                    'grep', '-v', 'INFO: NMI handler (perf_event_nmi_handler) took too long to run',
-                    run.Raw('|'),
-                    'grep', '-v', 'INFO: recovery required on readonly',
-                    run.Raw('|'),
-                    'head', '-n', '1',
-                    ],
-                stdout=StringIO(),
-                )
-            stdout = r.stdout.getvalue()
-            if stdout != '':
-                log.error('Error in syslog on %s: %s', remote.name, stdout)
-                ctx.summary['success'] = False
-                if 'failure_reason' not in ctx.summary:
-                    ctx.summary['failure_reason'] = \
-                        "'{error}' in syslog".format(error=stdout)
+        scans = teuthology.scan_logs(
+            ctx.cluster.remotes.keys(),
+            *_syslog_scan_args(archive_dir)
+            )
+        _check_syslog_scans(ctx, scans)
 
         log.info('Compressing syslogs...')
         run.wait(
             ctx.cluster.run(
-                args=[
-                    'find',
-                    '{adir}/syslog'.format(adir=archive_dir),
-                    '-name',
-                    '*.log',
-                    '-print0',
-                    run.Raw('|'),
-                    'sudo',
-                    'xargs',
-                    '-0',
-                    '--no-run-if-empty',
-                    '--',
-                    'gzip',
-                    '--',
-                    ],
+                args=_syslog_gzip_args(archive_dir),
                 wait=False,
                 ),
             )
 
+
+SYSLOG_CONF = '/etc/rsyslog.d/80-cephtest.conf'
+
+
+def _syslog_conf(archive_dir):
+    return '''
+kern.* -{adir}/syslog/kern.log;RSYSLOG_FileFormat
+*.*;kern.none -{adir}/syslog/misc.log;RSYSLOG_FileFormat
+'''.format(adir=archive_dir)
+
+
+def _syslog_scan_args(archive_dir):
+    """
+    :returns: (paths, patterns, excludes) for scan_logs()
+    """
+    return (
+        ['{adir}/syslog/*.log'.format(adir=archive_dir)],
+        [('error', '\\bBUG\\b|\\bINFO\\b|\\bDEADLOCK\\b')],
+        SYSLOG_WHITELIST,
+        )
+
+
+def _check_syslog_scans(ctx, scans):
+    """
+    Fail the run if scan_logs() found errors in any syslog.
+    """
+    for remote in sorted(scans, key=lambda remote: remote.name):
+        scan = scans[remote]
+        log.debug('Checked %s: %s', remote.name, scan['counts'])
+        hits = scan['hits']['error']
+        if hits:
+            stdout = '{0}:{1}'.format(*hits[0])
+            log.error('Error in syslog on %s: %s', remote.name, stdout)
+            ctx.summary['success'] = False
+            if 'failure_reason' not in ctx.summary:
+                ctx.summary['failure_reason'] = \
+                    "'{error}' in syslog".format(error=stdout)
+
+
+def _syslog_gzip_args(archive_dir):
+    return [
+        'find',
+        '{adir}/syslog'.format(adir=archive_dir),
+        '-name',
+        '*.log',
+        '-print0',
+        run.Raw('|'),
+        'sudo',
+        'xargs',
+        '-0',
+        '--no-run-if-empty',
+        '--',
+        'gzip',
+        '--',
+        ]
+
+
+@contextlib.contextmanager
+def setup_hosts(ctx, config):
+    """
+    Do what base, archive, coredump, sudo and syslog do, in that order, with
+    one remote command per host to set up, and two to tear down: before and
+    after the archive is transferred.
+
+    Each remote's facts are also gathered again, now that sudo works
+    without a tty.
+
+    If a step fails on a host, the steps after it are not run there, and
+    only the steps that succeeded are undone.
+    """
+    testdir = teuthology.get_testdir(ctx)
+    archive_dir = teuthology.get_archive_dir(ctx)
+
+    log.info('Setting up test directory, archive, coredumps, sudo%s...',
+             ' and syslog' if ctx.archive is not None else '')
+    script = preflight.StepScript()
+    script.add('base', ['mkdir', '-m0755', '--', testdir])
+    script.add('archive', ['install', '-d', '-m0755', '--', archive_dir])
+    script.add('coredump', _coredump_setup_args(archive_dir))
+    script.add('sudo', SUDOERS_EDIT)
+    # syslog is only monitored if we're going to archive the data
+    if ctx.archive is not None:
+        script.add('syslog', [
+            'mkdir', '-m0755', '--', '{adir}/syslog'.format(adir=archive_dir),
+            ])
+        script.add(
+            'syslog_conf',
+            ['sudo', 'install', '-m', '0644', '/dev/stdin', SYSLOG_CONF],
+            stdin=_syslog_conf(archive_dir),
+            )
+        script.add('syslog_restart', [
+            'sudo',
+            'service',
+            # a mere reload (SIGHUP) doesn't seem to make
+            # rsyslog open the files
+            'rsyslog',
+            'restart',
+            ])
+    script.add('facts', ['sh', '-c', remote_module.FACTS_SCRIPT], fatal=False)
+
+    scripts = dict((remote, script) for remote in ctx.cluster.remotes.iterkeys())
+    results = preflight.run_scripts(scripts)
+    done = dict(
+        (remote, set(name for name, result in steps.iteritems()
+                     if result.exitstatus == 0))
+        for remote, steps in results.iteritems())
+    try:
+        for remote, steps in results.iteritems():
+            if 'facts' in done[remote]:
+                remote.load_facts(steps['facts'].output)
+            elif 'facts' in steps:
+                log.warning('%s: could not gather facts: %s',
+                            remote.shortname,
+                            steps['facts'].output.rstrip('\n'))
+        preflight.raise_for_failure(scripts, results, ignore=['facts'])
+        try:
+            yield
+        except Exception:
+            # we need to know this below
+            ctx.summary['success'] = False
+            raise
+    finally:
+        _teardown_hosts(ctx, done, testdir, archive_dir)
+
+
+def _teardown_hosts(ctx, done, testdir, archive_dir):
+    """
+    Undo what setup_hosts did.
+
+    :param done: dict of remote -> names of the setup steps that succeeded
+                 there
+    """
+    log.info('Tearing down syslog, sudo and coredumps...')
+    scan_args, scan_script = teuthology.scan_logs_command(
+        *_syslog_scan_args(archive_dir))
+    scripts = {}
+    for remote, steps in done.iteritems():
+        script = preflight.StepScript()
+        if 'syslog' in steps:
+            script.add('syslog', [
+                'sudo', 'rm', '-f', '--', SYSLOG_CONF,
+                run.Raw('&&'),
+                'sudo', 'service', 'rsyslog', 'restart',
+                ], fatal=False)
+            # race condition: nothing actually says rsyslog had time to
+            # flush the file fully. oh well.
+            script.add('syslog_scan', scan_args, stdin=scan_script,
+                       fatal=False)
+            script.add('syslog_gzip', _syslog_gzip_args(archive_dir),
+                       fatal=False)
+        if 'sudo' in steps:
+            script.add('sudo', SUDOERS_RESTORE, fatal=False)
+        if 'coredump' in steps:
+            script.add('coredump', _coredump_teardown_args(archive_dir),
+                       fatal=False)
+            # the dir is still there if coredumps were seen
+            script.add('coredump_check', [
+                'test', '!', '-e', '{adir}/coredump'.format(adir=archive_dir),
+                ], fatal=False)
+        scripts[remote] = script
+    results = preflight.run_scripts(scripts)
+
+    scans = {}
+    for remote, steps in results.iteritems():
+        scan = steps.get('syslog_scan')
+        if scan is not None and scan.exitstatus == 0:
+            # anything before the JSON is from sudo, not the scan
+            scans[remote] = json.loads(scan.output.splitlines()[-1])
+    _check_syslog_scans(ctx, scans)
+    for remote in sorted(results, key=lambda remote: remote.name):
+        check = results[remote].get('coredump_check')
+        if check is not None and check.exitstatus != 0:
+            _flag_coredumps(ctx, remote)
+
+    _transfer_archive(
+        ctx, [remote for remote, steps in done.iteritems() if 'archive' in steps],
+        archive_dir)
+
+    log.info('Removing archive and test directories...')
+    final_scripts = {}
+    for remote, steps in done.iteritems():
+        script = preflight.StepScript()
+        if 'archive' in steps:
+            script.add('archive', ['rm', '-rf', '--', archive_dir],
+                       fatal=False)
+        if 'base' in steps:
+            # if this fails, one of the earlier cleanups is flawed; don't
+            # just cram an rm -rf here
+            script.add('base', ['rmdir', '--', testdir], fatal=False)
+        final_scripts[remote] = script
+    final_results = preflight.run_scripts(final_scripts)
+
+    preflight.raise_for_failure(scripts, results, ignore=['coredump_check'])
+    preflight.raise_for_failure(final_scripts, final_results)
+
+
 def vm_setup(ctx, config):
     """
     Look for virtual machines and handle their initialization
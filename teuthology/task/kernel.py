@@ -140,15 +140,8 @@ def need_to_install(ctx, role, version):
     ret = True
     log.info('Checking kernel version of {role}, want {ver}...'.format(
              role=role, ver=version))
-    uname_fp = StringIO()
-    ctx.cluster.only(role).run(
-        args=[
-            'uname',
-            '-r',
-            ],
-        stdout=uname_fp,
-        )
-    cur_version = uname_fp.getvalue().rstrip('\n')
+    (role_remote,) = ctx.cluster.only(role).remotes.keys()
+    cur_version = role_remote.facts['kernel']
     log.debug('current kernel version is {ver}'.format(ver=cur_version))
 
     if '.' in version:
@@ -171,7 +164,6 @@ def need_to_install(ctx, role, version):
                 ret = False
         else:
             log.debug('failed to parse current kernel version')
-    uname_fp.close()
     return ret
 
 def install_firmware(ctx, config):
@@ -332,6 +324,8 @@ def install_and_reboot(ctx, config):
     kernel_title = ''
     for role, src in config.iteritems():
         (role_remote,) = ctx.cluster.only(role).remotes.keys()
+        # it's about to boot into a new kernel
+        role_remote.invalidate_facts()
         if src.find('distro') >= 0:
             log.info('Installing distro kernel on {role}...'.format(role=role))
             install_distro_kernel(role_remote)
@@ -555,8 +549,7 @@ def need_to_install_distro(ctx, role):
     (role_remote,) = ctx.cluster.only(role).remotes.keys()
     system_type = teuthology.get_system_type(role_remote)
     output, err_mess = StringIO(), StringIO()
-    role_remote.run(args=['uname', '-r' ], stdout=output, stderr=err_mess )
-    current = output.getvalue().strip()
+    current = role_remote.facts['kernel']
     if system_type == 'rpm':
         role_remote.run(args=['sudo', 'yum', 'install', '-y', 'kernel' ], stdout=output, stderr=err_mess )
         #reset stringIO output.
@@ -0,0 +1,65 @@
+from .. import ceph_manager
+
+
+class TestPGStateSnapshot(object):
+    def make(self, *states):
+        return ceph_manager.PGStateSnapshot(
+            [dict(pgid='0.%d' % i, state=state)
+             for i, state in enumerate(states)])
+
+    def test_tallies(self):
+        pgs = self.make('active+clean',
+                        'active+recovering+degraded',
+                        'down+peering',
+                        'stale+active+clean',
+                        'creating')
+        assert pgs.num_pgs == 5
+        assert pgs.num_active == 2
+        assert pgs.num_active_clean == 1
+        assert pgs.num_active_recovered == 1
+        assert pgs.num_down == 1
+        assert pgs.num_active_down == 3
+        assert pgs.num_creating == 1
+        assert pgs.histogram['active'] == 3
+        assert pgs.histogram['clean'] == 2
+        assert not pgs.is_clean()
+        assert not pgs.is_active_or_down()
+
+    def test_all_clean(self):
+        pgs = self.make('active+clean', 'active+clean')
+        assert pgs.is_clean()
+        assert pgs.is_recovered()
+        assert pgs.is_active()
+        assert pgs.is_active_or_down()
+
+
+class FakeCephManager(ceph_manager.CephManager):
+    def __init__(self):
+        self.dumps = []
+        ceph_manager.CephManager.__init__(
+            self, None, logger=lambda msg: None)
+
+    def list_pools(self):
+        return []
+
+    def raw_cluster_cmd(self, *args):
+        self.pg_snapshot = None
+        self.dumps.append(args)
+        return ('dumped all\n{"pg_stats": '
+                '[{"pgid": "0.0", "state": "active+clean"}]}')
+
+
+class TestCephManagerSnapshot(object):
+    def setup(self):
+        self.manager = FakeCephManager()
+
+    def test_reuses_snapshot(self):
+        assert self.manager.is_clean()
+        assert self.manager.get_num_active() == 1
+        assert self.manager.get_num_pgs() == 1
+        assert len(self.manager.dumps) == 1
+
+    def test_refreshes_when_stale(self):
+        self.manager.is_clean()
+        self.manager.get_pg_snapshot(max_age=-1)
+        assert len(self.manager.dumps) == 2
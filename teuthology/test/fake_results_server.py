@@ -0,0 +1,73 @@
+import json
+import re
+
+from gevent.pywsgi import WSGIServer
+
+
+class FakeResultsServer(object):
+    """
+    A minimal stand-in for the results server, listening on localhost. It
+    understands just enough of the API for ResultsReporter: HEAD of runs, POST
+    and PUT of jobs, and - if batch is True - POST of a list of jobs to the
+    batch endpoint, which answers other methods with a 405.
+    """
+    def __init__(self, batch=True):
+        self.batch = batch
+        # run name -> {job id: job info}
+        self.runs = {}
+        # (method, path) of every request
+        self.requests = []
+        self.server = WSGIServer(('127.0.0.1', 0), self.application,
+                                 log=None)
+
+    def setup(self):
+        self.server.start()
+        self.base_uri = 'http://127.0.0.1:%d/' % self.server.server_port
+
+    def teardown(self):
+        self.server.stop()
+
+    def application(self, environ, start_response):
+        status, body = self.handle(environ)
+        content = json.dumps(body or {})
+        start_response(status, [('Content-Type', 'application/json'),
+                                ('Content-Length', str(len(content)))])
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [content]
+
+    def handle(self, environ):
+        method = environ['REQUEST_METHOD']
+        path = environ['PATH_INFO']
+        self.requests.append((method, path))
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        body = json.loads(environ['wsgi.input'].read(length)) if length \
+            else None
+
+        match = re.match(r'/runs/([^/]+)/(jobs/((\d+|batch)/)?)?$', path)
+        if not match:
+            return '404 Not Found', None
+        run_name, jobs, job_id = match.group(1), match.group(2), \
+            match.group(4)
+        run = self.runs.get(run_name)
+
+        if method == 'HEAD' and not jobs:
+            if run is None:
+                return '404 Not Found', None
+        elif method == 'POST' and jobs and job_id is None:
+            job_id = str(body['job_id'])
+            if job_id in (run or {}):
+                return '400 Bad Request', dict(
+                    message='job with job_id %s already exists' % job_id)
+            self.runs.setdefault(run_name, {})[job_id] = body
+        elif method == 'POST' and job_id == 'batch' and self.batch:
+            for job_info in body:
+                self.runs.setdefault(run_name, {})[
+                    str(job_info['job_id'])] = job_info
+        elif method == 'PUT' and job_id in (run or {}):
+            run[job_id].update(body)
+        elif job_id == 'batch' and self.batch:
+            return '405 Method Not Allowed', None
+        else:
+            return '404 Not Found', None
+        return '200 OK', None
@@ -0,0 +1,94 @@
+import os
+import shutil
+import yaml
+
+from .. import archive
+from ..config import config
+from .fake_archive import FakeArchive
+
+
+class TestArchiveIndex(object):
+    def setup(self):
+        self.archive = FakeArchive()
+        self.archive.setup()
+        self.archive_base = os.path.abspath(self.archive.archive_base)
+        self.jobs = self.archive.create_fake_run(
+            'run', 4, 'examples/3node_ceph.yaml', num_hung=1)
+        self.job_ids = sorted((str(job['job_id']) for job in self.jobs),
+                              key=int)
+        self.hung_id = str(self.jobs[0]['job_id'])
+        self.index = archive.ArchiveIndex(self.archive_base)
+        self.index.racy_window = 0
+
+    def teardown(self):
+        self.index.close()
+        self.archive.teardown()
+
+    def job_dir(self, job_id):
+        return os.path.join(self.archive_base, 'run', job_id)
+
+    def write_summary(self, job_id, summary):
+        with file(os.path.join(self.job_dir(job_id), 'summary.yaml'),
+                  'w') as f:
+            yaml.safe_dump(summary, f)
+
+    def test_jobs(self):
+        jobs = self.index.jobs('run')
+        assert [job['job_id'] for job in jobs] == self.job_ids
+        statuses = dict((job['job_id'], job['status']) for job in jobs)
+        assert statuses[self.hung_id] == 'running'
+        for job in self.jobs[1:]:
+            expected = 'pass' if job['summary']['success'] else 'fail'
+            assert statuses[str(job['job_id'])] == expected
+        assert self.index.runs() == ['run']
+
+    def test_job_finishes(self):
+        self.index.jobs('run')
+        self.write_summary(self.hung_id, dict(success=True, duration=10))
+        mtime = os.path.getmtime(self.job_dir(self.hung_id))
+        os.utime(self.job_dir(self.hung_id), (mtime + 10, mtime + 10))
+        jobs = self.index.jobs('run', status='pass')
+        assert self.hung_id in [job['job_id'] for job in jobs]
+
+    def test_run_removed(self):
+        self.index.update()
+        shutil.rmtree(os.path.join(self.archive_base, 'run'))
+        self.index.update()
+        assert self.index.runs() == []
+
+    def test_verify_and_rebuild(self):
+        self.index.update()
+        assert self.index.verify() == []
+        # change a finished job behind the index's back
+        job_id = str(self.jobs[1]['job_id'])
+        mtime = os.path.getmtime(self.job_dir(job_id))
+        self.write_summary(job_id, dict(success=True, owner='someone'))
+        os.utime(self.job_dir(job_id), (mtime, mtime))
+        problems = self.index.verify()
+        assert ('run', job_id, 'owner', 'job@owner', 'someone') in problems
+        self.index.rebuild()
+        assert self.index.verify() == []
+
+    def test_run_jobs_without_index(self):
+        indexed = archive.run_jobs(os.path.join(self.archive_base, 'run'))
+        orig = (config.archive_index, config.archive_base)
+        config.archive_index = '/nonexistent/index.sqlite'
+        config.archive_base = self.archive_base
+        try:
+            unindexed = archive.run_jobs(
+                os.path.join(self.archive_base, 'run'))
+        finally:
+            config.archive_index, config.archive_base = orig
+        assert unindexed == indexed
+
+    def test_archive_index_only_for_archive_base(self):
+        orig = (config.archive_index, config.archive_base)
+        config.archive_index = '/nonexistent/index.sqlite'
+        config.archive_base = '/nonexistent/archive'
+        try:
+            index = archive.ArchiveIndex(self.archive_base)
+            index.close()
+        finally:
+            config.archive_index, config.archive_base = orig
+        assert index.path == os.path.join(self.archive_base,
+                                          '.teuthology-index.sqlite')
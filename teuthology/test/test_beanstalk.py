@@ -0,0 +1,228 @@
+import os
+import tempfile
+
+import beanstalkc
+
+from .. import beanstalk
+from .. import kill
+from ..config import config
+
+
+class FakeJob(object):
+    def __init__(self, body):
+        self.body = body
+
+
+class FakeBeanstalk(object):
+    """
+    Just enough of beanstalkc.Connection for QueueIndex. Anything that would
+    take jobs away from workers fails the test.
+    """
+    def __init__(self, jobs):
+        # job_id -> (tube, state, priority, body)
+        self.jobs = jobs
+        self.calls = []
+        # tube -> jobs deleted
+        self.deleted = {}
+
+    def stats(self):
+        return {'total-jobs': max(self.jobs) if self.jobs else 0}
+
+    def stats_tube(self, tube):
+        stats = {'cmd-delete': self.deleted.get(tube, 0)}
+        for state in ('ready', 'delayed', 'reserved', 'buried'):
+            stats['current-jobs-' + state] = len(
+                [j for j in self.jobs.values()
+                 if j[0] == tube and j[1] == state])
+        return stats
+
+    def stats_job(self, job_id):
+        self.calls.append(('stats_job', job_id))
+        if job_id not in self.jobs:
+            raise beanstalkc.CommandFailed('stats-job', 'NOT_FOUND', [])
+        tube, state, pri, body = self.jobs[job_id]
+        return dict(id=job_id, tube=tube, state=state, pri=pri)
+
+    def peek(self, job_id):
+        self.calls.append(('peek', job_id))
+        return FakeJob(self.jobs[job_id][3])
+
+    def delete(self, job_id):
+        self.calls.append(('delete', job_id))
+        if self.jobs[job_id][1] != 'ready':
+            raise beanstalkc.CommandFailed('delete', 'NOT_FOUND', [])
+        self.forget(job_id)
+
+    def forget(self, job_id):
+        """
+        Delete a job the way a worker would.
+        """
+        tube = self.jobs.pop(job_id)[0]
+        self.deleted[tube] = self.deleted.get(tube, 0) + 1
+
+    def close(self):
+        pass
+
+    def reserve(self, timeout=None):
+        raise AssertionError('the queue must not be reserved from')
+
+
+def body(name):
+    return 'name: {name}\ndescription: desc of {name}\n'.format(name=name)
+
+
+class TestQueueIndex(object):
+    def setup(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.index = beanstalk.QueueIndex(self.path)
+
+    def teardown(self):
+        self.index.close()
+        os.remove(self.path)
+
+    def test_first_scan(self):
+        conn = FakeBeanstalk({
+            1: ('plana', 'ready', 10, body('old')),
+            2: ('mira', 'ready', 10, body('other')),
+            3: ('plana', 'ready', 20, body('run-a')),
+            4: ('plana', 'buried', 10, body('running')),
+        })
+        jobs = self.index.reconcile(conn, 'plana')
+        assert [job['job_id'] for job in jobs] == [1, 3]
+        assert jobs[1]['name'] == 'run-a'
+        assert jobs[1]['priority'] == 20
+        assert jobs[1]['description'] == 'desc of run-a'
+
+    def test_stops_when_all_found(self):
+        jobs = dict((i, ('mira', 'ready', 10, body('r')))
+                    for i in range(1, 101))
+        jobs.update((i, ('plana', 'ready', 10, body('r')))
+                    for i in range(91, 96))
+        jobs.update((i, ('plana', 'buried', 10, body('r')))
+                    for i in range(96, 101))
+        conn = FakeBeanstalk(jobs)
+        self.index.scan_new_jobs(conn, 'plana')
+        assert len(self.index.jobs('plana')) == 5
+        assert ('stats_job', 90) not in conn.calls
+
+    def test_first_scan_reserved_meanwhile(self):
+        """
+        The walk ends once every job of the tube has been seen, even if one
+        was reserved in between.
+        """
+        jobs = dict((i, ('mira', 'ready', 10, body('r')))
+                    for i in range(1, 101))
+        jobs.update((i, ('plana', 'ready', 10, body('r')))
+                    for i in range(91, 101))
+        conn = FakeBeanstalk(jobs)
+        orig_stats_job = conn.stats_job
+
+        def stats_job(job_id):
+            if job_id == 100:
+                conn.jobs[91] = ('plana', 'reserved', 10, body('r'))
+            return orig_stats_job(job_id)
+        conn.stats_job = stats_job
+        self.index.scan_new_jobs(conn, 'plana')
+        assert len(self.index.jobs('plana')) == 9
+        assert ('stats_job', 90) not in conn.calls
+
+    def test_first_scan_deleted_meanwhile(self):
+        """
+        Jobs deleted during the walk don't make it go on to job id 1.
+        """
+        self.index.recount_interval = 10
+        jobs = dict((i, ('mira', 'ready', 10, body('r')))
+                    for i in range(1, 1001))
+        jobs.update((i, ('plana', 'buried', 10, body('r')))
+                    for i in range(800, 811))
+        jobs[1000] = ('plana', 'ready', 10, body('r'))
+        conn = FakeBeanstalk(jobs)
+        orig_stats_job = conn.stats_job
+
+        def stats_job(job_id):
+            if job_id == 999:
+                # a worker finishes a job we haven't walked to yet
+                conn.forget(800)
+            return orig_stats_job(job_id)
+        conn.stats_job = stats_job
+        self.index.scan_new_jobs(conn, 'plana')
+        assert [job['job_id'] for job in self.index.jobs('plana')] == [1000]
+        assert ('stats_job', 790) not in conn.calls
+
+    def test_delayed_indexed(self):
+        conn = FakeBeanstalk({
+            1: ('plana', 'ready', 10, body('run-a')),
+        })
+        self.index.scan_new_jobs(conn, 'plana')
+        conn.jobs[2] = ('plana', 'delayed', 10, body('run-a'))
+        conn.jobs[3] = ('plana', 'buried', 10, body('run-a'))
+        jobs = self.index.reconcile(conn, 'plana')
+        assert [job['job_id'] for job in jobs] == [1, 2]
+
+    def test_only_matching_and_new_jobs_checked(self):
+        conn = FakeBeanstalk({
+            1: ('plana', 'ready', 10, body('run-a')),
+            2: ('plana', 'ready', 10, body('run-b')),
+        })
+        self.index.scan_new_jobs(conn, 'plana')
+        conn.jobs[3] = ('plana', 'ready', 10, body('run-b'))
+        del conn.jobs[2]
+        conn.calls = []
+        jobs = self.index.reconcile(conn, 'plana', name='run-b')
+        assert [job['job_id'] for job in jobs] == [3]
+        assert ('stats_job', 1) not in conn.calls
+        # job 2 is gone from the queue, so from the index too
+        assert [job['job_id'] for job in self.index.jobs('plana')] == [1, 3]
+
+    def test_beanstalkd_restarted(self):
+        conn = FakeBeanstalk({
+            1: ('plana', 'ready', 10, body('run-a')),
+        })
+        self.index.scan_new_jobs(conn, 'plana')
+        # job ids carry on from the binlog, but total-jobs starts over
+        conn.jobs[5] = ('plana', 'ready', 10, body('run-b'))
+        conn.stats = lambda: {'total-jobs': 1}
+        self.index.scan_new_jobs(conn, 'plana')
+        assert [job['job_id'] for job in self.index.jobs('plana')] == [1, 5]
+
+    def test_pattern(self):
+        self.index.add_many([(1, 'plana', dict(name='teuthology-a'), 1),
+                             (2, 'plana', dict(name='other'), 1)])
+        assert [job['job_id'] for job in
+                self.index.jobs('plana', pattern='teuth')] == [1]
+
+
+class TestRemoveBeanstalkJobs(object):
+    def setup(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.orig = (config.queue_index, kill.beanstalk.connect)
+        config.queue_index = self.path
+
+    def teardown(self):
+        config.queue_index, kill.beanstalk.connect = self.orig
+        os.remove(self.path)
+
+    def test_job_reserved_meanwhile(self):
+        conn = FakeBeanstalk({
+            1: ('plana', 'ready', 10, body('run-a')),
+            2: ('plana', 'ready', 10, body('run-a')),
+        })
+        kill.beanstalk.connect = lambda: conn
+        index = beanstalk.QueueIndex()
+        index.scan_new_jobs(conn, 'plana')
+        # a worker reserves job 1 between reconcile() and delete()
+        orig_stats_job = conn.stats_job
+
+        def stats_job(job_id):
+            stats = orig_stats_job(job_id)
+            if job_id == 2:
+                conn.jobs[1] = conn.jobs[1][:1] + ('reserved',) + \
+                    conn.jobs[1][2:]
+            return stats
+        conn.stats_job = stats_job
+        kill.remove_beanstalk_jobs('run-a', 'plana')
+        assert ('delete', 2) in conn.calls
+        assert [job['job_id'] for job in index.jobs('plana')] == [1]
+        index.close()
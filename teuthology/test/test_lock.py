@@ -0,0 +1,213 @@
+import json
+import urlparse
+
+from .. import lock
+
+
+class TestReserveMany(object):
+    def setup(self):
+        self.requests = []
+        self.responses = []
+        self.orig_send = lock.ls.send_request
+        lock.ls.send_request = self.send_request
+
+    def teardown(self):
+        lock.ls.send_request = self.orig_send
+
+    def send_request(self, method, url, body=None, headers=None):
+        self.requests.append((method, url, urlparse.parse_qs(body)))
+        return self.responses.pop(0)
+
+    def test_keeps_ticket(self):
+        self.responses = [
+            (True, json.dumps(dict(ticket=7, position=2, machines=None,
+                                   type='plana')), 200),
+            (True, json.dumps(dict(ticket=7, position=0,
+                                   machines={'a': 'key'}, type='plana')),
+             200),
+        ]
+        machines = lock.reserve_many(None, 1, 'plana', user='me',
+                                     timeout=5)
+        assert machines == {'a': 'key'}
+        assert self.requests[0][2]['timeout'] == ['5']
+        assert 'ticket' not in self.requests[0][2]
+        assert self.requests[1][2]['ticket'] == ['7']
+        assert self.requests[1][1].endswith('/reserve')
+
+    def test_old_server(self):
+        self.responses = [(False, None, 404)]
+        assert lock.reserve_many(None, 1, 'plana', user='me') is None
+
+
+class TestListLocks(object):
+    def setup(self):
+        self.urls = []
+        self.machines = [
+            dict(name='a', type='plana', up=1, locked=1, locked_by='me',
+                 description='run-1'),
+            dict(name='b', type='mira', up=1, locked=0, locked_by=None,
+                 description=None),
+            dict(name='c', type='plana', up=0, locked=1, locked_by='you',
+                 description='run-2'),
+        ]
+        self.orig_get = lock.ls.get_cached
+        lock.ls.get_cached = self.get_cached
+
+    def teardown(self):
+        lock.ls.get_cached = self.orig_get
+
+    def get_cached(self, url):
+        self.urls.append(url)
+        # behave like a lock server that ignores the filters
+        return (True, json.dumps(self.machines), 200)
+
+    def query(self):
+        return urlparse.parse_qs(urlparse.urlparse(self.urls[-1]).query)
+
+    def test_no_filters(self):
+        assert lock.list_locks() == self.machines
+        assert '?' not in self.urls[0]
+
+    def test_query(self):
+        lock.list_locks(machine_type='plana,mira', up=True, locked=False,
+                        owner='me', desc_pattern='run', fields=['arch'])
+        assert self.query() == dict(type=['plana,mira'], up=['true'],
+                                    locked=['false'], owner=['me'],
+                                    desc_pattern=['run'],
+                                    fields=['arch,type,up,locked,locked_by,'
+                                            'description'])
+
+    def test_filtered_locally(self):
+        names = lambda machines: [m['name'] for m in machines]  # noqa
+        assert names(lock.list_locks(machine_type='plana')) == ['a', 'c']
+        assert names(lock.list_locks(up=True, locked=True)) == ['a']
+        assert names(lock.list_locks(owner='you')) == ['c']
+        assert names(lock.list_locks(desc_pattern='run')) == ['a', 'c']
+        assert names(lock.list_locks(description='run-2')) == ['c']
+
+    def test_fields_filtered_locally(self):
+        self.machines = [dict(name=m['name'], description=m['description'],
+                              locked=m['locked'])
+                         for m in self.machines]
+        machines = lock.list_locks(locked=True, fields=['description'])
+        assert [m['name'] for m in machines] == ['a', 'c']
+        assert self.query()['fields'] == ['description,locked']
+
+    def test_no_matches(self):
+        lock.ls.get_cached = lambda url: (False, None, 404)
+        assert lock.list_locks(owner='nobody') == []
+        assert lock.list_locks() is None
+
+
+class FakeHttp(object):
+    responses = []
+    requests = []
+
+    def request(self, url, method='GET', body=None, headers=None):
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+
+class FakeResponse(dict):
+    def __init__(self, status, **headers):
+        super(FakeResponse, self).__init__(headers)
+        self.status = status
+
+
+class TestGetCached(object):
+    def setup(self):
+        self.orig_http = lock.ls.httplib2.Http
+        lock.ls.httplib2.Http = FakeHttp
+        FakeHttp.requests = []
+        lock.ls._etag_cache.clear()
+        del lock.ls._idle_clients[:]
+
+    def teardown(self):
+        lock.ls.httplib2.Http = self.orig_http
+        lock.ls._etag_cache.clear()
+        del lock.ls._idle_clients[:]
+
+    def test_not_modified(self):
+        FakeHttp.responses = [
+            (FakeResponse(200, etag='"x"'), '[1]'),
+            (FakeResponse(304), ''),
+        ]
+        assert lock.ls.get_cached('http://lock') == (True, '[1]', 200)
+        assert lock.ls.get_cached('http://lock') == (True, '[1]', 200)
+        assert FakeHttp.requests == [('http://lock', {}),
+                                     ('http://lock', {'If-None-Match': '"x"'})]
+
+    def test_failure(self):
+        FakeHttp.responses = [(FakeResponse(500), '')]
+        assert lock.ls.get_cached('http://lock') == (False, None, 500)
+
+
+class TestRequest(object):
+    def setup(self):
+        self.orig = (lock.ls.httplib2.Http, lock.ls.time.sleep)
+        lock.ls.httplib2.Http = FakeHttp
+        lock.ls.time.sleep = lambda seconds: None
+        FakeHttp.requests = []
+        del lock.ls._idle_clients[:]
+        lock.ls.request_stats.clear()
+
+    def teardown(self):
+        lock.ls.httplib2.Http, lock.ls.time.sleep = self.orig
+        del lock.ls._idle_clients[:]
+        lock.ls.request_stats.clear()
+
+    def test_reuses_client(self):
+        FakeHttp.responses = [(FakeResponse(200), '{}'),
+                              (FakeResponse(200), '{}')]
+        lock.ls.send_request('GET', 'http://lock/a')
+        client = lock.ls._idle_clients[0]
+        lock.ls.send_request('GET', 'http://lock/b')
+        assert lock.ls._idle_clients == [client]
+
+    def test_retries_idempotent(self):
+        FakeHttp.responses = [(FakeResponse(503), ''),
+                              (FakeResponse(200), '{}')]
+        assert lock.ls.send_request('PUT', 'http://lock/a') == \
+            (True, '{}', 200)
+        assert len(FakeHttp.requests) == 2
+
+    def test_no_post_retry(self):
+        FakeHttp.responses = [(FakeResponse(503), '')]
+        assert lock.ls.send_request('POST', 'http://lock/') == \
+            (False, None, 503)
+
+    def test_stats(self):
+        orig_server = lock.ls.config.lock_server
+        lock.ls.config.lock_server = 'http://host/lock'
+        try:
+            FakeHttp.responses = [(FakeResponse(200), '{}'),
+                                  (FakeResponse(404), '')]
+            lock.ls.send_request('GET', 'http://host/lock/ubuntu@a')
+            lock.ls.send_request('GET', 'http://host/lock/ubuntu@b')
+        finally:
+            lock.ls.config.lock_server = orig_server
+        stats = lock.ls.request_stats[('GET', '/lock/<name>')]
+        assert stats['count'] == 2
+
+
+class TestGetStatuses(object):
+    def setup(self):
+        self.urls = []
+        self.orig_send = lock.ls.send_request
+        lock.ls.send_request = self.send_request
+
+    def teardown(self):
+        lock.ls.send_request = self.orig_send
+
+    def send_request(self, method, url, body=None, headers=None):
+        self.urls.append(url)
+        # an old lock server ignores the name filter
+        return (True, json.dumps([dict(name='a'), dict(name='b'),
+                                  dict(name='c')]), 200)
+
+    def test_one_request(self):
+        statuses = lock.ls.get_statuses(None, ['a', 'c'])
+        assert statuses == dict(a=dict(name='a'), c=dict(name='c'))
+        assert len(self.urls) == 1
+        query = urlparse.parse_qs(urlparse.urlparse(self.urls[0]).query)
+        assert query == dict(name=['a,c'])
@@ -1,4 +1,7 @@
 import argparse
+import gevent.event
+import tarfile
+from cStringIO import StringIO
 from ..orchestra import cluster
 from .. import misc
 from ..config import config
@@ -50,3 +53,77 @@ def test_get_http_log_path():
 
     path = misc.get_http_log_path(archive_dir)
     assert path == "http://qa-proxy.ceph.com/teuthology/teuthology-2013-09-12_11:49:50-ceph-deploy-master-testing-basic-vps/"
+
+
+
+class FakeMountRemote(object):
+    facts = dict(
+        scratch_candidates=['/dev/vda', '/dev/vdb', '/dev/vdc', '/dev/vdd'],
+        scratch_readable=['/dev/vda', '/dev/vdb', '/dev/vdc'],
+        )
+
+    def __init__(self, mounts):
+        self.mounts = mounts
+        self.runs = []
+
+    def run(self, args, stdout):
+        self.runs.append(args)
+        stdout.write(self.mounts)
+        return FakeTarProcess(stdout)
+
+
+def test_get_scratch_devices():
+    remote = FakeMountRemote('/dev/vdc on /mnt type xfs (rw)\n')
+    assert misc.get_scratch_devices(remote) == ['/dev/vdb']
+    assert remote.runs == [['mount']]
+
+class FakeTarProcess(object):
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.exitstatus = gevent.event.AsyncResult()
+        self.exitstatus.set(0)
+
+
+def test_pull_directory_streams(tmpdir):
+    src = tmpdir.mkdir('src')
+    src.mkdir('sub').join('file.log').write('hello')
+    buf = StringIO()
+    tar = tarfile.open(mode='w:gz', fileobj=buf)
+    tar.add(str(src), arcname='.')
+    tar.close()
+    buf.seek(0)
+
+    remote = FakeRemote()
+    remote.shortname = 'fake'
+    remote.get_tar_stream = lambda path, sudo: FakeTarProcess(buf)
+    dest = tmpdir.join('dest')
+    misc.pull_directory(remote, '/remote/dir', str(dest))
+    assert dest.join('sub', 'file.log').read() == 'hello'
+    assert buf.tell() == len(buf.getvalue())
+
+
+def test_pull_directories_partial_failure():
+    ctx = argparse.Namespace(config={}, summary={})
+    bad = FakeRemote()
+    bad.shortname = 'bad'
+    good = FakeRemote()
+    good.shortname = 'good'
+    pulled = []
+
+    def pull(remote, remotedir, localpath, rate_limiter=None):
+        if remote is bad:
+            raise RuntimeError('no route to host')
+        pulled.append(remote)
+        return 42
+
+    with pytest.raises(RuntimeError):
+        misc.pull_directories(
+            ctx,
+            [('bad', pull, bad, '/dir', '/tmp/bad'),
+             ('good', pull, good, '/dir', '/tmp/good')],
+            'archive_transfers',
+            )
+    assert pulled == [good]
+    report = ctx.summary['archive_transfers']
+    assert report['bad'] == dict(failed=True)
+    assert report['good']['bytes'] == 42
@@ -0,0 +1,35 @@
+import gevent
+from pytest import raises
+from teuthology.parallel import parallel
+
+
+class TestParallel(object):
+
+    def test_results(self):
+        with parallel() as p:
+            for i in range(5):
+                p.spawn(lambda x: x * 2, i)
+            results = sorted(p)
+        assert results == [0, 2, 4, 6, 8]
+
+    def test_exception(self):
+        def fail():
+            raise RuntimeError('boom')
+
+        with raises(RuntimeError):
+            with parallel() as p:
+                p.spawn(fail)
+
+    def test_size(self):
+        state = dict(running=0, most=0)
+
+        def work():
+            state['running'] += 1
+            state['most'] = max(state['most'], state['running'])
+            gevent.sleep(0.01)
+            state['running'] -= 1
+
+        with parallel(size=2) as p:
+            for i in range(6):
+                p.spawn(work)
+        assert state['most'] == 2
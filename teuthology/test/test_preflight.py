@@ -0,0 +1,227 @@
+import argparse
+import collections
+import json
+import os
+import subprocess
+
+import pytest
+
+from ..orchestra import cluster, run
+from .. import preflight
+from ..task import internal
+
+
+class LocalRemote(object):
+    """
+    Runs commands on this host.
+    """
+    def __init__(self, name):
+        self.name = self.shortname = name
+
+    def run(self, args, stdin, stdout):
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        stdout.write(proc.communicate(stdin)[0])
+        return argparse.Namespace(stdout=stdout, exitstatus=proc.returncode)
+
+
+class TestStepScript(object):
+    def setup(self):
+        self.remote = LocalRemote('local')
+
+    def test_results(self):
+        script = preflight.StepScript()
+        script.add('one', ['echo', 'hello world'])
+        script.add('two', 'echo oops >&2; printf partial; exit 3',
+                   fatal=False)
+        script.add('three', ['true'])
+        results = script.run(self.remote)
+        assert results.keys() == ['one', 'two', 'three']
+        assert results['one'] == (0, 'hello world\n')
+        assert results['two'] == (3, 'oops\npartial')
+        assert results['three'] == (0, '')
+
+    def test_fatal(self):
+        script = preflight.StepScript()
+        script.add('one', ['false'])
+        script.add('two', ['true'])
+        assert script.run(self.remote).keys() == ['one']
+
+    def test_stdin(self):
+        script = preflight.StepScript()
+        script.add('cat', ['cat'], stdin="it's\n$HOME `x`")
+        script.add('no_stdin', ['cat'])
+        results = script.run(self.remote)
+        assert results['cat'].output == "it's\n$HOME `x`\n"
+        assert results['no_stdin'].output == ''
+
+    def test_raise_for_failure(self):
+        script = preflight.StepScript()
+        script.add('ok', ['true'], fatal=False)
+        script.add('bad', ['test', '-e', '/nonexistent'], fatal=False)
+        scripts = {self.remote: script}
+        results = preflight.run_scripts(scripts)
+        preflight.raise_for_failure(scripts, results, ignore=['bad'])
+        with pytest.raises(run.CommandFailedError) as excinfo:
+            preflight.raise_for_failure(scripts, results)
+        assert excinfo.value.command == 'test -e /nonexistent'
+        assert excinfo.value.node == 'local'
+
+
+class TestCheckHosts(object):
+    def setup(self):
+        self.remotes = [LocalRemote('a'), LocalRemote('b')]
+        self.ctx = argparse.Namespace()
+        self.ctx.cluster = cluster.Cluster(
+            remotes=[(remote, ['role']) for remote in self.remotes])
+
+    def test_ok(self, tmpdir):
+        self.ctx.teuthology_config = dict(
+            test_path=os.path.join(str(tmpdir), 'cephtest'))
+        internal.check_hosts(self.ctx, dict(ceph_data=False))
+
+    def test_conflict(self, tmpdir):
+        self.ctx.teuthology_config = dict(test_path=str(tmpdir))
+        with pytest.raises(RuntimeError) as excinfo:
+            internal.check_hosts(self.ctx, dict(ceph_data=False))
+        assert str(excinfo.value) == 'Stale jobs detected, aborting.'
+
+
+class FakeRemote(object):
+    def __init__(self, name):
+        self.name = self.shortname = name
+        self.facts = None
+
+    def __str__(self):
+        return self.name
+
+    def load_facts(self, output):
+        self.facts = output
+
+
+class TestSetupHosts(object):
+    """
+    Runs setup_hosts with a fake run_scripts, which fails the steps listed
+    in self.failures.
+    """
+    def setup(self):
+        self.remotes = [FakeRemote('a'), FakeRemote('b')]
+        self.ctx = argparse.Namespace(
+            teuthology_config=dict(test_path='/tmp/cephtest'),
+            archive='/archive/job',
+            summary=dict(),
+            )
+        self.ctx.cluster = cluster.Cluster(
+            remotes=[(remote, ['role']) for remote in self.remotes])
+        # (remote name, step name) -> exitstatus
+        self.failures = {}
+        # step name -> output
+        self.outputs = dict(
+            facts='{}',
+            syslog_scan=json.dumps(dict(counts=dict(), hits=dict(error=[]))),
+            )
+        self.calls = []
+        self.transferred = None
+        self.orig_run_scripts = internal.preflight.run_scripts
+        self.orig_transfer_archive = internal._transfer_archive
+        internal.preflight.run_scripts = self.fake_run_scripts
+        internal._transfer_archive = self.fake_transfer_archive
+
+    def teardown(self):
+        internal.preflight.run_scripts = self.orig_run_scripts
+        internal._transfer_archive = self.orig_transfer_archive
+
+    def fake_run_scripts(self, scripts):
+        self.calls.append(dict(
+            (remote.name, [step.name for step in script.steps])
+            for remote, script in scripts.iteritems()))
+        results = {}
+        for remote, script in scripts.iteritems():
+            steps = collections.OrderedDict()
+            for step in script.steps:
+                exitstatus = self.failures.get((remote.name, step.name), 0)
+                steps[step.name] = preflight.StepResult(
+                    exitstatus, self.outputs.get(step.name, ''))
+                if exitstatus != 0 and step.fatal:
+                    break
+            results[remote] = steps
+        return results
+
+    def fake_transfer_archive(self, ctx, remotes, archive_dir):
+        self.transferred = sorted(remote.name for remote in remotes)
+
+    def test_ok(self):
+        with internal.setup_hosts(self.ctx, None):
+            pass
+        setup, teardown, final = self.calls
+        assert setup['a'] == ['base', 'archive', 'coredump', 'sudo',
+                              'syslog', 'syslog_conf', 'syslog_restart',
+                              'facts']
+        assert teardown['a'] == ['syslog', 'syslog_scan', 'syslog_gzip',
+                                 'sudo', 'coredump', 'coredump_check']
+        assert final['a'] == ['archive', 'base']
+        assert self.transferred == ['a', 'b']
+        assert self.remotes[0].facts == '{}'
+        assert self.ctx.summary == dict()
+
+    def test_partial_failure(self):
+        self.failures[('b', 'sudo')] = 1
+        with pytest.raises(run.CommandFailedError) as excinfo:
+            with internal.setup_hosts(self.ctx, None):
+                raise AssertionError('should not get here')
+        assert excinfo.value.node == 'b'
+        # only what succeeded on b is undone there
+        setup, teardown, final = self.calls
+        assert teardown['a'] == ['syslog', 'syslog_scan', 'syslog_gzip',
+                                 'sudo', 'coredump', 'coredump_check']
+        assert teardown['b'] == ['coredump', 'coredump_check']
+        assert final['b'] == ['archive', 'base']
+        assert self.transferred == ['a', 'b']
+        assert self.remotes[1].facts is None
+
+    def test_early_failure(self):
+        self.failures[('a', 'archive')] = 1
+        with pytest.raises(run.CommandFailedError) as excinfo:
+            with internal.setup_hosts(self.ctx, None):
+                pass
+        assert excinfo.value.node == 'a'
+        setup, teardown, final = self.calls
+        assert teardown['a'] == []
+        assert final['a'] == ['base']
+        assert self.transferred == ['b']
+
+    def test_facts_not_fatal(self):
+        self.failures[('a', 'facts')] = 1
+        with internal.setup_hosts(self.ctx, None):
+            pass
+        assert self.remotes[0].facts is None
+        assert self.remotes[1].facts == '{}'
+
+    def test_syslog_scan(self):
+        self.outputs['syslog_scan'] = '\n'.join([
+            'sudo: unable to resolve host b',
+            json.dumps(dict(
+                counts=dict(error=1),
+                hits=dict(error=[['kern.log', 'BUG: oops']]),
+                )),
+            ])
+        with internal.setup_hosts(self.ctx, None):
+            pass
+        assert self.ctx.summary['success'] is False
+        assert self.ctx.summary['failure_reason'] == \
+            "'kern.log:BUG: oops' in syslog"
+
+    def test_coredumps(self):
+        self.failures[('b', 'coredump_check')] = 1
+        with internal.setup_hosts(self.ctx, None):
+            pass
+        assert self.ctx.summary['success'] is False
+        assert 'Found coredumps on b' == self.ctx.summary['failure_reason']
+
+    def test_no_archive(self):
+        self.ctx.archive = None
+        with internal.setup_hosts(self.ctx, None):
+            pass
+        setup, teardown, final = self.calls
+        assert 'syslog' not in setup['a']
+        assert teardown['a'] == ['sudo', 'coredump', 'coredump_check']
@@ -1,6 +1,16 @@
+import gevent
+import gevent.event
+import os
+import pytest
+import requests
+import shutil
+import subprocess
+import tempfile
+import time
 import yaml
 import json
 import fake_archive
+from fake_results_server import FakeResultsServer
 from .. import report
 
 
@@ -75,3 +85,225 @@ class TestSerializer(object):
         assert full_obj == out_obj
 
 
+
+
+class TestReporter(object):
+    def setup(self):
+        self.archive = fake_archive.FakeArchive()
+        self.archive.setup()
+        self.jobs = self.archive.create_fake_run(
+            'test_reporter', 5, 'examples/3node_ceph.yaml')
+        self.job_ids = [str(job['job_id']) for job in self.jobs]
+
+    def teardown(self):
+        self.archive.teardown()
+        self.server.teardown()
+
+    def start(self, batch):
+        self.server = FakeResultsServer(batch=batch)
+        self.server.setup()
+        self.reporter = report.ResultsReporter(
+            archive_base=self.archive.archive_base,
+            base_uri=self.server.base_uri, concurrency=3)
+        self.reporter.batch_size = 2
+
+    def test_batched(self):
+        self.start(batch=True)
+        self.reporter.report_run('test_reporter')
+        assert sorted(self.server.runs['test_reporter'].keys()) == \
+            sorted(self.job_ids)
+        posts = [r for r in self.server.requests if r[0] == 'POST']
+        assert posts == [('POST', '/runs/test_reporter/jobs/batch/')] * 3
+        assert self.reporter.batch_supported is True
+
+    def test_fallback(self):
+        self.start(batch=False)
+        self.reporter.report_run('test_reporter')
+        assert sorted(self.server.runs['test_reporter'].keys()) == \
+            sorted(self.job_ids)
+        assert self.reporter.batch_supported is False
+        # the first batch is retried job by job, which creates the run; the
+        # endpoint is then probed, and no more batches are tried
+        batches = [r for r in self.server.requests
+                   if r[1].endswith('/batch/')]
+        assert batches == [('POST', '/runs/test_reporter/jobs/batch/'),
+                           ('HEAD', '/runs/test_reporter/jobs/batch/')]
+        # not even for the next run
+        self.reporter.report_jobs('next_run', self.job_ids)
+        assert len([r for r in self.server.requests
+                    if r[1].endswith('/batch/')]) == 2
+
+    def test_missing_run_keeps_batching(self):
+        self.start(batch=True)
+        orig_handle = self.server.handle
+
+        def handle(environ):
+            # a batch endpoint that doesn't create runs
+            if environ['PATH_INFO'].endswith('/batch/') and \
+                    'test_reporter' not in self.server.runs:
+                self.server.requests.append(('POST', environ['PATH_INFO']))
+                return '404 Not Found', None
+            return orig_handle(environ)
+        self.server.handle = handle
+        self.reporter.report_run('test_reporter')
+        assert sorted(self.server.runs['test_reporter'].keys()) == \
+            sorted(self.job_ids)
+        assert self.reporter.batch_supported is True
+
+    def test_fallback_updates(self):
+        self.start(batch=False)
+        self.reporter.report_jobs('test_reporter', self.job_ids)
+        self.reporter.report_jobs('test_reporter', self.job_ids, dead=True)
+        puts = [r for r in self.server.requests if r[0] == 'PUT']
+        assert len(puts) == len(self.job_ids)
+
+
+class FakeReporter(object):
+    base_uri = 'http://results'
+
+    def __init__(self):
+        self.posted = []
+        self.error = None
+        # if set, posting waits for it
+        self.gate = None
+
+    def post_jobs(self, run_name, job_infos):
+        if self.gate is not None:
+            self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        self.posted.append((run_name, job_infos))
+        return len(job_infos)
+
+
+class TestPushQueue(object):
+    def setup(self):
+        self.spool_dir = tempfile.mkdtemp()
+        self.reporter = FakeReporter()
+        self.queue = report.PushQueue(self.spool_dir, reporter=self.reporter)
+        self.queue.retry_backoff = 0
+
+    def teardown(self):
+        if self.queue.sender is not None:
+            self.queue.sender.kill()
+        shutil.rmtree(self.spool_dir)
+
+    def test_coalesces(self):
+        self.reporter.error = requests.exceptions.ConnectionError()
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        self.queue.put(dict(name='run', job_id='1', success=True))
+        self.queue.put(dict(name='run', job_id='1', status='dead'))
+        self.queue.put(dict(name='run', job_id='2', status='queued'))
+        entries = self.queue.pending()
+        assert [entry['job_info'] for _, entry in entries] == [
+            dict(name='run', job_id='1', success=True),
+            dict(name='run', job_id='2', status='queued'),
+        ]
+        stats = self.queue.stats()
+        assert stats['depth'] == 2
+
+    def test_replays_after_outage(self):
+        self.reporter.error = requests.exceptions.ConnectionError()
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        gevent.sleep(0.1)
+        assert self.queue.failures > 0
+        assert self.queue.stats()['depth'] == 1
+
+        # a new process picks up what is spooled
+        self.queue.sender.kill()
+        reporter = FakeReporter()
+        queue = report.PushQueue(self.spool_dir, reporter=reporter)
+        assert queue.send_pending() == 1
+        assert reporter.posted == [
+            ('run', [dict(name='run', job_id='1', status='running')])]
+        assert os.listdir(self.spool_dir) == ['.lock']
+
+    def test_flush(self):
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        self.queue.put(dict(name='other', job_id='2', status='running'))
+        assert self.queue.flush(timeout=5)
+        assert sorted(run for run, _ in self.reporter.posted) == \
+            ['other', 'run']
+        assert self.queue.stats()['depth'] == 0
+
+    def test_flush_during_outage(self):
+        self.queue.retry_backoff = 300
+        self.reporter.error = requests.exceptions.ConnectionError()
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        gevent.sleep(0.1)
+        assert self.queue.failures == 1
+        # doesn't wait out the backoff, nor the timeout once the retry fails
+        start = time.time()
+        assert not self.queue.flush(timeout=5)
+        assert time.time() - start < 1
+        assert self.queue.failures == 2
+        assert self.queue.flushed
+
+    def test_drops_rejected(self):
+        response = requests.models.Response()
+        response.status_code = 400
+        self.reporter.error = requests.exceptions.HTTPError(
+            response=response)
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        assert self.queue.flush(timeout=5)
+        assert self.queue.failures == 0
+
+    def test_shared_spool(self):
+        """
+        A queue doesn't send a job's update while another queue is sending
+        the job's previous one.
+        """
+        self.reporter.gate = gevent.event.Event()
+        # put() into the spool only; nothing sends it yet
+        self.queue.start = lambda: None
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        # another process's queue picks it up
+        reporter = FakeReporter()
+        reporter.gate = gevent.event.Event()
+        other = report.PushQueue(self.spool_dir, reporter=reporter)
+        sending = gevent.spawn(other.send_pending)
+        gevent.sleep(0.1)
+        self.queue.put(dict(name='run', job_id='1', success=True))
+        self.reporter.gate.set()
+        assert self.queue.send_pending() == 0
+        assert self.queue.blocked
+        reporter.gate.set()
+        assert sending.get() == 1
+        assert self.queue.send_pending() == 1
+        assert reporter.posted == [
+            ('run', [dict(name='run', job_id='1', status='running')])]
+        assert self.reporter.posted == [
+            ('run', [dict(name='run', job_id='1', success=True)])]
+        assert os.listdir(self.spool_dir) == ['.lock']
+
+    def test_failed_send_unclaims(self):
+        self.queue.start = lambda: None
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        self.reporter.gate = gevent.event.Event()
+        self.reporter.error = requests.exceptions.ConnectionError()
+        sending = gevent.spawn(self.queue.send_pending)
+        gevent.sleep(0.1)
+        assert self.queue.flush(timeout=0) is False
+        self.queue.put(dict(name='run', job_id='1', success=True))
+        self.reporter.gate.set()
+        with pytest.raises(requests.exceptions.ConnectionError):
+            sending.get()
+        # the newer update was merged into the one that wasn't sent
+        entries = self.queue.pending()
+        assert [entry['job_info'] for _, entry in entries] == [
+            dict(name='run', job_id='1', success=True)]
+        assert sorted(os.listdir(self.spool_dir)) == \
+            ['.lock', 'run.1.json']
+
+    def test_takes_back_dead_claims(self):
+        self.queue.start = lambda: None
+        self.queue.put(dict(name='run', job_id='1', status='running'))
+        proc = subprocess.Popen(['true'])
+        proc.wait()
+        path = os.path.join(self.spool_dir, 'run.1.json')
+        os.rename(path, '{path}.sending.{pid}-0'.format(path=path,
+                                                        pid=proc.pid))
+        assert self.queue.send_pending() == 1
+        assert self.reporter.posted == [
+            ('run', [dict(name='run', job_id='1', status='running')])]
+        assert os.listdir(self.spool_dir) == ['.lock']
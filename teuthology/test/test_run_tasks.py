@@ -0,0 +1,135 @@
+import argparse
+import contextlib
+import os
+
+import gevent
+import pytest
+import yaml
+
+from .. import run_tasks
+from .. import timing
+
+
+class TestRunTasks(object):
+    def setup(self):
+        self.events = []
+        self.orig_run_one_task = run_tasks.run_one_task
+        run_tasks.run_one_task = self.run_one_task
+        self.orig_profile = timing.profile
+        timing.profile = timing.Profile()
+        self.ctx = argparse.Namespace(summary=dict(success=True), config={},
+                                      owner='me', archive=None)
+
+    def teardown(self):
+        run_tasks.run_one_task = self.orig_run_one_task
+        timing.profile = self.orig_profile
+
+    def run_one_task(self, taskname, ctx, config):
+        """
+        config is how long to take entering, 'fail' or 'interrupt'.
+        """
+        @contextlib.contextmanager
+        def task():
+            self.events.append(('start', taskname))
+            if config == 'fail':
+                raise RuntimeError('{name} failed'.format(name=taskname))
+            if config == 'interrupt':
+                raise KeyboardInterrupt()
+            gevent.sleep(config or 0)
+            self.events.append(('entered', taskname))
+            try:
+                yield
+            finally:
+                self.events.append(('exit', taskname))
+        return task()
+
+    def test_sequential(self):
+        run_tasks.run_tasks([{'a': None}, {'b': None}, {'c': None}],
+                            self.ctx)
+        assert self.events == [
+            ('start', 'a'), ('entered', 'a'),
+            ('start', 'b'), ('entered', 'b'),
+            ('start', 'c'), ('entered', 'c'),
+            ('exit', 'c'), ('exit', 'b'), ('exit', 'a'),
+            ]
+
+    def test_concurrent(self):
+        run_tasks.run_tasks([
+            {'a': None},
+            {'b': 0.05, 'after': []},
+            {'c': 0.01, 'needs': ['a']},
+            {'d': None},
+            ], self.ctx)
+        assert self.events[:4] == [
+            ('start', 'a'), ('entered', 'a'), ('start', 'b'), ('start', 'c'),
+            ]
+        assert self.events.index(('start', 'c')) < \
+            self.events.index(('entered', 'b'))
+        assert self.events.index(('start', 'd')) > \
+            self.events.index(('entered', 'b'))
+        # unwound in the reverse order they were entered
+        assert [name for event, name in self.events if event == 'exit'] == \
+            ['d', 'b', 'c', 'a']
+
+    def test_needs_missing(self):
+        with pytest.raises(SystemExit):
+            run_tasks.run_tasks([{'a': None, 'needs': ['x']}], self.ctx)
+        assert self.ctx.summary['success'] is False
+        assert self.ctx.summary['failure_reason'] == \
+            'Task a needs x, which is not an earlier task'
+        assert self.events == []
+
+    def test_failure(self):
+        with pytest.raises(SystemExit):
+            run_tasks.run_tasks([
+                {'a': None},
+                {'b': 'fail', 'after': ['a']},
+                {'c': 0.01, 'after': ['a']},
+                {'d': None},
+                ], self.ctx)
+        assert self.ctx.summary['failure_reason'] == 'b failed'
+        # c was already starting, so it was waited for and unwound; d wasn't
+        # started
+        assert ('start', 'd') not in self.events
+        assert [name for event, name in self.events if event == 'exit'] == \
+            ['c', 'a']
+
+    def test_interrupt(self):
+        # run_tasks() turns it into SystemExit, as for any exception
+        with gevent.Timeout(5):
+            with pytest.raises(SystemExit):
+                run_tasks.run_tasks([
+                    {'a': None},
+                    {'b': 'interrupt', 'after': ['a']},
+                    {'c': 0.01, 'after': ['a']},
+                    ], self.ctx)
+        # the tasks that were entered are still unwound
+        assert [name for event, name in self.events if event == 'exit'] == \
+            ['c', 'a']
+
+    def test_report(self, tmpdir):
+        self.ctx.archive = str(tmpdir)
+        run_tasks.run_tasks([
+            {'a': None},
+            {'b': 0.05, 'id': 'slow', 'after': ['a']},
+            {'b': None, 'after': ['a']},
+            {'c': None, 'needs': ['slow']},
+            ], self.ctx)
+        with file(os.path.join(str(tmpdir), 'task_graph.yaml')) as f:
+            report = yaml.safe_load(f)
+        assert report['critical_path'] == ['a', 'slow', 'c']
+        assert [task['id'] for task in report['tasks']] == \
+            ['a', 'slow', 'b', 'c']
+        assert report['tasks'][3]['deps'] == ['a', 'slow']
+        assert self.ctx.summary['profile']['slowest_task'] == 'slow'
+        assert os.path.exists(os.path.join(str(tmpdir), 'profile.json'))
+
+    def test_report_failure(self, tmpdir, monkeypatch):
+        def write_report(graph, archive):
+            raise IOError('disk full')
+        monkeypatch.setattr(run_tasks.TaskGraph, 'write_report', write_report)
+        self.ctx.archive = str(tmpdir)
+        run_tasks.run_tasks([{'a': None}], self.ctx)
+        # the profile is still written
+        assert self.ctx.summary['profile']['slowest_task'] == 'a'
+        assert os.path.exists(os.path.join(str(tmpdir), 'profile.json'))
@@ -0,0 +1,56 @@
+import gzip
+import json
+import os
+import subprocess
+import sys
+
+SCAN_LOGS = os.path.join(os.path.dirname(__file__), '..', 'task', 'scan-logs')
+
+
+def scan(*args):
+    out = subprocess.check_output([sys.executable, SCAN_LOGS] + list(args))
+    return json.loads(out)
+
+
+class TestScanLogs(object):
+
+    def setup(self):
+        self.lines = [
+            '2014-05-30 mon.0 [INF] all good',
+            '2014-05-30 osd.1 [WRN] slow request',
+            '2014-05-30 osd.2 [ERR] bad crc',
+            '2014-05-30 osd.3 [WRN] clock skew',
+            '2014-05-30 osd.4 [ERR] ignore me',
+        ]
+
+    def test_plain_and_gz(self, tmpdir):
+        tmpdir.join('ceph.log').write('\n'.join(self.lines[:3]) + '\n')
+        f = gzip.open(str(tmpdir.join('old.log.gz')), 'wb')
+        f.write('\n'.join(self.lines[3:]) + '\n')
+        f.close()
+        got = scan(
+            '--pattern', 'ERR=\\[ERR\\]',
+            '--pattern', 'WRN=\\[WRN\\]',
+            '--exclude', 'ignore me',
+            '--', str(tmpdir.join('*')),
+        )
+        assert got['counts'] == {'ERR': 1, 'WRN': 2}
+        assert got['hits']['ERR'] == [
+            [str(tmpdir.join('ceph.log')), self.lines[2]]]
+        assert len(got['hits']['WRN']) == 1
+
+    def test_max_hits_and_unique(self, tmpdir):
+        tmpdir.join('v.log').write('<kind>Leak</kind>\n' * 3 +
+                                   '<kind>Race</kind>\n')
+        got = scan(
+            '--max-hits', '10', '--unique',
+            '--pattern', 'kind=<kind>',
+            str(tmpdir.join('v.log')),
+        )
+        assert got['counts'] == {'kind': 2}
+        assert [line for _, line in got['hits']['kind']] == [
+            '<kind>Leak</kind>', '<kind>Race</kind>']
+
+    def test_missing_files(self, tmpdir):
+        got = scan('--pattern', 'x=x', str(tmpdir.join('nope*')))
+        assert got == {'counts': {'x': 0}, 'hits': {'x': []}}
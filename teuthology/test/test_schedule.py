@@ -0,0 +1,125 @@
+import argparse
+import os
+import tempfile
+import yaml
+from pytest import raises
+
+import beanstalkc
+
+from .. import beanstalk
+from .. import schedule
+from .. import suite
+from ..config import config
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+class FakeConnection(beanstalk.Connection):
+    def __init__(self, responses=None):
+        self.responses = list(responses or [])
+        self.next_jid = 1
+        self.connect()
+
+    def connect(self):
+        self._socket = FakeSocket()
+
+    def _read_response(self):
+        if self.responses:
+            return self.responses.pop(0)
+        jid = self.next_jid
+        self.next_jid += 1
+        return 'INSERTED', [str(jid)]
+
+
+class TestPutJobs(object):
+    def test_single_round_trip(self):
+        conn = FakeConnection()
+        jids = beanstalk.put_jobs(conn, ['a', 'bc'], 10)
+        assert jids == [1, 2]
+        assert len(conn._socket.sent) == 1
+        assert conn._socket.sent[0] == \
+            'put 10 0 86400 1\r\na\r\nput 10 0 86400 2\r\nbc\r\n'
+
+    def test_failure(self):
+        conn = FakeConnection(responses=[('INSERTED', ['1']),
+                                         ('JOB_TOO_BIG', [])])
+        with raises(beanstalkc.CommandFailed):
+            beanstalk.put_jobs(conn, ['a', 'b'], 10)
+
+    def test_unknown_version(self):
+        orig_version = beanstalkc.__version__
+        beanstalkc.__version__ = '99.0'
+        try:
+            conn = FakeConnection()
+            jids = beanstalk.put_jobs(conn, ['a', 'bc'], 10)
+        finally:
+            beanstalkc.__version__ = orig_version
+        assert jids == [1, 2]
+        assert conn._socket.sent == ['put 10 0 86400 1\r\na\r\n',
+                                     'put 10 0 86400 2\r\nbc\r\n']
+
+
+class TestScheduleJobs(object):
+    def setup(self):
+        self.pushed = []
+        self.orig_push = schedule.report.try_push_jobs_info
+        schedule.report.try_push_jobs_info = \
+            lambda configs, extra: self.pushed.append(
+                [c['job_id'] for c in configs])
+
+        fd, self.index_path = tempfile.mkstemp()
+        os.close(fd)
+        self.orig_index = config.queue_index
+        config.queue_index = self.index_path
+
+    def teardown(self):
+        schedule.report.try_push_jobs_info = self.orig_push
+        config.queue_index = self.orig_index
+        os.remove(self.index_path)
+
+    def test_batches(self):
+        conn = FakeConnection()
+        configs = [dict(name='run', description=str(i), machine_type='plana')
+                   for i in range(5)]
+        count = schedule.schedule_jobs(conn, 'plana', configs, 1000, num=2,
+                                       batch_size=4)
+        assert count == 10
+        assert len(conn._socket.sent) == 3
+        assert self.pushed == [['1', '2', '3', '4'], ['5', '6', '7', '8'],
+                               ['9', '10']]
+        bodies = conn._socket.sent[0].split('\r\n')
+        assert yaml.safe_load(bodies[1]) == configs[0]
+
+    def test_indexed(self):
+        conn = FakeConnection()
+        # the job's yaml overrode machine_type
+        configs = [dict(name='run', description='desc', machine_type='mira')]
+        schedule.schedule_jobs(conn, 'plana', configs, 1000)
+        index = beanstalk.QueueIndex()
+        assert index.jobs('plana') == [
+            dict(job_id=1, name='run', priority=1000, description='desc')]
+        assert index.jobs('mira') == []
+        index.close()
+
+
+class TestBuildJobConfig(object):
+    def test_build_job_config(self):
+        args = argparse.Namespace(name='run', owner='me', verbose=None,
+                                  worker='plana', priority=50)
+        base = dict(targets=dict(host='key'), overrides=dict(a=[1]))
+        config = suite.build_job_config(
+            args, [base, dict(overrides=dict(a=[2]))], description='desc')
+        assert config['overrides'] == dict(a=[1, 2])
+        assert 'targets' not in config
+        assert config['description'] == 'desc'
+        assert config['machine_type'] == 'plana'
+        assert config['last_in_suite'] is False
+        assert config['priority'] == 50
+        # the base config must be left alone for the next job
+        assert base['overrides'] == dict(a=[1])
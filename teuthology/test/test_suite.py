@@ -0,0 +1,91 @@
+import itertools
+import os
+import shutil
+import tempfile
+
+from .. import suite
+
+
+def make_tree(base, tree):
+    for name, contents in tree.items():
+        path = os.path.join(base, name)
+        if isinstance(contents, dict):
+            os.mkdir(path)
+            make_tree(path, contents)
+        else:
+            with file(path, 'w') as f:
+                f.write(contents)
+
+
+class TestMatrix(object):
+    def setup(self):
+        self.base = tempfile.mkdtemp()
+        make_tree(self.base, {
+            'rados': {
+                '%': '',
+                'clusters': {'a.yaml': '', 'b.yaml': ''},
+                'fs': {'btrfs.yaml': '', 'xfs.yaml': '', 'README': ''},
+                'tasks': {
+                    '+': '',
+                    'install.yaml': '',
+                    'ceph.yaml': '',
+                },
+                'workloads': {
+                    'x.yaml': '',
+                    'y': {'%': '', 'p': {'1.yaml': '', '2.yaml': ''}},
+                },
+            },
+            'empty': {'%': ''},
+        })
+
+    def teardown(self):
+        shutil.rmtree(self.base)
+
+    def test_generate_matches_count(self):
+        path = os.path.join(self.base, 'rados')
+        items = suite.build_matrix(path)
+        assert len(items) == 2 * 2 * 1 * 3
+        assert suite.count_matrix(path) == len(items)
+        assert suite.count_matrix(os.path.join(self.base, 'empty')) == 0
+        assert suite.build_matrix(os.path.join(self.base, 'empty')) == []
+
+    def test_items(self):
+        items = suite.build_matrix(os.path.join(self.base, 'rados'))
+        desc, paths = items[0]
+        assert desc == ('{clusters/a.yaml fs/btrfs.yaml '
+                        'tasks/{ceph.yaml install.yaml} '
+                        'workloads/x.yaml}')
+        assert [os.path.basename(p) for p in paths] == \
+            ['a.yaml', 'btrfs.yaml', 'ceph.yaml', 'install.yaml', 'x.yaml']
+
+    def test_lazy(self):
+        gen = suite.generate_matrix(os.path.join(self.base, 'rados'))
+        first = list(itertools.islice(gen, 2))
+        assert first == suite.build_matrix(
+            os.path.join(self.base, 'rados'))[:2]
+
+
+class TestLoadFragment(object):
+    def setup(self):
+        fd, self.path = tempfile.mkstemp(suffix='.yaml')
+        os.close(fd)
+
+    def teardown(self):
+        os.remove(self.path)
+        suite._fragments.pop(self.path, None)
+
+    def test_cached_until_modified(self):
+        with file(self.path, 'w') as f:
+            f.write('os_type: ubuntu\n')
+        first = suite.load_fragment(self.path)
+        assert first == dict(os_type='ubuntu')
+        assert suite.load_fragment(self.path) is first
+
+        with file(self.path, 'w') as f:
+            f.write('os_type: rhel\n')
+        mtime = os.path.getmtime(self.path)
+        os.utime(self.path, (mtime + 10, mtime + 10))
+        assert suite.load_fragment(self.path) == dict(os_type='rhel')
+
+    def test_empty(self):
+        assert suite.load_fragment(self.path) == {}
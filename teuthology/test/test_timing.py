@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+
+from .. import timing
+
+
+class TestProfile(object):
+    def setup(self):
+        self.profile = timing.Profile()
+
+    def test_current_task(self):
+        assert self.profile.current_task() is None
+        with self.profile.task('b'):
+            assert self.profile.current_task() == 'b'
+            with self.profile.task('a'):
+                assert self.profile.current_task() == 'a+b'
+        assert self.profile.current_task() is None
+
+    def test_record_command(self):
+        self.profile.record_command('host1', 'true', 'a', 1.0, 0, 10)
+        self.profile.record_command('host2', 'false', 'a', 2.0, 1, 0)
+        self.profile.record_command('host1', 'ls', None, 0.5, None, 5)
+        assert self.profile.commands == 3
+        assert self.profile.failed_commands == 2
+        assert self.profile.command_time == 3.5
+        assert self.profile.output_bytes == 15
+        assert self.profile.hosts['host1'] == dict(
+            commands=2, command_time=1.5, failed_commands=1)
+        assert self.profile.tasks['a'] == dict(
+            commands=2, command_time=3.0, failed_commands=1)
+
+    def test_background(self):
+        self.profile.record_command('host', 'true', 'a', 1.0, 0, 10)
+        self.profile.record_command('host', 'daemon', 'a', 100.0, 1, 5,
+                                    background=True)
+        report = self.profile.report()
+        assert report['commands'] == 1
+        assert report['command_time'] == 1.0
+        assert report['output_bytes'] == 15
+        assert report['background_commands'] == 1
+        assert report['failed_background_commands'] == 1
+        assert report['background_time'] == 100.0
+        assert report['hosts']['host']['commands'] == 1
+        assert [command['command'] for command in
+                report['slowest_commands']] == ['true']
+        headline = self.profile.headline(report)
+        assert headline['slowest_command_duration'] == 1.0
+        assert headline['background_commands'] == 1
+
+    def test_slowest(self):
+        self.profile.max_slowest = 3
+        self.profile.max_command_length = 5
+        for i in range(10):
+            self.profile.record_command(
+                'host', 'sleep {i}'.format(i=i), 'a', float(i), 0, 0)
+        report = self.profile.report()
+        assert [command['duration'] for command in
+                report['slowest_commands']] == [9.0, 8.0, 7.0]
+        assert report['slowest_commands'][0]['command'] == 'sleep'
+
+    def test_report(self):
+        self.profile.record_command('host', 'true', 'a', 1.0, 0, 0)
+        self.profile.record_command('host', 'true', 'b+c', 4.0, 0, 0)
+        report = self.profile.report([
+            dict(task='a', enter=2.0, exit=1.0),
+            dict(task='b', enter=5.0, exit=None),
+            ])
+        assert [task['task'] for task in report['tasks']] == ['a', 'b', 'b+c']
+        assert report['tasks'][0]['commands'] == 1
+        assert 'commands' not in report['tasks'][1]
+        headline = self.profile.headline(report)
+        assert headline['slowest_task'] == 'b'
+        assert headline['slowest_task_duration'] == 5.0
+        assert headline['slowest_command_duration'] == 4.0
+        assert headline['command_time'] == 5.0
+
+
+class TestWriteProfile(object):
+    def setup(self):
+        self.orig_profile = timing.profile
+        timing.profile = timing.Profile()
+
+    def teardown(self):
+        timing.profile = self.orig_profile
+
+    def test_write_profile(self, tmpdir):
+        ctx = argparse.Namespace(summary=dict(), archive=str(tmpdir))
+        timing.profile.record_command('host', 'true', 'a', 1.0, 0, 3)
+        timing.write_profile(ctx, [dict(task='a', enter=1.5, exit=0.5)])
+        assert ctx.summary['profile']['commands'] == 1
+        assert ctx.summary['profile']['slowest_task'] == 'a'
+        with file(os.path.join(str(tmpdir), 'profile.json')) as f:
+            report = json.load(f)
+        assert report['hosts']['host']['commands'] == 1
+        assert report['tasks'][0]['enter'] == 1.5
@@ -0,0 +1,191 @@
+import argparse
+import gevent
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from pytest import raises
+
+from .. import worker
+
+
+class FakeProcess(object):
+    def __init__(self, polls):
+        self.polls = polls
+
+    def poll(self):
+        self.polls -= 1
+        if self.polls <= 0:
+            return 0
+
+
+class FakeJob(object):
+    def __init__(self, jid):
+        self.jid = jid
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+
+class TestCheckOutput(object):
+    def test_output(self):
+        assert worker.check_output(['echo', 'hi']) == 'hi\n'
+
+    def test_failure(self):
+        with raises(subprocess.CalledProcessError) as excinfo:
+            worker.check_output('echo oops; exit 3', shell=True)
+        assert excinfo.value.returncode == 3
+        assert excinfo.value.output == 'oops\n'
+
+    def test_cooperative(self):
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(None)
+                gevent.sleep(0.05)
+        ticker = gevent.spawn(tick)
+        try:
+            worker.check_output(['sleep', '0.5'])
+        finally:
+            ticker.kill()
+        assert len(ticks) > 2
+
+
+class TestJobWatchdog(object):
+    def setup(self):
+        self.pushed = []
+        self.orig_push = worker.report.try_push_job_info
+        worker.report.try_push_job_info = \
+            lambda info, extra: self.pushed.append(extra['status'])
+        self.orig_interval = worker.JobWatchdog.poll_interval
+        worker.JobWatchdog.poll_interval = 0
+
+    def teardown(self):
+        worker.report.try_push_job_info = self.orig_push
+        worker.JobWatchdog.poll_interval = self.orig_interval
+
+    def make_watchdog(self, polls):
+        job_config = dict(name='run', job_id='1', worker_log='/dev/null',
+                          archive_path='/nonexistent')
+        return worker.JobWatchdog(FakeProcess(polls), job_config)
+
+    def test_returns_when_process_exits(self):
+        watchdog = self.make_watchdog(3)
+        watchdog.wait()
+        assert watchdog.process.polls == 0
+        # nowhere near watchdog_interval
+        assert self.pushed == []
+
+
+class TestSupervisor(object):
+    def setup(self):
+        ctx = argparse.Namespace(tube='test-%d' % os.getpid())
+        self.supervisor = worker.Supervisor(ctx, None, '/dev/null', 2)
+        fd, self.supervisor.slots_path = tempfile.mkstemp()
+        os.close(fd)
+
+    def teardown(self):
+        os.remove(self.supervisor.slots_path)
+
+    def test_reap(self):
+        done = FakeJob(1)
+        thrown_away = FakeJob(2)
+        busy = FakeJob(3)
+        self.supervisor.running = {
+            1: (done, gevent.spawn(lambda: True)),
+            2: (thrown_away, gevent.spawn(lambda: False)),
+            3: (busy, gevent.spawn(gevent.sleep, 10)),
+        }
+        gevent.sleep(0)
+        self.supervisor.reap()
+        assert self.supervisor.running.keys() == [3]
+        assert done.deleted
+        assert not thrown_away.deleted
+        self.supervisor.running[3][1].kill()
+
+    def test_update_slots(self):
+        with file(self.supervisor.slots_path, 'w') as f:
+            f.write('5\n')
+        self.supervisor.update_slots()
+        assert self.supervisor.slots == 5
+
+    def test_update_slots_garbage(self):
+        with file(self.supervisor.slots_path, 'w') as f:
+            f.write('many\n')
+        self.supervisor.update_slots()
+        assert self.supervisor.slots == 2
+
+
+class TestCheckoutCache(object):
+    def setup(self):
+        self.base = tempfile.mkdtemp()
+        upstream = os.path.join(self.base, 'teuthology.git')
+        os.mkdir(upstream)
+        bootstrap = os.path.join(upstream, 'bootstrap')
+        with file(bootstrap, 'w') as f:
+            f.write('#!/bin/sh\nmkdir -p virtualenv/bin\n')
+        os.chmod(bootstrap, 0755)
+        for cmd in (('git', 'init', '-q'),
+                    ('git', 'symbolic-ref', 'HEAD', 'refs/heads/master'),
+                    ('git', 'add', 'bootstrap'),
+                    ('git', '-c', 'user.name=t', '-c', 'user.email=t@t',
+                     'commit', '-q', '-m', 'init')):
+            subprocess.check_call(cmd, cwd=upstream)
+        self.orig = (worker.checkout_cache_dir,
+                     worker.teuth_config.ceph_git_base_url)
+        worker.checkout_cache_dir = os.path.join(self.base, 'cache')
+        worker.teuth_config.ceph_git_base_url = 'file://' + self.base + '/'
+        worker._resolved_branches.clear()
+
+    def teardown(self):
+        (worker.checkout_cache_dir,
+         worker.teuth_config.ceph_git_base_url) = self.orig
+        worker._resolved_branches.clear()
+        shutil.rmtree(self.base)
+
+    def test_miss_then_hit(self):
+        hits = worker.cache_stats['hits']
+        misses = worker.cache_stats['misses']
+        path = worker.fetch_teuthology_branch('master')
+        assert os.path.isdir(os.path.join(path, 'virtualenv', 'bin'))
+        assert worker.cache_stats['misses'] == misses + 1
+        assert worker.fetch_teuthology_branch('master') == path
+        assert worker.cache_stats['hits'] == hits + 1
+
+    def test_bootstrap_fails(self):
+        upstream = os.path.join(self.base, 'teuthology.git')
+        with file(os.path.join(upstream, 'bootstrap'), 'w') as f:
+            f.write('#!/bin/sh\necho broken\nexit 1\n')
+        for cmd in (('git', 'checkout', '-q', '-b', 'broken'),
+                    ('git', '-c', 'user.name=t', '-c', 'user.email=t@t',
+                     'commit', '-q', '-a', '-m', 'break')):
+            subprocess.check_call(cmd, cwd=upstream)
+        with raises(RuntimeError):
+            worker.fetch_teuthology_branch('broken')
+        # so the next job tries again, instead of using the broken checkout
+        assert not [name for name in os.listdir(worker.checkout_cache_dir)
+                    if name.endswith('.ready')]
+
+    def test_missing_branch(self):
+        with raises(worker.BranchNotFoundError):
+            worker.fetch_teuthology_branch('nonexistent')
+
+    def test_prune(self):
+        os.makedirs(worker.checkout_cache_dir)
+        old = time.time() - worker.teuth_config.max_job_time - 60
+        for i, sha1 in enumerate(['a', 'b', 'c']):
+            os.mkdir(os.path.join(worker.checkout_cache_dir, sha1))
+            ready = os.path.join(worker.checkout_cache_dir, sha1 + '.ready')
+            file(ready, 'w').close()
+            os.utime(ready, (old + i, old + i))
+        orig_size = worker.checkout_cache_size
+        worker.checkout_cache_size = 2
+        try:
+            worker.prune_teuthology_checkouts()
+        finally:
+            worker.checkout_cache_size = orig_size
+        assert sorted(os.listdir(worker.checkout_cache_dir)) == \
+            ['a.lock', 'b', 'b.ready', 'c', 'c.ready']
@@ -0,0 +1,177 @@
+"""
+Where the time in a job went: how long each task took to enter and exit,
+and the wall time of every remote command, summed per task and per host.
+
+Long-lived daemons - commands whose stdin is kept open, as daemon-helper
+needs - are only counted apart: their lifetime is not time spent waiting
+for them.
+"""
+import contextlib
+import heapq
+import json
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+
+class Profile(object):
+    """
+    Aggregates the remote commands run through `orchestra.run.run`, keeping
+    only the slowest ones in full.
+    """
+    # how many of the slowest commands to keep
+    max_slowest = 20
+    # longer commands are truncated in the report
+    max_command_length = 200
+
+    def __init__(self):
+        self.commands = 0
+        self.failed_commands = 0
+        self.command_time = 0.0
+        self.output_bytes = 0
+        # daemons; see record_command()
+        self.background_commands = 0
+        self.failed_background_commands = 0
+        self.background_time = 0.0
+        # name -> dict(commands, command_time, failed_commands)
+        self.hosts = {}
+        self.tasks = {}
+        # heap of (duration, sequence number, info)
+        self.slowest = []
+        # tasks being entered or exited right now
+        self._active = []
+
+    @contextlib.contextmanager
+    def task(self, name):
+        """
+        Count the commands started in this block against task name.
+        """
+        self._active.append(name)
+        try:
+            yield
+        finally:
+            self._active.remove(name)
+
+    def current_task(self):
+        """
+        The task that commands started now belong to. When several tasks
+        are being entered at once, it's all of them, joined by '+'.
+        """
+        if not self._active:
+            return None
+        return '+'.join(sorted(set(self._active)))
+
+    def record_command(self, host, command, task, duration, exitstatus,
+                       output_bytes, background=False):
+        """
+        :param task:         `current_task` when the command started
+        :param exitstatus:   None if it crashed or the connection was lost
+        :param output_bytes: Bytes of stdout and stderr, where we read them
+        :param background:   Whether it is a daemon, which runs until its
+                             stdin is closed. Those are only added to the
+                             background_* counters.
+        """
+        failed = exitstatus != 0
+        self.output_bytes += output_bytes
+        if background:
+            self.background_commands += 1
+            self.failed_background_commands += failed
+            self.background_time += duration
+            return
+        self.commands += 1
+        self.failed_commands += failed
+        self.command_time += duration
+        for counters in (self.hosts.setdefault(host, {}),
+                         self.tasks.setdefault(task, {})):
+            counters['commands'] = counters.get('commands', 0) + 1
+            counters['command_time'] = \
+                counters.get('command_time', 0.0) + duration
+            counters['failed_commands'] = \
+                counters.get('failed_commands', 0) + failed
+        info = dict(host=host, command=command[:self.max_command_length],
+                    task=task, duration=round(duration, 3),
+                    exitstatus=exitstatus, output_bytes=output_bytes)
+        entry = (duration, self.commands, info)
+        if len(self.slowest) < self.max_slowest:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def report(self, tasks=()):
+        """
+        :param tasks: A list of dict(task=<id>, enter=<seconds>,
+                      exit=<seconds>), in job order
+        :returns: The profile, as a dict
+        """
+        task_reports = []
+        for task in tasks:
+            info = dict(task)
+            info.update(self.tasks.get(task['task'], {}))
+            task_reports.append(info)
+        # commands not started by a single task, e.g. by several being
+        # entered at once
+        listed = set(task['task'] for task in tasks)
+        for name, counters in sorted(self.tasks.iteritems()):
+            if name not in listed:
+                info = dict(task=name)
+                info.update(counters)
+                task_reports.append(info)
+        return dict(
+            commands=self.commands,
+            failed_commands=self.failed_commands,
+            command_time=round(self.command_time, 3),
+            output_bytes=self.output_bytes,
+            background_commands=self.background_commands,
+            failed_background_commands=self.failed_background_commands,
+            background_time=round(self.background_time, 3),
+            tasks=task_reports,
+            hosts=self.hosts,
+            slowest_commands=[command for _, _, command in
+                              sorted(self.slowest, reverse=True)],
+            )
+
+    def headline(self, report):
+        """
+        The few numbers from report that go in the job summary.
+        """
+        headline = dict(
+            commands=report['commands'],
+            failed_commands=report['failed_commands'],
+            command_time=report['command_time'],
+            output_bytes=report['output_bytes'],
+            background_commands=report['background_commands'],
+            )
+        timed = [task for task in report['tasks'] if 'enter' in task]
+        if timed:
+            slowest = max(timed, key=lambda task: (task['enter'] or 0) +
+                          (task['exit'] or 0))
+            headline['slowest_task'] = slowest['task']
+            headline['slowest_task_duration'] = round(
+                (slowest['enter'] or 0) + (slowest['exit'] or 0), 3)
+        if report['slowest_commands']:
+            headline['slowest_command_duration'] = \
+                report['slowest_commands'][0]['duration']
+        return headline
+
+
+# the profile of this job
+profile = Profile()
+
+
+def write_profile(ctx, tasks=()):
+    """
+    Write profile.json to the archive directory, if there is one, and put
+    the headline numbers in ctx.summary['profile'].
+
+    :param tasks: See `Profile.report`
+    """
+    report = profile.report(tasks)
+    ctx.summary['profile'] = profile.headline(report)
+    archive = getattr(ctx, 'archive', None)
+    if archive is not None:
+        with file(os.path.join(archive, 'profile.json'), 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    log.info('%d commands took %.1fs; slowest task: %s',
+             report['commands'], report['command_time'],
+             ctx.summary['profile'].get('slowest_task'))
@@ -1,4 +1,6 @@
+import errno
 import fcntl
+import gevent
 import logging
 import os
 import subprocess
@@ -6,6 +8,7 @@ import signal
 import shutil
 import sys
 import tempfile
+import threading
 import time
 import yaml
 
@@ -23,6 +26,7 @@ from .misc import read_config
 log = logging.getLogger(__name__)
 start_time = datetime.utcnow()
 restart_file_path = '/tmp/teuthology-restart-workers'
+slots_file_path = '/tmp/teuthology-worker-slots.{tube}'
 
 
 def need_restart():
@@ -42,6 +46,35 @@ def restart():
     os.execv(sys.executable, args)
 
 
+def wait_for_process(process, interval=0.5):
+    """
+    Wait for a subprocess.Popen to exit, letting other greenlets run
+    meanwhile: gevent 0.13 doesn't make Popen.wait() or communicate()
+    cooperative, so either would stall every slot of the worker.
+
+    :returns: The process's exit status
+    """
+    while process.poll() is None:
+        gevent.sleep(interval)
+    return process.returncode
+
+
+def check_output(args, **kwargs):
+    """
+    subprocess.check_output(), without blocking other greenlets. The output
+    goes to a temporary file rather than a pipe, so that the process can
+    never block on a full pipe while we poll it.
+    """
+    with tempfile.TemporaryFile() as out:
+        process = subprocess.Popen(args, stdout=out, **kwargs)
+        returncode = wait_for_process(process, interval=0.1)
+        out.seek(0)
+        output = out.read()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args, output=output)
+    return output
+
+
 def install_except_hook():
     """
     Install an exception hook that first logs any uncaught exception, then
@@ -68,7 +101,16 @@ class filelock(object):
     def acquire(self):
         assert not self.fd
         self.fd = file(self.fn, 'w')
-        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        # poll rather than block, so that other greenlets keep running while
+        # another worker holds the lock
+        while True:
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+            gevent.sleep(1)
 
     def release(self):
         assert self.fd
@@ -84,70 +126,174 @@ class BranchNotFoundError(ValueError):
         return "teuthology branch not found: '{0}'".format(self.branch)
 
 
-def fetch_teuthology_branch(path, branch='master'):
+# Checkouts of teuthology are kept here, one per commit, named after its sha1.
+# A checkout is ready to be used once a <sha1>.ready file exists beside it;
+# that file's mtime records when the checkout was last used.
+checkout_cache_dir = os.path.join(os.path.expanduser('~'),
+                                  'teuthology-cache')
+# How many checkouts to keep around. Older ones are removed, but only once
+# no job can still be running from them.
+checkout_cache_size = 10
+
+# path -> threading.Lock, so that slots of one worker don't update the same
+# checkout at once (filelock only excludes other processes)
+_cache_locks = {}
+# branch -> (sha1, when it was resolved)
+_resolved_branches = {}
+cache_stats = dict(hits=0, misses=0)
+
+
+def _cache_lock(path):
+    return _cache_locks.setdefault(path, threading.Lock())
+
+
+def _teuthology_git_upstream():
+    return teuth_config.ceph_git_base_url + 'teuthology.git'
+
+
+def resolve_teuthology_branch(branch):
     """
-    Make sure we have the correct teuthology branch checked out and up-to-date
+    Find the sha1 that a teuthology branch currently points to upstream,
+    asking at most once a minute.
+
+    :raises: BranchNotFoundError if there is no such branch
     """
-    # only let one worker create/update the checkout at a time
-    lock = filelock('%s.lock' % path)
-    lock.acquire()
-    try:
-        if os.path.isdir(path) and \
-                not os.path.isdir(os.path.join(path, '.git')):
-            log.info("Removing possibly-corrupt repo for branch %s", branch)
-            shutil.rmtree(path)
-
-        if not os.path.isdir(path):
-            log.info("Cloning %s from upstream", branch)
-            teuthology_git_upstream = teuth_config.ceph_git_base_url + \
-                'teuthology.git'
-            log.info(
-                subprocess.check_output(('git', 'clone', '--branch', branch,
-                                         teuthology_git_upstream, path),
-                                        cwd=os.path.dirname(path))
-            )
-        elif time.time() - os.stat('/etc/passwd').st_mtime > 60:
-            # only do this at most once per minute
-            log.info("Fetching %s from upstream", branch)
-            log.info(
-                subprocess.check_output(('git', 'fetch', '-p', 'origin'),
-                                        cwd=path)
-            )
-            log.info(
-                subprocess.check_output(('touch', path))
-            )
-        else:
-            log.info("%s was just updated; assuming it is current", branch)
+    resolved = _resolved_branches.get(branch)
+    if resolved is not None and time.time() - resolved[1] < 60:
+        return resolved[0]
+    out = check_output(
+        ('git', 'ls-remote', _teuthology_git_upstream(),
+         'refs/heads/%s' % branch))
+    if not out.strip():
+        raise BranchNotFoundError(branch)
+    sha1 = out.split()[0]
+    _resolved_branches[branch] = (sha1, time.time())
+    return sha1
+
+
+def fetch_teuthology_branch(branch='master'):
+    """
+    Make sure we have a bootstrapped checkout of the current head of a
+    teuthology branch.
 
-        # This try/except block will notice if the requested branch doesn't
-        # exist, whether it was cloned or fetched.
+    :returns: The path to the checkout
+    """
+    sha1 = resolve_teuthology_branch(branch)
+    path = os.path.join(checkout_cache_dir, sha1)
+    ready_path = path + '.ready'
+    if not os.path.isdir(checkout_cache_dir):
+        os.makedirs(checkout_cache_dir)
+    with _cache_lock(path):
+        # only let one worker build a checkout at a time
+        lock = filelock('%s.lock' % path)
+        lock.acquire()
         try:
-            subprocess.check_output(
-                ('git', 'reset', '--hard', 'origin/%s' % branch),
-                cwd=path,
-            )
-        except subprocess.CalledProcessError:
-            shutil.rmtree(path)
-            raise BranchNotFoundError(branch)
-
-        log.debug("Bootstrapping %s", path)
-        # This magic makes the bootstrap script not attempt to clobber an
-        # existing virtualenv. But the branch's bootstrap needs to actually
-        # check for the NO_CLOBBER variable.
-        env = os.environ.copy()
-        env['NO_CLOBBER'] = '1'
-        cmd = './bootstrap'
-        boot_proc = subprocess.Popen(cmd, shell=True, cwd=path, env=env,
-                                     stdout=subprocess.PIPE,
-                                     stderr=subprocess.STDOUT)
-        returncode = boot_proc.wait()
-        if returncode != 0:
-            for line in boot_proc.stdout.readlines():
-                log.warn(line.strip())
-        log.info("Bootstrap exited with status %s", returncode)
-
-    finally:
-        lock.release()
+            if os.path.exists(ready_path):
+                cache_stats['hits'] += 1
+                os.utime(ready_path, None)
+                log.info("Using cached teuthology %s (%s); "
+                         "cache hits: %d misses: %d", branch, sha1,
+                         cache_stats['hits'], cache_stats['misses'])
+                return path
+            cache_stats['misses'] += 1
+            log.info("Building teuthology %s (%s); "
+                     "cache hits: %d misses: %d", branch, sha1,
+                     cache_stats['hits'], cache_stats['misses'])
+            build_teuthology_checkout(path, sha1)
+            file(ready_path, 'w').close()
+        finally:
+            lock.release()
+    prune_teuthology_checkouts()
+    return path
+
+
+def update_teuthology_mirror():
+    """
+    Create or update the local mirror of teuthology.git that checkouts are
+    cloned from.
+
+    :returns: The path to the mirror
+    """
+    path = os.path.join(checkout_cache_dir, 'teuthology.git')
+    with _cache_lock(path):
+        lock = filelock('%s.lock' % path)
+        lock.acquire()
+        try:
+            if os.path.isdir(path):
+                log.info("Fetching teuthology from upstream")
+                log.info(
+                    check_output(('git', 'fetch', '-p', 'origin'), cwd=path)
+                )
+            else:
+                log.info("Mirroring teuthology from upstream")
+                log.info(
+                    check_output(
+                        ('git', 'clone', '--mirror',
+                         _teuthology_git_upstream(), path))
+                )
+        finally:
+            lock.release()
+    return path
+
+
+def build_teuthology_checkout(path, sha1):
+    """
+    Check out and bootstrap one teuthology commit at path, replacing whatever
+    partial checkout may have been left there.
+
+    :raises: RuntimeError if ./bootstrap fails
+    """
+    if os.path.isdir(path):
+        log.info("Removing incomplete checkout %s", path)
+        shutil.rmtree(path)
+    mirror = update_teuthology_mirror()
+    check_output(('git', 'clone', '--no-checkout', mirror, path))
+    check_output(('git', 'checkout', '-q', sha1), cwd=path)
+
+    log.debug("Bootstrapping %s", path)
+    # This magic makes the bootstrap script not attempt to clobber an
+    # existing virtualenv. But the branch's bootstrap needs to actually
+    # check for the NO_CLOBBER variable.
+    env = os.environ.copy()
+    env['NO_CLOBBER'] = '1'
+    cmd = './bootstrap'
+    try:
+        check_output(cmd, shell=True, cwd=path, env=env,
+                     stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        for line in e.output.splitlines():
+            log.warn(line.strip())
+        # without the .ready file, the next job rebuilds it from scratch
+        raise RuntimeError("Bootstrap of teuthology %s failed with status %s"
+                           % (sha1, e.returncode))
+    log.info("Bootstrapped %s", path)
+
+
+def prune_teuthology_checkouts():
+    """
+    Remove the least recently used checkouts beyond checkout_cache_size,
+    skipping any that were used within max_job_time.
+    """
+    entries = []
+    for name in os.listdir(checkout_cache_dir):
+        if name.endswith('.ready'):
+            sha1 = name[:-len('.ready')]
+            mtime = os.path.getmtime(os.path.join(checkout_cache_dir, name))
+            entries.append((mtime, sha1))
+    entries.sort(reverse=True)
+    for mtime, sha1 in entries[checkout_cache_size:]:
+        if time.time() - mtime < teuth_config.max_job_time:
+            continue
+        path = os.path.join(checkout_cache_dir, sha1)
+        with _cache_lock(path):
+            lock = filelock('%s.lock' % path)
+            lock.acquire()
+            try:
+                log.info("Removing least recently used teuthology %s", sha1)
+                os.remove(path + '.ready')
+                shutil.rmtree(path, ignore_errors=True)
+            finally:
+                lock.release()
 
 
 def main(ctx):
@@ -175,6 +321,10 @@ def main(ctx):
     connection = beanstalk.connect()
     beanstalk.watch_tube(connection, ctx.tube)
 
+    if ctx.slots is not None:
+        Supervisor(ctx, connection, log_file_path, ctx.slots).loop()
+        return
+
     while True:
         if need_restart():
             restart()
@@ -185,99 +335,247 @@ def main(ctx):
 
         # bury the job so it won't be re-run if it fails
         job.bury()
-        log.info('Reserved job %d', job.jid)
-        log.info('Config is: %s', job.body)
-        job_config = yaml.safe_load(job.body)
+        if process_job(ctx, job, log_file_path):
+            job.delete()
+
 
-        job_config['job_id'] = str(job.jid)
-        safe_archive = safepath.munge(job_config['name'])
-        job_config['worker_log'] = log_file_path
-        archive_path_full = os.path.join(
-            ctx.archive_dir, safe_archive, str(job.jid))
-        job_config['archive_path'] = archive_path_full
+def process_job(ctx, job, log_file_path, report_running=True):
+    """
+    Run a reserved (and buried) job to completion.
+
+    :param ctx:            The worker's parsed arguments
+    :param job:            The beanstalkc.Job
+    :param log_file_path:  The worker's log file
+    :param report_running: Whether the job's watchdog pushes the 'running'
+                           status itself
+    :returns:              False if the job was thrown away and must be left
+                           buried, True once it has been run
+    """
+    log.info('Reserved job %d', job.jid)
+    log.info('Config is: %s', job.body)
+    job_config = yaml.safe_load(job.body)
+
+    job_config['job_id'] = str(job.jid)
+    safe_archive = safepath.munge(job_config['name'])
+    job_config['worker_log'] = log_file_path
+    archive_path_full = os.path.join(
+        ctx.archive_dir, safe_archive, str(job.jid))
+    job_config['archive_path'] = archive_path_full
+
+    # If the teuthology branch was not specified, default to master and
+    # store that value.
+    teuthology_branch = job_config.get('teuthology_branch', 'master')
+    job_config['teuthology_branch'] = teuthology_branch
 
-        # If the teuthology branch was not specified, default to master and
-        # store that value.
-        teuthology_branch = job_config.get('teuthology_branch', 'master')
-        job_config['teuthology_branch'] = teuthology_branch
+    try:
+        teuth_path = fetch_teuthology_branch(branch=teuthology_branch)
+    except BranchNotFoundError:
+        log.exception(
+            "Branch not found; throwing job away")
+        # Optionally, we could mark the job as dead, but we don't have a
+        # great way to express why it is dead.
+        report.try_delete_jobs(job_config['name'],
+                               job_config['job_id'])
+        return False
 
-        teuth_path = os.path.join(os.getenv("HOME"),
-                                  'teuthology-' + teuthology_branch)
+    teuth_bin_path = os.path.join(teuth_path, 'virtualenv', 'bin')
+    if not os.path.isdir(teuth_bin_path):
+        raise RuntimeError("teuthology branch %s at %s not bootstrapped!" %
+                           (teuthology_branch, teuth_bin_path))
 
-        try:
-            fetch_teuthology_branch(path=teuth_path, branch=teuthology_branch)
-        except BranchNotFoundError:
-            log.exception(
-                "Branch not found; throwing job away")
-            # Optionally, we could mark the job as dead, but we don't have a
-            # great way to express why it is dead.
+    if job_config.get('last_in_suite'):
+        if teuth_config.results_server:
             report.try_delete_jobs(job_config['name'],
                                    job_config['job_id'])
-            continue
+        log.info('Generating results email for %s', job_config['name'])
+        args = [
+            os.path.join(teuth_bin_path, 'teuthology-results'),
+            '--timeout',
+            str(job_config.get('results_timeout', 21600)),
+            '--email',
+            job_config['email'],
+            '--archive-dir',
+            os.path.join(ctx.archive_dir, safe_archive),
+            '--name',
+            job_config['name'],
+        ]
+        # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
+        # make sure that it will continue to run if this worker process
+        # dies (e.g. because of a restart)
+        result_pid = subprocess.Popen(args=args,
+                                      preexec_fn=os.setpgrp,).pid
+        # Indicate that we don't care about collecting its return code, so
+        # it doesn't become a zombie. We can't have zombies piling up.
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        log.info("teuthology-results PID: %s", result_pid)
+    else:
+        log.info('Creating archive dir %s', archive_path_full)
+        safepath.makedirs(ctx.archive_dir, safe_archive)
+        log.info('Running job %d', job.jid)
+        run_job(job_config, teuth_bin_path, report_running=report_running)
+    return True
 
-        teuth_bin_path = os.path.join(teuth_path, 'virtualenv', 'bin')
-        if not os.path.isdir(teuth_bin_path):
-            raise RuntimeError("teuthology branch %s at %s not bootstrapped!" %
-                               (teuthology_branch, teuth_bin_path))
-
-        if job_config.get('last_in_suite'):
-            if teuth_config.results_server:
-                report.try_delete_jobs(job_config['name'],
-                                       job_config['job_id'])
-            log.info('Generating results email for %s', job_config['name'])
-            args = [
-                os.path.join(teuth_bin_path, 'teuthology-results'),
-                '--timeout',
-                str(job_config.get('results_timeout', 21600)),
-                '--email',
-                job_config['email'],
-                '--archive-dir',
-                os.path.join(ctx.archive_dir, safe_archive),
-                '--name',
-                job_config['name'],
-            ]
-            # Execute teuthology-results, passing 'preexec_fn=os.setpgrp' to
-            # make sure that it will continue to run if this worker process
-            # dies (e.g. because of a restart)
-            result_pid = subprocess.Popen(args=args,
-                                          preexec_fn=os.setpgrp,).pid
-            # Indicate that we don't care about collecting its return code, so
-            # it doesn't become a zombie. We can't have zombies piling up.
-            signal.signal(signal.SIGCHLD, signal.SIG_IGN)
-            log.info("teuthology-results PID: %s", result_pid)
-        else:
-            log.info('Creating archive dir %s', archive_path_full)
-            safepath.makedirs(ctx.archive_dir, safe_archive)
-            log.info('Running job %d', job.jid)
-            run_job(job_config, teuth_bin_path)
-        job.delete()
 
+class Supervisor(object):
+    """
+    Run up to a number of jobs from one tube at once, each in its own slot.
 
-def run_with_watchdog(process, job_config):
-    job_start_time = datetime.utcnow()
+    Only the supervisor itself talks to beanstalk. The 'running' status of
+    every busy slot is pushed to the results server together, once per
+    watchdog_interval.
 
-    # Only push the information that's relevant to the watchdog, to save db
-    # load
+    The number of slots can be changed while the worker is running by
+    writing it to slots_file_path. Lowering it never kills running jobs; no
+    new jobs are reserved until enough of them have finished.
+    """
+    # how long to block in reserve() before checking on the slots again
+    reserve_timeout = 10
+
+    def __init__(self, ctx, connection, log_file_path, slots):
+        self.ctx = ctx
+        self.connection = connection
+        self.log_file_path = log_file_path
+        self.slots = slots
+        self.slots_path = slots_file_path.format(tube=ctx.tube)
+        self.slots_mtime = None
+        # jid -> (beanstalkc.Job, greenlet)
+        self.running = {}
+
+    def update_slots(self):
+        """
+        Pick up a new slot count from self.slots_path, if it has changed.
+        """
+        try:
+            mtime = os.path.getmtime(self.slots_path)
+            if mtime == self.slots_mtime:
+                return
+            self.slots_mtime = mtime
+            with file(self.slots_path) as f:
+                slots = int(f.read().strip())
+        except (OSError, IOError, ValueError):
+            return
+        if slots != self.slots and slots >= 0:
+            log.info("Changing from %d to %d slots", self.slots, slots)
+            self.slots = slots
+
+    def reap(self):
+        """
+        Delete the jobs whose slots have finished.
+        """
+        for jid, (job, greenlet) in self.running.items():
+            if not greenlet.ready():
+                continue
+            del self.running[jid]
+            if not greenlet.successful():
+                log.error("Job %d failed in its slot: %s", jid,
+                          greenlet.exception)
+            elif greenlet.value:
+                job.delete()
+
+    def report_running(self):
+        """
+        Push the 'running' status of every busy slot, forever, and log how
+        far behind the results PushQueue is.
+        """
+        while True:
+            gevent.sleep(teuth_config.watchdog_interval)
+            job_infos = []
+            for job, greenlet in self.running.values():
+                job_config = yaml.safe_load(job.body)
+                if job_config.get('last_in_suite'):
+                    continue
+                job_infos.append(dict(
+                    name=job_config['name'],
+                    job_id=str(job.jid),
+                ))
+            if job_infos:
+                report.try_push_jobs_info(job_infos, dict(status='running'))
+            stats = report.get_push_queue().stats()
+            if stats['depth']:
+                log.info("%d results updates queued, the oldest %ds ago",
+                         stats['depth'], stats['lag'])
+
+    def loop(self):
+        log.info("Supervising %d slots", self.slots)
+        if teuth_config.results_server:
+            gevent.spawn(self.report_running)
+        while True:
+            self.reap()
+            if need_restart():
+                if not self.running:
+                    restart()
+                log.info("Waiting for %d jobs before restarting",
+                         len(self.running))
+                gevent.sleep(self.reserve_timeout)
+                continue
+            self.update_slots()
+            if len(self.running) >= self.slots:
+                gevent.sleep(1)
+                continue
+
+            job = self.connection.reserve(timeout=self.reserve_timeout)
+            if job is None:
+                continue
+
+            # bury the job so it won't be re-run if it fails
+            job.bury()
+            greenlet = gevent.spawn(process_job, self.ctx, job,
+                                    self.log_file_path, report_running=False)
+            self.running[job.jid] = (job, greenlet)
+
+
+class JobWatchdog(object):
+    """
+    Wait for a job's process to exit, killing the job if it runs longer than
+    max_job_time and optionally pushing its 'running' status once per
+    watchdog_interval.
+    """
+    # how often to check whether the process has exited
+    poll_interval = 5
+
+    def __init__(self, process, job_config):
+        self.process = process
+        self.job_config = job_config
+        # Only push the information that's relevant to the watchdog, to save
+        # db load
+        self.job_info = dict(
+            name=job_config['name'],
+            job_id=job_config['job_id'],
+        )
+
+    def wait(self, report_running=True):
+        start = time.time()
+        next_report = start + teuth_config.watchdog_interval
+        killed = False
+        symlinked = False
+        while self.process.poll() is None:
+            time.sleep(self.poll_interval)
+            if not symlinked and \
+                    os.path.isdir(self.job_config['archive_path']):
+                symlink_worker_log(self.job_config['worker_log'],
+                                   self.job_config['archive_path'])
+                symlinked = True
+            now = time.time()
+            # Kill jobs that have been running longer than the global max
+            if not killed and now - start > teuth_config.max_job_time:
+                log.warning("Job ran longer than {max}s. Killing...".format(
+                    max=teuth_config.max_job_time))
+                kill_job(self.job_info['name'], self.job_info['job_id'],
+                         teuth_config.archive_base)
+                killed = True
+            if report_running and now >= next_report:
+                report.try_push_job_info(self.job_info,
+                                         dict(status='running'))
+                next_report = now + teuth_config.watchdog_interval
+
+
+def run_with_watchdog(process, job_config, report_running=True):
     job_info = dict(
         name=job_config['name'],
         job_id=job_config['job_id'],
     )
 
-    # Sleep once outside of the loop to avoid double-posting jobs
-    time.sleep(teuth_config.watchdog_interval)
-    symlink_worker_log(job_config['worker_log'], job_config['archive_path'])
-    while process.poll() is None:
-        # Kill jobs that have been running longer than the global max
-        run_time = datetime.utcnow() - job_start_time
-        total_seconds = run_time.days * 60 * 60 * 24 + run_time.seconds
-        if total_seconds > teuth_config.max_job_time:
-            log.warning("Job ran longer than {max}s. Killing...".format(
-                max=teuth_config.max_job_time))
-            kill_job(job_info['name'], job_info['job_id'],
-                     teuth_config.archive_base)
-
-        report.try_push_job_info(job_info, dict(status='running'))
-        time.sleep(teuth_config.watchdog_interval)
+    JobWatchdog(process, job_config).wait(report_running=report_running)
 
     # The job finished. Let's make sure paddles knows.
     branches_sans_reporting = ('argonaut', 'bobtail', 'cuttlefish', 'dumpling')
@@ -290,13 +588,9 @@ def run_with_watchdog(process, job_config):
             job_id=job_info['job_id'])
         try:
             log.info("Executing %s" % cmd)
-            report_proc = subprocess.Popen(cmd, shell=True,
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.STDOUT)
-            while report_proc.poll() is None:
-                for line in report_proc.stdout.readlines():
-                    log.info(line.strip())
-                time.sleep(1)
+            output = check_output(cmd, shell=True, stderr=subprocess.STDOUT)
+            for line in output.splitlines():
+                log.info(line.strip())
             log.info("Reported results via the teuthology-report command")
         except Exception:
             log.exception("teuthology-report failed")
@@ -308,7 +602,7 @@ def run_with_watchdog(process, job_config):
         report.try_push_job_info(job_info, dict(status='dead'))
 
 
-def run_job(job_config, teuth_bin_path):
+def run_job(job_config, teuth_bin_path, report_running=True):
     arg = [
         os.path.join(teuth_bin_path, 'teuthology'),
     ]
@@ -349,7 +643,8 @@ def run_job(job_config, teuth_bin_path):
         if teuth_config.results_server:
             log.info("Running with watchdog")
             try:
-                run_with_watchdog(p, job_config)
+                run_with_watchdog(p, job_config,
+                                  report_running=report_running)
             except Exception:
                 log.exception("run_with_watchdog had an unhandled exception")
                 raise
@@ -360,7 +655,7 @@ def run_job(job_config, teuth_bin_path):
             time.sleep(5)
             symlink_worker_log(job_config['worker_log'],
                                job_config['archive_path'])
-            p.wait()
+            wait_for_process(p)
 
         if p.returncode != 0:
             log.error('Child exited with code %d', p.returncode)